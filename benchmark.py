@@ -0,0 +1,239 @@
+"""
+Micro-benchmarks comparing the current implementation of some functions with
+their replacements. Results are printed, nothing is saved.
+Usage: python benchmark.py [-n NUMBER] BENCHMARK [BENCHMARK ...]
+"""
+import bz2
+import csv
+import datetime
+import gzip
+import lzma
+import os
+import random
+import shutil
+import sys
+import tempfile
+import timeit
+from optparse import OptionParser
+
+from common import read_timestamp, TimestampParser, TS_FORMAT, TS_LONG_FORMAT, read_raw_rows, CSV_TIME, \
+    CSV_POWER, CSV_OP, COMPRESSION_SUFFIXES, zstandard
+from data_csv_process import data_file_energy
+from merge import merge_dicts, merge_pd, pd
+from metrics_log_process import metrics_file_process
+
+
+def timestamps_sample(ts_format, n):
+    """
+    Returns 'n' consecutive timestamps, 1.3ms apart, written with 'ts_format'
+    as the acquisition script does (only 4 digits for microseconds)
+    """
+    start = datetime.datetime(2019, 7, 3, 9, 47, 35)
+    step = datetime.timedelta(microseconds=1300)
+    sample = []
+    for i in range(n):
+        ts = start + step * i
+        if ts_format.endswith('%f'):
+            sample.append(ts.strftime(ts_format)[:-2])
+        else:
+            sample.append(ts.strftime(ts_format))
+    return sample
+
+
+def report(name, n, seconds):
+    print(f'{name:<45}{n / seconds:>15,.0f} items/s{seconds:>12.4f} s')
+
+
+def bench_timestamp(number):
+    """
+    'read_timestamp' against 'TimestampParser.parse' and 'TimestampParser.epoch_us_column'
+    for each layout in TS_FORMAT
+    """
+    for ts_format in TS_FORMAT:
+        sample = timestamps_sample(ts_format, number)
+        print(f'[{ts_format}]')
+        report('read_timestamp', number, timeit.timeit(lambda: [read_timestamp(ts) for ts in sample], number=1))
+        parser = TimestampParser()
+        report('TimestampParser.parse', number, timeit.timeit(lambda: [parser.parse(ts) for ts in sample], number=1))
+        parser = TimestampParser()
+        report('TimestampParser.epoch_us_column', number,
+               timeit.timeit(lambda: parser.epoch_us_column(sample), number=1))
+
+
+def power_csv_sample(n, marks=None):
+    """
+    Writes a raw power csv with 'n' rows in a temporary file
+    :param n: int, number of rows
+    :param marks: dict of row number to operation, ie. {10: 'XS'}
+    :return: string, path of the file, the caller removes it
+    """
+    marks = marks or {}
+    fd, path = tempfile.mkstemp(suffix='.csv')
+    with os.fdopen(fd, 'w') as f:
+        f.write(f'{CSV_TIME},{CSV_POWER},{CSV_OP}\n')
+        for i, ts in enumerate(timestamps_sample(TS_LONG_FORMAT, n)):
+            f.write(f'{ts},{random.uniform(2000, 4000):.2f},{marks.get(i, "")}\n')
+    return path
+
+
+def bench_raw_rows(number):
+    """
+    csv.DictReader, as used before by data_csv_process, against 'read_raw_rows'
+    """
+    path = power_csv_sample(number)
+    try:
+        def dict_reader():
+            with open(path, 'r') as f:
+                for _ in csv.DictReader(f):
+                    pass
+
+        def raw_rows():
+            with open(path, 'rb') as f:
+                for _ in read_raw_rows(f):
+                    pass
+
+        report('csv.DictReader', number, timeit.timeit(dict_reader, number=1))
+        report('read_raw_rows', number, timeit.timeit(raw_rows, number=1))
+    finally:
+        os.remove(path)
+
+
+def compress(path, suffix):
+    """
+    Writes a copy of 'path' compressed with the format of 'suffix', see 'common.COMPRESSION_SUFFIXES'
+    :return: string, path of the copy
+    """
+    with open(path, 'rb') as src:
+        if suffix == '.zst':
+            with open(path + suffix, 'wb') as dst:
+                zstandard.ZstdCompressor().copy_stream(src, dst)
+        else:
+            with {'.gz': gzip, '.xz': lzma, '.bz2': bz2}[suffix].open(path + suffix, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+    return path + suffix
+
+
+def bench_compressed(number):
+    """
+    End to end energy of a power csv ('data_file_energy') read plain and from each compressed
+    format, the compressed files are decompressed as a stream
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        sample = power_csv_sample(number, {10: 'XS', number - 10: 'XF'})
+        file = 'data_hikey970_linux_mg_b_4_001.csv'
+        shutil.move(sample, os.path.join(directory, file))
+        size = os.path.getsize(os.path.join(directory, file))
+        files = [('', file)]
+        for suffix in COMPRESSION_SUFFIXES:
+            if suffix == '.zst' and zstandard is None:
+                print(f'{suffix:<10}zstandard is not installed, skipped')
+                continue
+            files.append((suffix, os.path.basename(compress(os.path.join(directory, file), suffix))))
+        for suffix, name in files:
+            seconds = timeit.timeit(lambda: data_file_energy(directory, name), number=1)
+            ratio = os.path.getsize(os.path.join(directory, name)) / size
+            report(f'data_file_energy {suffix or "plain"} ({ratio:.0%} of the size)', number, seconds)
+    finally:
+        shutil.rmtree(directory)
+
+
+def npb_log_sample(directory, n, chatter=0.99):
+    """
+    Writes a NPB log with about 'n' lines in 'directory', 'chatter' of them are output of the
+    benchmark that is not parsed, ie. iterations, as in the logs of long campaigns
+    :return: string, name of the log
+    """
+    name = 'npb_hikey970_linux_mg_b_4.log'
+    result = ['Class = B', 'Time in seconds = 10.50', 'Mop/s total = 120.10', 'Mops total = 120.10',
+              'Verification = SUCCESSFUL']
+    block = 2 + len(result)
+    iterations = max(int(block * chatter / (1 - chatter)), 1)
+    with open(os.path.join(directory, name), 'w') as f:
+        for run in range(1, n // (block + iterations) + 2):
+            f.write(f'[2019/07/03-09:47:35] Run: {run}\n[2019/07/03-09:47:35] Size: B\n')
+            for i in range(iterations):
+                f.write(f'[2019/07/03-09:47:35]  iter {i:8d}  residual {random.random():.12E}\n')
+            for line in result:
+                f.write(f'[2019/07/03-09:47:35]  {line}\n')
+    return name
+
+
+def bench_npb_log(number):
+    """
+    'metrics_file_process' reading every line of a NPB log against the scan of the lines
+    needed in a memory map, see 'metrics_log_process.scan_npb_log'
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        name = npb_log_sample(directory, number)
+        with open(os.path.join(directory, name)) as f:
+            lines = sum(1 for _ in f)
+        print(f'[{lines} lines][{os.path.getsize(os.path.join(directory, name)) / 1e6:.1f} MB]')
+        data = {}
+        for scan in (False, True):
+            seconds = timeit.timeit(lambda: data.setdefault(scan, metrics_file_process(directory, name, scan)),
+                                    number=1)
+            report(f'metrics_file_process {"scan" if scan else "line by line"}', lines, seconds)
+        assert data[False] == data[True]
+    finally:
+        shutil.rmtree(directory)
+
+
+def merge_sample(directory, n):
+    """
+    Writes a data and a metrics csv with 'n' runs each in 'directory', half of them in both
+    :return: tuple of strings (data, metrics), their paths
+    """
+    header = ['type', 'device', 'os', 'benchmark', 'size', 'threads', 'iteration']
+    data, metrics = os.path.join(directory, 'data.csv'), os.path.join(directory, 'metrics.csv')
+    with open(data, 'w', newline='') as d, open(metrics, 'w', newline='') as m:
+        data_writer, metrics_writer = csv.writer(d), csv.writer(m)
+        data_writer.writerow(header + ['joules', 'time'])
+        metrics_writer.writerow(header + ['time_npb', 'mops'])
+        for i in range(n):
+            run = ['', 'hikey970', 'linux', 'mg', 'b', '4', f'{i:08d}']
+            data_writer.writerow(run + [f'{random.random() * 1000:.6f}', f'{random.random() * 100:.4f}'])
+            run[-1] = f'{i + n // 2:08d}'
+            metrics_writer.writerow(run + [f'{random.random() * 100:.3f}', f'{random.random() * 100:.3f}'])
+    return data, metrics
+
+
+def bench_merge(number):
+    """
+    'merge_dicts', a hash join on the common fields, against 'merge_pd' when pandas is installed
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        data, metrics = merge_sample(directory, number)
+        seconds = timeit.timeit(lambda: merge_dicts(data=data, metrics=metrics), number=1)
+        report('merge_dicts', 2 * number, seconds)
+        if pd is not None:
+            seconds = timeit.timeit(lambda: merge_pd(data_file=data, metrics_file=metrics), number=1)
+            report('merge_pd', 2 * number, seconds)
+    finally:
+        shutil.rmtree(directory)
+
+
+BENCHMARKS = {
+    'timestamp': bench_timestamp,
+    'raw_rows': bench_raw_rows,
+    'compressed': bench_compressed,
+    'npb_log': bench_npb_log,
+    'merge': bench_merge,
+}
+
+
+def main():
+    parser = OptionParser(f'usage: python %prog [-n NUMBER] {{{",".join(BENCHMARKS)}}} ...')
+    parser.add_option('-n', '--number', action='store', type='int', dest='number', default=200000)
+    (options, args) = parser.parse_args()
+    if not args or not set(args) <= set(BENCHMARKS):
+        parser.print_help()
+        sys.exit(-1)
+    for name in args:
+        BENCHMARKS[name](options.number)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+import logging
+import os
+import sqlite3
+import time
+
+from common import csv_name_parsing, log_to_file, parse_args, strip_compression, IDs
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='[%(process)d][%(asctime)s.%(msecs)03d][%(name)s][%(levelname)s]%(message)s',
+    datefmt='%Y/%m/%d-%H:%M:%S'
+)
+
+logger = logging.getLogger('CATALOG')
+
+# Index file, saved in the root of the cataloged tree
+CATALOG_FILE = 'catalog.sqlite'
+# Files made by the scripts, their names look like the names of the data files
+DERIVED_PREFIXES = ('transformed-', 'read-')
+SUFFIXES = ('.csv', '.pta', '.log')
+# Columns that can be used to select files, see 'Catalog.select'
+CATALOG_FILTERS = (IDs.TYPE, IDs.DEVICE, IDs.OS, IDs.BENCH, IDs.SIZE, IDs.THREADS, IDs.ITERATION, 'suffix',
+                   'directory')
+
+CATALOG_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS catalog (
+    path TEXT PRIMARY KEY,
+    directory TEXT NOT NULL,
+    suffix TEXT NOT NULL,
+    type TEXT NOT NULL,
+    device TEXT NOT NULL,
+    os TEXT NOT NULL,
+    benchmark TEXT NOT NULL,
+    size TEXT NOT NULL,
+    threads TEXT NOT NULL,
+    iteration TEXT,
+    bytes INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS catalog_run ON catalog (device, os, benchmark, size, threads);
+CREATE INDEX IF NOT EXISTS catalog_directory ON catalog (directory);
+'''
+
+
+def list_files(directory=os.curdir):
+    """
+    :return: dict of the names of the regular files in 'directory' to their os.stat_result,
+    one os.scandir call
+    """
+    with os.scandir(directory) as entries:
+        return {entry.name: entry.stat() for entry in entries if entry.is_file()}
+
+
+def walk_files(root):
+    """
+    Yields the regular files under 'root' as os.DirEntry, directories are read with os.scandir,
+    hidden ones are skipped
+    """
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file():
+                    yield entry
+
+
+def parse_name(name):
+    """
+    :return: dict, the fields of a data file name (see 'common.csv_name_parsing') with 'suffix',
+    the format of the file even if it is compressed, None if 'name' is not a data file
+    """
+    if not strip_compression(name).endswith(SUFFIXES) or name.startswith(DERIVED_PREFIXES):
+        return None
+    try:
+        fields = csv_name_parsing(name)
+    except IndexError:
+        return None
+    fields['suffix'] = strip_compression(name).rsplit('.', 1)[1]
+    return fields
+
+
+def is_power_csv(name):
+    """
+    :return: bool, True if 'name' is a raw power csv, compressed or not, False for other
+    files, ie. the outputs of the scripts as 'processed_data.csv' or 'transformed-<file>'
+    """
+    fields = parse_name(name)
+    return fields is not None and fields['suffix'] == 'csv'
+
+
+class Catalog:
+    """
+    SQLite index of the data files of a tree of experiments: the fields of their names, size
+    and mtime. 'update' walks the tree and parses only the names of new or changed files,
+    'select' answers from the index, without listing directories.
+    """
+
+    def __init__(self, root, path=None):
+        """
+        :param root: string, directory of the tree
+        :param path: string, index file, 'CATALOG_FILE' in 'root' if None
+        """
+        self.root = root
+        self.connection = sqlite3.connect(path or os.path.join(root, CATALOG_FILE))
+        self.connection.executescript(CATALOG_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def update(self):
+        """
+        Indexes the data files under 'root', the files removed from the tree are removed
+        from the index
+        :return: tuple (added or changed, removed) number of files
+        """
+        saved = {path: (size, mtime_ns) for path, size, mtime_ns in
+                 self.connection.execute('SELECT path, bytes, mtime_ns FROM catalog')}
+        seen = set()
+        changed = []
+        for entry in walk_files(self.root):
+            path = os.path.relpath(entry.path, self.root)
+            if path in saved:
+                seen.add(path)
+                stat = entry.stat()
+                if saved[path] == (stat.st_size, stat.st_mtime_ns):
+                    continue
+            fields = parse_name(entry.name)
+            if fields is None:
+                continue
+            seen.add(path)
+            stat = entry.stat()
+            changed.append((
+                path, os.path.dirname(path), fields['suffix'], fields[IDs.TYPE], fields[IDs.DEVICE], fields[IDs.OS],
+                fields[IDs.BENCH], fields[IDs.SIZE], fields[IDs.THREADS], fields.get(IDs.ITERATION),
+                stat.st_size, stat.st_mtime_ns
+            ))
+        removed = [(path,) for path in saved.keys() - seen]
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO catalog VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                        changed)
+            self.connection.executemany('DELETE FROM catalog WHERE path = ?', removed)
+        return len(changed), len(removed)
+
+    def select(self, **filters):
+        """
+        :param filters: column=value or column=list of values, columns of 'CATALOG_FILTERS',
+        ie. select(device='hikey970', os='linux', benchmark='mg')
+        :return: list of dict with the columns of the files selected, sorted by path, their
+        'path' is relative to 'root'
+        """
+        where, values = [], []
+        for column, value in filters.items():
+            if column not in CATALOG_FILTERS:
+                raise ValueError(f'Unknown catalog column: {column}')
+            value = value if isinstance(value, (list, tuple, set)) else [value]
+            where.append(f'{column} IN ({", ".join("?" * len(value))})')
+            values.extend(value)
+        cursor = self.connection.execute(
+            'SELECT * FROM catalog' + (f' WHERE {" AND ".join(where)}' if where else '') + ' ORDER BY path', values
+        )
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor]
+
+
+def _option(column):
+    # '--directory' is the root of the tree
+    return 'subdirectory' if column == 'directory' else column
+
+
+def add_options(parser):
+    for column in CATALOG_FILTERS:
+        parser.add_option(f'--{_option(column)}', action='append', type='string', dest=_option(column),
+                          help=f'select the files with this {column}, can be repeated')
+    parser.add_option('--no-update', action='store_false', dest='update', default=True,
+                      help='select from the index without walking the tree')
+
+
+def main():
+    options = parse_args(logger, add_options)
+    logger.addHandler(log_to_file(os.path.join(options.directory, 'catalog.log')))
+
+    with Catalog(options.directory) as catalog:
+        if options.update:
+            start = time.perf_counter()
+            changed, removed = catalog.update()
+            logger.info(f'[{options.directory}][UPDATE][{changed} changed][{removed} removed]'
+                        f'[{time.perf_counter() - start:.3f} s]')
+        start = time.perf_counter()
+        filters = {
+            column: getattr(options, _option(column)) for column in CATALOG_FILTERS if getattr(options, _option(column))
+        }
+        files = catalog.select(**filters)
+        logger.info(f'[{options.directory}][SELECT][{len(files)} files][{time.perf_counter() - start:.3f} s]')
+    for file in files:
+        print(file['path'])
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,31 @@
+import bz2
 import csv
 import datetime
+import gzip
+import heapq
+import io
+import json
 import logging
+import lzma
 import multiprocessing
 import os
+import re
 import sys
+import tempfile
+from itertools import islice, zip_longest
 from optparse import OptionParser
 
+import numpy
 import psutil
-from flyingcircus.base import readline
+
+try:
+    import pandas as pd
+except ImportError:  # Optional, only needed by 'read_raw_columns'
+    pd = None
+try:
+    import zstandard
+except ImportError:  # Optional, only needed to read '.zst' files
+    zstandard = None
 
 from custom_exceptions import UnsupportedNumberOfCores
 
@@ -75,13 +93,68 @@ CORES = multiprocessing.cpu_count()
 # <threads> is the number of threads (core) used to run the <bench>
 #   has a length of 1 char and usually is multiple of 2, examples: '1', '2', '4'...
 # <iteration> is used for energy data files (csv's) and denotes the number of iteration that was running
-# <suffix> is the format of the file, usually '.log' and '.csv'
+# <suffix> is the format of the file, usually '.log' and '.csv', '.pta' for archived csv files,
+#   it can be followed by the suffix of a compression, see 'COMPRESSION_SUFFIXES'
+
+# Compressed inputs, read as streams by 'open_input'
+COMPRESSION_SUFFIXES = ('.gz', '.xz', '.bz2', '.zst')
+_OPENERS = {'.gz': gzip, '.xz': lzma, '.bz2': bz2}
+
+
+def compression_suffix(filename):
+    """
+    :return: string, the suffix of COMPRESSION_SUFFIXES of 'filename', '' if it is not compressed
+    """
+    return next((suffix for suffix in COMPRESSION_SUFFIXES if filename.endswith(suffix)), '')
+
+
+def strip_compression(filename):
+    """
+    :return: string, 'filename' without its compression suffix, 'x.csv.gz' becomes 'x.csv'
+    """
+    suffix = compression_suffix(filename)
+    return filename[:-len(suffix)] if suffix else filename
+
+
+def unique_inputs(filenames):
+    """
+    One name of each input whose file is there uncompressed and compressed (see
+    'COMPRESSION_SUFFIXES'), 'x.csv' and 'x.csv.gz' are the same input
+    :param filenames: iterable of string
+    :return: list of string, the uncompressed name if it is there, the first compressed one
+    in alphabetical order otherwise, sorted
+    """
+    inputs = {}
+    for filename in sorted(filenames):
+        # A name sorts before its compressed names, they only add a suffix
+        inputs.setdefault(strip_compression(filename), filename)
+    return sorted(inputs.values())
+
+
+def open_input(path, mode='rb'):
+    """
+    Opens the input file 'path' for reading, compressed files (see 'COMPRESSION_SUFFIXES')
+    are decompressed while they are read, nothing is written to disk. Compressed files can
+    not seek backwards cheaply, zstd ones can not at all.
+    :param mode: string, 'rb' or 'r'
+    :return: file object
+    """
+    suffix = compression_suffix(path)
+    if not suffix:
+        return open(path, mode)
+    mode = 'rt' if mode == 'r' else mode
+    if suffix == '.zst':
+        if zstandard is None:
+            raise ImportError(f'zstandard is needed to read {path}: pip install zstandard')
+        return zstandard.open(path, mode)
+    return _OPENERS[suffix].open(path, mode)
+
 
 def csv_name_parsing(filename):
     csv_row = {}
-    parts = filename.split('.')
+    parts = strip_compression(filename).split('.')
 
-    if parts[-1] == 'csv':
+    if parts[-1] in ('csv', 'pta'):  # 'pta' are archives of csv files, see trace_archive
         parts_csv = parts[-2].split('_')
         csv_row = {}
         try:
@@ -125,6 +198,137 @@ def read_timestamp(timestamp):
     return None
 
 
+def timestamp_format(timestamp):
+    """
+    Returns the first format from TS_FORMAT that is able to parse 'timestamp'
+    :param timestamp: string with a timestamp
+    :return: string with the format or None if no format matches
+    """
+    for item in TS_FORMAT:
+        try:
+            datetime.datetime.strptime(timestamp, item)
+            return item
+        except ValueError:
+            pass
+    return None
+
+
+class TimestampParser:
+    """
+    Parses timestamps written in any of the TS_FORMAT layouts, returns the same values as
+    'read_timestamp' without its strptime fallback loop. The layout is detected with the
+    first timestamp and cached, next timestamps are only checked against that layout and
+    sliced: the part up to the seconds is parsed once per second, microseconds on every call.
+    Timestamps that do not fit the cached layout go through 'read_timestamp' and the
+    layout is detected again. Use one instance per file.
+    """
+    EPOCH = datetime.datetime(1970, 1, 1)
+
+    # For each layout: a regex, the subset of what strptime accepts that we expect in
+    # files, which splits the timestamp in seconds and microseconds, and the strptime
+    # format for the seconds part. '%H:%M:%S.%f' and '%H:%M:%S' are mixed in the same
+    # file, ie. str(timedelta), hence the optional microseconds.
+    LAYOUTS = {
+        TS_LONG_FORMAT: (
+            re.compile(r'([0-9]{4}/[0-9]{2}/[0-9]{2}-[0-9]{2}:[0-9]{2}:[0-9]{2})\.([0-9]{1,6})'),
+            '%Y/%m/%d-%H:%M:%S'
+        ),
+        '%H:%M:%S.%f': (re.compile(r'([0-9]{1,2}:[0-9]{1,2}:[0-9]{1,2})(?:\.([0-9]{1,6}))?'), '%H:%M:%S'),
+        '%H:%M:%S': (re.compile(r'([0-9]{1,2}:[0-9]{1,2}:[0-9]{1,2})(?:\.([0-9]{1,6}))?'), '%H:%M:%S'),
+    }
+
+    def __init__(self):
+        self.format = None
+        self._regex = None
+        self._seconds_format = None
+        # Last parsed seconds part, as string, datetime and microseconds since EPOCH
+        self._seconds = None
+        self._seconds_ts = None
+        self._seconds_us = None
+
+    def detect(self, timestamp):
+        """
+        Detects and caches the layout of 'timestamp'
+        :param timestamp: string with a timestamp
+        :return: the detected format from TS_FORMAT or None
+        """
+        self.format = timestamp_format(timestamp)
+        self._regex, self._seconds_format = self.LAYOUTS.get(self.format, (None, None))
+        return self.format
+
+    def _microseconds(self, timestamp):
+        """
+        Matches 'timestamp' against the cached layout and updates the seconds part if needed
+        :return: int, microseconds part of 'timestamp' or None if it does not fit the layout
+        """
+        if self._regex is None:
+            self.detect(timestamp)
+            if self._regex is None:
+                return None
+        match = self._regex.fullmatch(timestamp)
+        if match is None:
+            return None
+        seconds, frac = match.groups()
+        if seconds != self._seconds:
+            try:
+                ts = datetime.datetime.strptime(seconds, self._seconds_format)
+            except ValueError:
+                return None
+            self._seconds, self._seconds_ts, self._seconds_us = seconds, ts, datetime_to_epoch_us(ts)
+        return int(frac.ljust(6, '0')) if frac else 0
+
+    def _fallback(self, timestamp):
+        ts = read_timestamp(timestamp)
+        if ts is not None:
+            self.detect(timestamp)
+        return ts
+
+    def parse(self, timestamp):
+        """
+        :param timestamp: string with a timestamp
+        :return: datetime or None if 'timestamp' is not valid
+        """
+        us = self._microseconds(timestamp)
+        if us is None:
+            return self._fallback(timestamp)
+        return self._seconds_ts.replace(microsecond=us)
+
+    def epoch_us(self, timestamp):
+        """
+        :param timestamp: string with a timestamp
+        :return: int, microseconds since 1970/01/01 (naive), or None if 'timestamp' is not valid
+        """
+        us = self._microseconds(timestamp)
+        if us is None:
+            ts = self._fallback(timestamp)
+            return None if ts is None else datetime_to_epoch_us(ts)
+        return self._seconds_us + us
+
+    def epoch_us_column(self, timestamps):
+        """
+        Batch version of 'epoch_us'
+        :param timestamps: iterable of strings
+        :return: a list of int (or None for not valid timestamps)
+        """
+        epoch_us = self.epoch_us
+        return [epoch_us(ts) for ts in timestamps]
+
+
+def datetime_to_epoch_us(ts):
+    """
+    :param ts: naive datetime
+    :return: int, microseconds since 1970/01/01
+    """
+    return (ts - TimestampParser.EPOCH) // datetime.timedelta(microseconds=1)
+
+
+def epoch_us_to_datetime(us):
+    """
+    Inverse of 'datetime_to_epoch_us'
+    """
+    return TimestampParser.EPOCH + datetime.timedelta(microseconds=us)
+
+
 def is_valid_last_row(rows):
     if rows[-2][CSV_OP] is None or \
             len(rows[-2][CSV_TIME]) != len(rows[-2][CSV_TIME]) or \
@@ -134,30 +338,209 @@ def is_valid_last_row(rows):
     return True
 
 
-def check_last_row(file, logger):
-    rows = []  # Save the last 2 rows here
+# Header of a raw power csv, the columns of RAW_ROW
+RAW_HEADER = f'{CSV_TIME},{CSV_POWER},{CSV_OP}'
+# Time field of a raw power csv, the layouts of TS_FORMAT: long, with date, or time of the day
+RAW_TIME = r'[0-9]{4}/[0-9]{1,2}/[0-9]{1,2}-[0-9]{1,2}:[0-9]{1,2}:[0-9]{1,2}\.[0-9]{1,6}|' \
+           r'[0-9]{1,2}:[0-9]{1,2}:[0-9]{1,2}(?:\.[0-9]{1,6})?'
+# A valid row of a raw power csv: Time,Power(mWatt),Operation
+RAW_ROW = re.compile(rf'({RAW_TIME}),(-?[0-9]+(?:\.[0-9]*)?),([A-Z]*)\r?')
+# Rows of a block with the long layout only, see 'read_raw_columns'
+RAW_LONG_ROW = r'[0-9]{4}/[0-9]{2}/[0-9]{2}-[0-9]{2}:[0-9]{2}:[0-9]{2}\.[0-9]{1,6},-?[0-9]+(?:\.[0-9]*)?,[A-Z]*\r?'
+RAW_LONG_ROWS = re.compile(rf'{RAW_LONG_ROW}(?:\n{RAW_LONG_ROW})*')
+# Power loss leaves runs of NUL bytes where the data was not flushed
+NUL_RUN = re.compile('\x00+')
 
-    # Only iterate 2 times to get the last 2 rows
-    for row in readline(file, reverse=True):
-        if len(rows) < 2:
-            rows.append(row)
-        else:
+
+class RawCsvStats:
+    """
+    Counters of 'read_raw_rows' for a file:
+    dropped: rows that are not valid (partial, torn or damaged), including a last row without '\\n'
+    repaired: valid rows recovered from lines that contained NUL bytes
+    """
+
+    def __init__(self):
+        self.dropped = 0
+        self.repaired = 0
+
+    def __bool__(self):
+        return bool(self.dropped or self.repaired)
+
+    def __str__(self):
+        return f'[DROPPED ROWS: {self.dropped}][REPAIRED ROWS: {self.repaired}]'
+
+
+def _raw_lines(file, stats, header=True, end=None, block_size=1024 * 1024):
+    """
+    Complete lines of a raw power csv read by blocks, see 'read_raw_rows'. Pieces of long NUL
+    runs without new lines are joined in a line that starts with NUL, so they are damaged.
+    :return: a generator of lists of strings, the lines of each block without their new line
+    """
+    remaining = None if end is None else end - file.tell()
+    tail = ''
+    while True:
+        block = file.read(block_size if remaining is None else min(block_size, remaining))
+        if not block:
             break
-    if len(rows) < 2:
-        logger.warning(f'[{file.name}][Possibly empty]')
-    else:
-        if len(rows[0]) != len(rows[1]):  # Is the last row valid?
-            file.seek(file.tell() - len(rows[0]))
-            file.truncate()
-    file.seek(0)  # Set the current position in file at beginning
+        if remaining is not None:
+            remaining -= len(block)
+        # latin-1 maps each byte to one char, never fails and valid rows are ascii
+        lines = (tail + block.decode('latin-1')).split('\n')
+        tail = lines.pop()
+        if header and lines:
+            header = False
+            if lines[0].rstrip('\r') != RAW_HEADER:
+                raise ValueError(f'Not a raw power csv, header {lines[0][:80]!r}, expected {RAW_HEADER!r}')
+            lines = lines[1:]
+        if len(tail) > block_size and '\x00' in tail:
+            # Long NUL runs without new lines, pieces before the last run are already complete,
+            # the NUL kept in 'tail' marks the next piece as recovered from a damaged line
+            *pieces, tail = NUL_RUN.split(tail)
+            lines.append('\x00' + '\x00'.join(pieces))
+            tail = '\x00' + tail
+        yield lines
+    if tail.strip('\x00'):
+        stats.dropped += 1
+
+
+def read_raw_rows(file, stats=None, header=True, end=None, block_size=1024 * 1024):
+    """
+    Reads the rows of a raw power csv opened in binary mode, the file is never modified.
+    NUL runs split a line, every piece is validated as a row of its own, see '_raw_pieces'.
+    Not valid rows and a last row not terminated by a new line (torn, the acquisition
+    was interrupted while writing it) are dropped and counted in 'stats'.
+    :param file: file object opened in binary mode
+    :param stats: RawCsvStats to update, optional
+    :param header: bool, True if reading at the beginning of the file, the header is checked
+    and skipped, ValueError is raised if it is not RAW_HEADER
+    :param end: int, stop reading at this byte, None to read until the end of file
+    :param block_size: int, bytes read at once
+    :return: a generator of tuples of strings (time, power, operation)
+    """
+    if stats is None:
+        stats = RawCsvStats()
+    parser = TimestampParser()
+    row = None  # Last valid row, see '_raw_pieces'
+    for lines in _raw_lines(file, stats, header, end, block_size):
+        for line in lines:
+            match = RAW_ROW.fullmatch(line)
+            if match is not None:
+                row = match.groups()
+                yield row
+            else:
+                for row in raw_line_rows(line, stats, parser, row):
+                    yield row
+
+
+def read_raw_columns(file, stats=None, block_size=1024 * 1024):
+    """
+    Column version of 'read_raw_rows', the same rows by blocks of complete lines. Blocks where
+    every line is a row with the long layout (the one written by the acquisition) are parsed at
+    once: the pandas C parser splits the columns and numpy converts the timestamps. Other
+    blocks, ie. with damaged lines, are read row by row as 'read_raw_rows' does.
+    :param file: file object opened in binary mode, at the beginning of the file
+    :param stats: RawCsvStats to update, optional
+    :param block_size: int, bytes read at once
+    :return: a generator of tuples for each block with rows: numpy arrays of the time column
+    (bytes), timestamps (int64 microseconds since epoch) and power (float64 milliwatt), and a
+    list of tuples (position in the block, operation) for the rows with an operation
+    """
+    if pd is None:
+        raise ImportError('pandas is needed to read columns: pip install pandas')
+    if stats is None:
+        stats = RawCsvStats()
+    parser = TimestampParser()
+    row = None  # Last valid row, see '_raw_pieces'
+    for lines in _raw_lines(file, stats, block_size=block_size):
+        if not any(lines):
+            continue
+        text = '\n'.join(lines)
+        columns = _long_columns(text) if RAW_LONG_ROWS.fullmatch(text) else None
+        if columns is None:
+            rows = []
+            for line in lines:
+                rows.extend(raw_line_rows(line, stats, parser, rows[-1] if rows else row))
+            if not rows:
+                continue
+            time_str, power, op = zip(*rows)
+            columns = (
+                numpy.array(time_str, dtype=bytes), numpy.array(parser.epoch_us_column(time_str), dtype=numpy.int64),
+                numpy.fromiter(map(float, power), dtype=numpy.float64, count=len(rows)),
+                [(position, o) for position, o in enumerate(op) if o != '']
+            )
+        row = (columns[0][-1].decode(),)
+        yield columns
+
+
+def _long_columns(text):
+    """
+    :param text: string, rows with the long layout, see 'RAW_LONG_ROWS'
+    :return: the columns of 'read_raw_columns', None if a timestamp is not a valid date
+    """
+    # Power is parsed as 'float' does, the default of the C parser may differ in the last digit
+    frame = pd.read_csv(io.StringIO(text), header=None, names=[CSV_TIME, CSV_POWER, CSV_OP],
+                        dtype={CSV_TIME: str, CSV_POWER: numpy.float64, CSV_OP: str}, keep_default_na=False,
+                        na_filter=False, float_precision='round_trip')
+    time_str = frame[CSV_TIME].to_numpy().astype(bytes)
+    # 'YYYY/MM/DD-HH:MM:SS.ffffff' to ISO 8601, numpy rejects the dates and times strptime rejects
+    iso = time_str.view(numpy.uint8).reshape(len(time_str), -1).copy()
+    iso[:, [4, 7]], iso[:, 10] = ord('-'), ord('T')
+    try:
+        ts = iso.view(time_str.dtype).ravel().astype('datetime64[us]').astype(numpy.int64)
+    except ValueError:
+        return None
+    op = frame[CSV_OP].to_numpy()
+    positions = numpy.flatnonzero(op != '')
+    return time_str, ts, frame[CSV_POWER].to_numpy(), list(zip(positions.tolist(), op[positions]))
+
+
+def raw_line_rows(line, stats, parser, row=None):
+    """
+    Valid rows of one line of a raw power csv, the same ones 'read_raw_rows' reads, for the
+    readers that need the position of each line, ie. trace_index
+    :param line: string, the line decoded as latin-1, without its new line
+    :param stats: RawCsvStats to update
+    :param parser: TimestampParser used to validate the rows of damaged lines, one per file
+    :param row: tuple, the last valid row before 'line', see '_raw_pieces'
+    :return: list of tuples (time, power, operation)
+    """
+    match = RAW_ROW.fullmatch(line)
+    if match is not None:
+        return [match.groups()]
+    if '\x00' in line:
+        return list(_raw_pieces(NUL_RUN.split(line), stats, parser, row))
+    if line:
+        stats.dropped += 1
+    return []
+
+
+def _raw_pieces(pieces, stats, parser, row=None):
+    """
+    Rows recovered from the pieces of a line split by NUL runs. A piece can be the end of a
+    torn row that looks like a row, ie. '23,1234,XS' or '9:47:35.923,1234,XS' from
+    '2019/04/04-09:47:35.923,1234,XS', so it is only a row if its timestamp is valid and has
+    the layout of the rows before, with or without date
+    :param parser: TimestampParser used to validate the timestamps
+    :param row: tuple, the last valid row before the pieces, None if there is none
+    """
+    for piece in pieces:
+        match = RAW_ROW.fullmatch(piece)
+        if match is not None and parser.epoch_us(match.group(1)) is not None and \
+                (row is None or ('/' in match.group(1)) == ('/' in row[0])):
+            stats.repaired += 1
+            yield match.groups()
+        elif piece:
+            stats.dropped += 1
 
 
 def first_timestamp(file):
-    # TODO a line can contain NULL byte, this script does not control this use case
-    file.readline()
-    ts_first = read_timestamp(file.readline().split(',')[0])
+    """
+    :param file: file object opened in binary mode, position is set at the beginning
+    :return: timestamp of the first valid row
+    """
+    row = next(read_raw_rows(file), None)
     file.seek(0)  # Set the current position in file at beginning
-    return ts_first
+    return None if row is None else read_timestamp(row[0])
 
 
 def set_cores(req_cores):
@@ -211,17 +594,30 @@ def profile(m, filename, function, *args):
     return ret
 
 
+def iter_column(column, chunk_size=65536):
+    """
+    Iterates over 'column' yielding python objects, numpy arrays are converted by chunks
+    :param column: list, numpy array or any iterable
+    """
+    if hasattr(column, 'tolist'):
+        for i in range(0, len(column), chunk_size):
+            yield from column[i:i + chunk_size].tolist()
+    else:
+        yield from column
+
+
 def write_csv_dict_with_lists(filename, csv_data):
+    """
+    Writes a dict with columns as values, the csv header are the keys
+    :param filename: string
+    :param csv_data: a dict (or any mapping, ie. PowerTrace) of lists, numpy arrays or iterables,
+    shorter columns are written with empty values, ie. 'time_xs' before XS
+    """
     with open(filename, 'w') as f:
         header = list(csv_data.keys())
-        writer = csv.DictWriter(f, header)
-        writer.writeheader()
-        # upper range defined by any list from the csv_data, since they all are equal
-        for i in range(0, len(csv_data[header[0]])):
-            data_dict = {}
-            for key in header:
-                data_dict[key] = csv_data[key][i]
-            writer.writerow(data_dict)
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(zip_longest(*[iter_column(csv_data[key]) for key in header], fillvalue=''))
 
 
 def write_csv_list_of_dict(filename, csv_data, logger, overwrite=False):
@@ -242,12 +638,36 @@ def write_csv_list_of_dict(filename, csv_data, logger, overwrite=False):
         logger.warning('[NO PROCESSED DATA]')
 
 
-def parse_args(logger):
+def options_parser(add_options=None):
     # Parsear linea de comandos
     parser = OptionParser('usage: python %prog [OPTIONS]')
     parser.add_option('-d', '--directory', action='store', type='string', dest='directory')
     parser.add_option('-c', '--cores', action='store', type='int', dest='cores')
     parser.add_option('-s', '--starts-with', action='store', type='string', dest='starts_with')
+    # Script specific options, 'add_options' receives the parser and adds them
+    if add_options is not None:
+        add_options(parser)
+    return parser
+
+
+def default_options(add_options=None, **values):
+    """
+    Options of a script when it is used as a library, without a command line
+    :param add_options: the same function given to 'parse_args'
+    :param values: options that are not the default, ie. cores=2
+    :return: optparse.Values, as returned by 'parse_args'
+    """
+    options = options_parser(add_options).get_default_values()
+    for name, value in values.items():
+        if not hasattr(options, name):
+            raise AttributeError(f'Unknown option: {name}')
+        setattr(options, name, value)
+    options.cores = set_cores(options.cores)
+    return options
+
+
+def parse_args(logger, add_options=None):
+    parser = options_parser(add_options)
     (options, args) = parser.parse_args()
     if not options.directory:
         # This logger line will not be saved to file
@@ -258,5 +678,61 @@ def parse_args(logger):
     return options
 
 
+def sort_key(s: dict):
+    return s['type'], s['device'], s['os'], s['benchmark'], s['size'], s['threads'], s['iteration']
+
+
 def sort_list_of_dict(l: list):
-    l.sort(key=lambda s: (s['type'], s['device'], s['os'], s['benchmark'], s['size'], s['threads'], s['iteration']))
+    l.sort(key=sort_key)
+
+
+def write_csv_sorted(filename, rows, logger, run_size=100000):
+    """
+    Same as 'write_csv_list_of_dict' but 'rows' are sorted with 'sort_key' first, in bounded
+    memory: sorted runs of 'run_size' rows are spilled to temporary files and merged.
+    Rows may have different keys (ie. with and without '--phases'), the header is the union of
+    them: the columns of the existing csv first, then the new ones in the order they are first
+    seen. Missing values are written empty, an existing csv with fewer columns is rewritten.
+    :param rows: iterable of dict
+    :return: int, number of rows written
+    """
+    runs = []
+    try:
+        rows = iter(rows)
+        keys = {}
+        for run in iter(lambda: list(islice(rows, run_size)), []):
+            run.sort(key=sort_key)
+            spill = tempfile.TemporaryFile('w+')
+            runs.append(spill)
+            for row in run:
+                keys.update(dict.fromkeys(row))
+                spill.write(f'{json.dumps(row)}\n')
+            spill.seek(0)
+        if not runs:
+            logger.warning('[NO PROCESSED DATA]')
+            return 0
+        merged = heapq.merge(*[map(json.loads, run) for run in runs], key=sort_key)
+        header = []
+        if os.access(filename, os.F_OK):
+            with open(filename, 'r') as f:
+                header = next(csv.reader(f), [])
+        columns = header + [key for key in keys if key not in header]
+        if header and columns != header:
+            # New columns, the rows of the csv are copied with them empty
+            with open(filename, 'r') as f, open(f'{filename}.tmp', 'w') as tmp:
+                writer = csv.DictWriter(tmp, columns, restval='')
+                writer.writeheader()
+                writer.writerows(csv.DictReader(f))
+            os.replace(f'{filename}.tmp', filename)
+        with open(filename, 'a' if header else 'w') as f:
+            writer = csv.DictWriter(f, columns, restval='')
+            if not header:
+                writer.writeheader()
+            n = 0
+            for row in merged:
+                writer.writerow(row)
+                n += 1
+        return n
+    finally:
+        for run in runs:
+            run.close()
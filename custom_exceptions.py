@@ -3,3 +3,10 @@ class UnsupportedNumberOfCores(Exception):
     Raised when the number of cores is higher then available cores or equal/less then 0
     """
     pass
+
+
+class TaskTimeout(Exception):
+    """
+    Raised in a pool worker when processing a file takes longer than the task timeout
+    """
+    pass
@@ -1,14 +1,44 @@
-import csv
-import datetime
+import contextlib
 import logging
 import os
-from multiprocessing import Manager
-from multiprocessing.pool import Pool
+import time
+from itertools import zip_longest, chain
 
-from common import read_timestamp, CSV_TIME, CSV_POWER, CSV_OP, check_last_row, \
-    first_timestamp, csv_name_parsing, log_to_file, profile, write_csv_dict_with_lists, \
-    write_csv_list_of_dict, parse_args, sort_list_of_dict
+import numpy
+
+from catalog import list_files, parse_name
+from common import first_timestamp, read_raw_rows, read_raw_columns, RawCsvStats, csv_name_parsing, log_to_file, \
+    write_csv_dict_with_lists, parse_args, TimestampParser, datetime_to_epoch_us, epoch_us_to_datetime, \
+    default_options, read_timestamp, open_input, compression_suffix, strip_compression, unique_inputs
 from plotters import power_plot
+from power_trace import PowerTrace, PowerTraceBuilder, plot_columns
+import profiling
+from planner import add_plan_options, plan
+from profiling import stage, ProfileReport
+from progress import Progress
+from scheduler import CostModel, run_scheduled, task_mode, observe, observe_key, add_pool_options, limited_pool, \
+    log_quarantined, RangeTasks
+from manifest import Manifest, file_key
+from trace_archive import TraceArchive, is_archive, archive_name, ARCHIVE_SUFFIX
+from trace_index import load_index
+
+# Engines available to process a csv file, see 'csv_process' and 'csv_process_vectorized'
+ENGINE_PYTHON = 'python'
+ENGINE_NUMPY = 'numpy'
+ENGINES = [ENGINE_PYTHON, ENGINE_NUMPY]
+
+# Output of the processed data rows, one per file
+PROCESSED_DATA = 'processed_data.csv'
+
+# Columns saved in 'transformed-<file>'
+TRANSFORMED_COLUMNS = ['time_str', 'mw', 'op', 'time_xs', 'time_00', 'us']
+
+# Phases delimited by start and finish marks, see 'Operation' in thread_flask_pminfo, their energy,
+# time and mean power are saved as '<phase>_joules', '<phase>_time' and '<phase>_watts'.
+# XS and XF delimit the main phase, saved as 'joules', 'time' and 'watts'
+PHASES = {'a': ('AS', 'AF'), 'b': ('BS', 'BF')}
+
+logger = logging.getLogger('TRANSFORM_CSV')
 
 
 def csv_shortcuts(data):
@@ -22,26 +52,23 @@ def csv_shortcuts(data):
     return data_time, data_mw, data_op, data_time_xs, data_time_00, data_us
 
 
-# TODO a line can contain NULL byte, this script does not control this use case
 def pre_compute_checks(file):
     """
     Checks in file:
     1. return the first timestamp that appears in file
-    2. checks if last row is valid (complete data), if no deletes it
+    2. not valid rows (NUL bytes, partial last row) are skipped, the file is not modified
     3. searches and returns timestamp of XS and XF marks
-    :param file: csv file with raw data
+    :param file: csv file with raw data, opened in binary mode
     :return: xs, xf and first timestamps
     """
     ts_first = first_timestamp(file)
-    check_last_row(file)
     ts_xs, ts_xf = None, None
-    reader = csv.DictReader(file)
-    for row in reader:
-        op = row.get(CSV_OP)
+    parser = TimestampParser()
+    for time_str, power, op in read_raw_rows(file):
         if op == 'XS':
-            ts_xs = read_timestamp(row.get(CSV_TIME))
+            ts_xs = parser.parse(time_str)
         if op == 'XF':
-            ts_xf = read_timestamp(row.get(CSV_TIME))
+            ts_xf = parser.parse(time_str)
 
     return ts_xs, ts_xf, ts_first
 
@@ -66,146 +93,853 @@ def backwards_xs_time_compute(data_time, ts_xs):
     return time_xs
 
 
-def csv_process(data: dict, file: str, ts_first, ts_xs, ts_xf):
+def csv_process(rows, ts_first, ts_xs, ts_xf):
     """
-    Opens 'file' in csv form, applies a series of transformations for each csv row
-    :param data: a dict,
-    :param file: string, file name
+    Applies a series of transformations for each csv row, the rows are kept in a compact
+    PowerTrace (see 'PowerTraceBuilder') that derives the other columns on demand
+    :param rows: iterable of tuples (time, power, operation), see 'common.read_raw_rows'
     :param ts_first: timestamp, from first row of 'file'
     :param ts_xs: timestamp, when XS marks appeared in 'file
     :param ts_xf: timestamp, when XF marks appeared in 'file
-    :return: timestamp x2: XS and XF if found, floats 2x: computed energy (joules) and time (seconds)
+    :return: PowerTrace (None if there are no rows), timestamp x2: XS and XF if found, floats 2x: computed
+    energy (joules) and time (seconds)
     """
-    reader = csv.DictReader(file)
     energy = 0
     time_us = 0
-    td_dt_ref = datetime.datetime.min
-    # TODO a line can contain NULL byte, this script does not control this use case
-    for row in reader:
-        time_str = row.get(CSV_TIME)
-        power_current = row.get(CSV_POWER)
-        op = row.get(CSV_OP)
-        us = ''  # microseconds
-        ts_current = read_timestamp(time_str)
+    parser = TimestampParser()
+    trace = PowerTraceBuilder()
+    # Rows where energy is computed, 'us' is not empty for them
+    window_start, window_stop = None, 0
+    ts_prev, power_prev = None, None
+    for time_str, power, op in rows:
+        ts_current, power_current = parser.epoch_us(time_str), float(power)
         # Order of these conditions is important
         if ts_xs and not ts_xf:
             # When inside this condition we are at Tn and Xn with n = 1 to XF mark
             # XS is n = 0, Xn defines power in milliwatt, Tn defines time
             # energy of this zone is equal to (Xn + X(n-1))/2 * (Tn-T(n-1))
-            # X(n-1) is "data['mw'][-1]", Xn is "power_current"
-            # T(n-1) is "data['time'][-1]", Tn is "ts_current"
-            us = (ts_current - data['time'][-1]).microseconds
-            energy += calculate_energy(power_current, data['mw'][-1], us)
+            # X(n-1) is "power_prev", Xn is "power_current"
+            # T(n-1) is "ts_prev", Tn is "ts_current", us is the microseconds component of Tn-T(n-1)
+            us = (ts_current - ts_prev) % 1000000
+            energy += calculate_energy(power_current, power_prev, us)
             time_us += us
-        if op != '':
-            if op == 'XS':
-                ts_xs = ts_current
-                data['time_xs'] = backwards_xs_time_compute(data['time'], ts_xs)
-            if op == 'XF':
-                ts_xf = ts_current
-
-            # Here we save the position in data dict, since all lists in data have
-            # the same length, the position will always show data from the same row
-            # position = reader.line_num - 2, because reader.line_num tells us the
-            # position in the csv file, it starts with 1 (not 0) and the line nº 1
-            # is the header, the first line with data is nº 2, but in our dict with lists
-            # is 0, hence the '- 2'
-            # op is the operation, we have it in our data dict already, but is big and
-            # mostly empty, and this will only have the values to be marked in the plot
-            data['pos_and_marks'].append((reader.line_num - 2, op))
-        if ts_xs:
-            data['time_xs'].append(
-                (ts_current - ts_xs).total_seconds()
-            )
-
-        data['time_str'].append(time_str)
-        data['time'].append(ts_current)
-        data['mw'].append(float(power_current))
-        data['op'].append(op)
-        data['time_00'].append(ts_current - ts_first)
-        data['td_dt_00'].append(td_dt_ref + data['time_00'][-1])
-        data['us'].append(us)
-
-    return ts_xs, ts_xf, energy / 1000000000, time_us / 1000000
-
-
-def data_file_process(cwd, file):
-    logger.info(f'[{cwd}][{file}]')
-    data = {
-        'time_str': [], 'time': [], 'mw': [], 'op': [], 'time_xs': [],
-        'time_00': [], 'us': [], 'td_dt_00': [], 'pos_and_marks': []
+            if window_start is None:
+                window_start = trace.rows
+            window_stop = trace.rows + 1
+        if op == 'XS':
+            ts_xs = epoch_us_to_datetime(ts_current)
+        if op == 'XF':
+            ts_xf = epoch_us_to_datetime(ts_current)
+        # Marks are saved with their position in the trace, not valid rows are not in 'rows'
+        # so the position in the csv file is not used
+        trace.append(time_str, ts_current, power_current, op)
+        ts_prev, power_prev = ts_current, power_current
+
+    window = (window_start, window_stop) if window_start is not None else (0, 0)
+    trace = trace.build(datetime_to_epoch_us(ts_first) if ts_first else None,
+                        datetime_to_epoch_us(ts_xs) if ts_xs else None, window)
+    return trace, ts_xs, ts_xf, energy / 1000000000, time_us / 1000000
+
+
+def csv_process_vectorized(blocks, ts_xs, ts_xf, integrator=None):
+    """
+    Same transformations as 'csv_process' but the rows are read in columns by blocks into the
+    arrays of a compact PowerTrace and energy is computed with array operations. Results are
+    identical to 'csv_process', including the microseconds component only for 'us' and the
+    sequential order of the energy sum.
+    :param blocks: iterable of the column blocks of a file, see 'common.read_raw_columns'
+    :param ts_xs: timestamp, when XS marks appeared in 'file
+    :param ts_xf: timestamp, when XF marks appeared in 'file
+    :param integrator: EnergyIntegrator or PhaseIntegrator fed with every block, optional
+    :return: PowerTrace (None if there are no rows), timestamp x2: XS and XF if found, floats 2x: computed
+    energy (joules) and time (seconds)
+    """
+    time_str, ts, mw, marks = [], [], [], []
+    n = 0
+    with stage('parse'):
+        for block_time, block_ts, block_mw, block_marks in blocks:
+            if integrator is not None:
+                integrator.feed_columns(block_ts, block_mw, block_marks)
+            time_str.append(block_time)
+            ts.append(block_ts)
+            mw.append(block_mw)
+            marks.extend((n + position, op) for position, op in block_marks)
+            n += len(block_ts)
+        if n == 0:
+            return None, ts_xs, ts_xf, 0 / 1000000000, 0 / 1000000
+        time_str, ts, mw = numpy.concatenate(time_str), numpy.concatenate(ts), numpy.concatenate(mw)
+    ts_first = read_timestamp(time_str[0].decode())
+
+    xs_pos = [p for p, o in marks if o == 'XS']
+    xf_pos = [p for p, o in marks if o == 'XF']
+    # Energy is computed for rows after XS (not included) until XF (included), see 'csv_process'
+    start = 1 if ts_xs else (xs_pos[0] + 1 if xs_pos else n)
+    stop = max(start, 0 if ts_xf else (xf_pos[0] + 1 if xf_pos else n))
+    with stage('integrate'):
+        energy, time_us = trace_energy(ts[start - 1:stop], mw[start - 1:stop])
+
+    if xs_pos:
+        ts_xs = epoch_us_to_datetime(int(ts[xs_pos[-1]]))
+    if xf_pos:
+        ts_xf = epoch_us_to_datetime(int(ts[xf_pos[-1]]))
+    trace = PowerTrace(
+        time_str, ts, mw, marks, datetime_to_epoch_us(ts_first),
+        ts_xs=datetime_to_epoch_us(ts_xs) if ts_xs else None, window=(start, stop)
+    )
+    return trace, ts_xs, ts_xf, energy / 1000000000, time_us / 1000000
+
+
+def trace_energy(ts, mw):
+    """
+    Energy and time between the first and the last sample of a trace, with the same
+    rules and results as 'csv_process'
+    :param ts: numpy int array, timestamps in microseconds since epoch
+    :param mw: numpy float array, power in milliwatt
+    :return: float, int: energy (milliwatt * microseconds) and time (microseconds)
+    """
+    mw = numpy.asarray(mw, dtype=numpy.float64)
+    # 'csv_process' uses timedelta.microseconds, the microseconds component, not the total
+    us = numpy.diff(ts) % 1000000
+    # cumsum accumulates sequentially, as the loop in 'csv_process' does, sum() would not
+    terms = (mw[1:] + mw[:-1]) / 2 * us
+    energy = float(numpy.cumsum(terms)[-1]) if len(terms) else 0
+    return energy, int(us.sum())
+
+
+class EnergyIntegrator:
+    """
+    Computes energy and time between the 'start' and 'finish' marks one sample at a time,
+    only the previous sample and the running integrals are kept. Follows the same rules
+    as 'csv_process': samples after the first 'start' mark until the first 'finish'
+    mark (included) are integrated, 'us' is the microseconds component of Tn-T(n-1).
+    """
+
+    def __init__(self, start='XS', finish='XF'):
+        self.start = start
+        self.finish = finish
+        self.ts_start = None  # microseconds since epoch of the last 'start' mark
+        self.ts_finish = None  # microseconds since epoch of the last 'finish' mark
+        self.energy = 0
+        self.time_us = 0
+        self.samples = 0
+        self._inside = False
+        self._finished = False
+        self._ts_prev = None
+        self._power_prev = None
+
+    def feed(self, ts_us, power, op):
+        """
+        :param ts_us: int, timestamp of the sample in microseconds since epoch
+        :param power: float, power in milliwatt
+        :param op: string, the operation mark of the sample, '' if none
+        """
+        if self._inside:
+            us = (ts_us - self._ts_prev) % 1000000
+            self.energy += calculate_energy(power, self._power_prev, us)
+            self.time_us += us
+        self._mark(op, ts_us)
+        self._ts_prev = ts_us
+        self._power_prev = power
+        self.samples += 1
+
+    def feed_columns(self, ts, mw, marks):
+        """
+        Batch version of 'feed' for a block of samples, energy is computed with array
+        operations between the marks and summed in the same order, so results are identical
+        :param ts: numpy int64 array, timestamps in microseconds since epoch
+        :param mw: numpy float array, power in milliwatt
+        :param marks: list of tuples (position in the block, operation), see 'common.read_raw_columns'
+        """
+        if not len(ts):
+            return
+        offset = 0
+        if self._ts_prev is not None:
+            # The first sample of the block needs the last sample of the previous block
+            ts = numpy.concatenate(([self._ts_prev], ts))
+            mw = numpy.concatenate(([self._power_prev], mw))
+            offset = 1
+        start = 0
+        for position, op in [*((position + offset, op) for position, op in marks), (len(ts) - 1, None)]:
+            if self._inside and position > start:
+                us = numpy.diff(ts[start:position + 1]) % 1000000
+                terms = (mw[start + 1:position + 1] + mw[start:position]) / 2 * us
+                # cumsum from the running energy adds as 'feed' does, one term at a time
+                self.energy = float(numpy.cumsum(numpy.concatenate(([self.energy], terms)))[-1])
+                self.time_us += int(us.sum())
+            if op is not None:
+                self._mark(op, int(ts[position]))
+            start = position
+        self._ts_prev, self._power_prev = int(ts[-1]), float(mw[-1])
+        self.samples += len(ts) - offset
+
+    def feed_range(self, partial):
+        """
+        Adds the partial result of a byte range of a file, see 'csv_range_process'.
+        Ranges must be fed in file order.
+        :param partial: dict returned by 'csv_range_process'
+        """
+        if partial['first'] is None:
+            return
+        # The first sample of the range needs the last sample of the previous range
+        self.feed(*partial['first'], '')
+        self.samples -= 1
+        for (energy, time_us), mark in zip_longest(partial['segments'], partial['marks']):
+            if self._inside:
+                self.energy += energy
+                self.time_us += time_us
+            if mark is not None:
+                self._mark(*mark)
+        self._ts_prev, self._power_prev = partial['last']
+        self.samples += partial['samples']
+
+    def _mark(self, op, ts_us):
+        if op == self.start:
+            self.ts_start = ts_us
+            self._inside = not self._finished
+        elif op == self.finish:
+            self.ts_finish = ts_us
+            self._inside = False
+            self._finished = True
+
+    def complete(self):
+        return self.ts_start is not None and self.ts_finish is not None
+
+    def joules(self):
+        return self.energy / 1000000000
+
+    def seconds(self):
+        return self.time_us / 1000000
+
+
+class PhaseIntegrator:
+    """
+    EnergyIntegrator for XS and XF with one more for each phase in PHASES, every sample
+    is fed to all of them so the phases are computed in the same pass. Works as the
+    EnergyIntegrator of XS and XF, ie. in 'energy_row' or 'CsvFollower'.
+    """
+
+    def __init__(self):
+        self.main = EnergyIntegrator()
+        self.phases = {phase: EnergyIntegrator(start, finish) for phase, (start, finish) in PHASES.items()}
+        self._all = [self.main, *self.phases.values()]
+
+    def __getattr__(self, name):
+        return getattr(self.main, name)
+
+    def feed(self, ts_us, power, op):
+        for integrator in self._all:
+            integrator.feed(ts_us, power, op)
+
+    def feed_columns(self, ts, mw, marks):
+        for integrator in self._all:
+            integrator.feed_columns(ts, mw, marks)
+
+    def feed_range(self, partial):
+        for integrator in self._all:
+            integrator.feed_range(partial)
+
+    def columns(self):
+        """
+        :return: dict, columns added to the processed data row, see 'phase_columns'
+        """
+        return phase_columns(
+            {phase: (i.joules(), i.seconds()) for phase, i in self.phases.items() if i.complete()},
+            (self.main.joules(), self.main.seconds()) if self.main.complete() else None
+        )
+
+
+def mean_power(joules, seconds):
+    return joules / seconds if seconds else ''
+
+
+def phase_columns(phases, main):
+    """
+    :param phases: dict of phase to tuple (joules, seconds), only for phases found
+    :param main: tuple (joules, seconds) of XS and XF, None if not found
+    :return: dict, the phase columns ('' for phases not found) and 'watts'
+    """
+    columns = {}
+    for phase in PHASES:
+        joules, seconds = phases.get(phase, ('', ''))
+        columns.update({
+            f'{phase}_joules': joules, f'{phase}_time': seconds,
+            f'{phase}_watts': '' if joules == '' else mean_power(joules, seconds)
+        })
+    columns['watts'] = '' if main is None else mean_power(*main)
+    return columns
+
+
+def feed_rows(rows, integrator):
+    """
+    Feeds 'integrator' with every row of 'rows' as they are read by another consumer
+    :return: a generator of the same rows
+    """
+    parser = TimestampParser()
+    for row in rows:
+        integrator.feed(parser.epoch_us(row[0]), float(row[1]), row[2])
+        yield row
+
+
+def csv_process_stream(rows, integrator=None):
+    """
+    Single streaming pass over 'rows' feeding every row to 'integrator', memory usage
+    does not depend on the length of the file
+    :param rows: iterable of tuples (time, power, operation), see 'common.read_raw_rows'
+    :param integrator: EnergyIntegrator, a new one for XS and XF marks if None
+    :return: the EnergyIntegrator
+    """
+    if integrator is None:
+        integrator = EnergyIntegrator()
+    parser = TimestampParser()
+    for time_str, power, op in rows:
+        integrator.feed(parser.epoch_us(time_str), float(power), op)
+    return integrator
+
+
+class CsvFollower:
+    """
+    Incremental reader of a raw power csv that is still being written, each 'poll' feeds
+    the rows appended since the previous one to 'integrator'. Only lines terminated by a
+    new line are read, a partially written last line is read by the next 'poll' once it
+    is complete. The file is never modified.
+    """
+
+    def __init__(self, file, integrator=None, block_size=64 * 1024):
+        self.file = file
+        self.integrator = EnergyIntegrator() if integrator is None else integrator
+        self.stats = RawCsvStats()
+        self.offset = 0  # Start of the first line not read yet
+        self.block_size = block_size
+        self._parser = TimestampParser()
+
+    def _complete_end(self, f, size):
+        """
+        :return: int, end of the last complete line of 'f' before 'size', 'offset' if none
+        """
+        position = size
+        while position > self.offset:
+            start = max(self.offset, position - self.block_size)
+            f.seek(start)
+            new_line = f.read(position - start).rfind(b'\n')
+            if new_line >= 0:
+                return start + new_line + 1
+            position = start
+        return self.offset
+
+    def poll(self):
+        """
+        :return: int, number of rows read
+        """
+        samples = self.integrator.samples
+        with open(self.file, 'rb') as f:
+            end = self._complete_end(f, os.fstat(f.fileno()).st_size)
+            if end > self.offset:
+                f.seek(self.offset)
+                for time_str, power, op in read_raw_rows(f, self.stats, header=self.offset == 0, end=end):
+                    self.integrator.feed(self._parser.epoch_us(time_str), float(power), op)
+                self.offset = end
+        return self.integrator.samples - samples
+
+
+def data_file_follow(cwd, file, interval=1.0, timeout=60.0, phases=False):
+    """
+    Energy only processing of a file that is still being written, the file is polled every
+    'interval' seconds and the running energy and time are logged when new rows arrive.
+    :param timeout: float, seconds without new rows before giving up
+    :return: the processed data row once XS and XF are found, None if 'timeout' expires
+    before, the file is not recorded as processed then, a later run will process it again
+    """
+    if is_archive(file):
+        # Archives are made from complete files
+        return data_archive_process(cwd, file, plot=False, phases=phases)
+    if compression_suffix(file):
+        # So are compressed files
+        return data_file_energy(cwd, file, phases=phases)
+    logger.info(f'[{cwd}][{file}][FOLLOW]')
+    follower = CsvFollower(os.path.join(cwd, file), PhaseIntegrator() if phases else None)
+    integrator = follower.integrator
+    last_row = time.monotonic()
+    while not integrator.complete():
+        with stage('parse_integrate'):
+            new_rows = follower.poll()
+        if new_rows:
+            last_row = time.monotonic()
+            logger.info(f'[{cwd}][{file}][FOLLOW][{integrator.samples} rows]'
+                        f'[{integrator.joules():.6f} J][{integrator.seconds():.4f} s]')
+        elif time.monotonic() - last_row > timeout:
+            log_raw_stats(cwd, file, follower.stats)
+            logger.warning(f'[{cwd}][{file}][FOLLOW][No new rows in {timeout} s, XF not found]')
+            return None
+        else:
+            time.sleep(interval)
+    log_raw_stats(cwd, file, follower.stats)
+    # The file grew while it was followed, it is recorded as it is now
+    observe_key(file_key(os.path.join(cwd, file), hashed=False))
+    return energy_row(cwd, file, integrator)
+
+
+class DirectoryFollower:
+    """
+    Files of a directory followed with '--follow' that appear during the run, see
+    'scheduler.run_scheduled'. The directory is scanned on each call, it is followed until no
+    file is being followed and no new file appeared in 'timeout' seconds.
+    """
+
+    def __init__(self, directory, starts_with, manifest, task, timeout, seen, progress=None):
+        """
+        :param starts_with: string, only files that start with it, see 'get_files'
+        :param manifest: Manifest, files already processed are not new
+        :param task: tuple (function, *args), the task of each new file
+        :param timeout: float, seconds without new files before the directory is left
+        :param seen: iterable of the files of the run, they are not new
+        :param progress: progress.Progress, new files are added to its totals, optional
+        """
+        self.directory = directory
+        self.starts_with = starts_with
+        self.manifest = manifest
+        self.task = task
+        self.timeout = timeout
+        self.seen = set(seen)
+        self.progress = progress
+        self.last_file = time.monotonic()
+
+    def __call__(self, pending):
+        """
+        :param pending: int, tasks not completed yet
+        :return: list of tasks of the new files, None once the directory is left
+        """
+        new = [file for file in get_files(self.starts_with, self.manifest, self.directory) if file not in self.seen]
+        if new or pending:
+            self.last_file = time.monotonic()
+        elif time.monotonic() - self.last_file > self.timeout:
+            return None
+        self.seen.update(new)
+        function, *args = self.task
+        for file in new:
+            logger.info(f'[{self.directory}][{file}][FOLLOW][New file]')
+            if self.progress is not None:
+                self.progress.files += 1
+                self.progress.size += os.path.getsize(os.path.join(self.directory, file))
+        return [(function, self.directory, file, *args) for file in new]
+
+
+def split_ranges(file, parts):
+    """
+    Splits 'file' in 'parts' byte ranges aligned to the start of a line, the header
+    is not included in any range
+    :param file: string, path of the file
+    :param parts: int, number of ranges, less are returned for small files
+    :return: a list of tuples (start, end)
+    """
+    size = os.path.getsize(file)
+    with open(file, 'rb') as f:
+        bounds = [len(f.readline())]
+        for i in range(1, parts):
+            position = bounds[0] + (size - bounds[0]) * i // parts
+            if position <= bounds[-1]:
+                continue
+            # Move to the end of the line that contains the byte before 'position'
+            f.seek(position - 1)
+            f.readline()
+            if bounds[-1] < f.tell() < size:
+                bounds.append(f.tell())
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def csv_range_process(file, start, end):
+    """
+    Process the rows of 'file' between the bytes 'start' and 'end', both aligned to the
+    start of a line. Energy and time are computed for every pair of consecutive rows in
+    the range and summed in segments delimited by the marks, so the parent can keep
+    the segments that are inside XS..XF, see 'EnergyIntegrator.feed_range'.
+    :return: a dict with 'first' and 'last' samples (timestamp, power), None if there are
+    no rows in the range, 'marks' a list of (operation, timestamp), 'segments' a list of
+    (energy, time_us), one more than 'marks', the segment n ends with the row of the
+    mark n (included), 'samples' the number of rows, 'stats' the RawCsvStats and 'profile'
+    the stages measured, see 'profiling.collect'
+    """
+    profiling.collect()  # Stages of other work done by this worker, see 'scheduler.run_task'
+    parser = TimestampParser()
+    stats = RawCsvStats()
+    first, prev, marks, segments = None, None, [], []
+    energy, time_us, samples = 0, 0, 0
+    with open(file, 'rb') as f, stage('parse_integrate'):
+        f.seek(start)
+        for time_str, power, op in read_raw_rows(f, stats, header=False, end=end):
+            ts_current, power_current = parser.epoch_us(time_str), float(power)
+            if prev is None:
+                first = (ts_current, power_current)
+            else:
+                us = (ts_current - prev[0]) % 1000000
+                energy += calculate_energy(power_current, prev[1], us)
+                time_us += us
+            if op != '':
+                segments.append((energy, time_us))
+                marks.append((op, ts_current))
+                energy, time_us = 0, 0
+            prev = (ts_current, power_current)
+            samples += 1
+    segments.append((energy, time_us))
+    return {
+        'first': first, 'last': prev, 'marks': marks, 'segments': segments, 'samples': samples, 'stats': stats,
+        'profile': profiling.collect()
     }
+
+
+def data_file_process(cwd, file, engine=ENGINE_PYTHON, phases=False):
+    if is_archive(file):
+        return data_archive_process(cwd, file, phases=phases)
+    logger.info(f'[{cwd}][{file}]')
     ts_xs = None
     ts_xf = None
-    with open(file, 'r+') as f:
+    stats = RawCsvStats()
+    with open_input(os.path.join(cwd, file)) as f:
         energy_dict = csv_name_parsing(file)
-        ts_first = first_timestamp(f)
-        check_last_row(f, logger)
-        ts_xs, ts_xf, energy_dict['joules'], energy_dict['time'] = \
-            csv_process(data, f, ts_first, ts_xs, ts_xf)
+        integrator = PhaseIntegrator() if phases else None
+        # 'data' is a PowerTrace, None if there are no rows
+        if engine == ENGINE_NUMPY:
+            data, ts_xs, ts_xf, energy_dict['joules'], energy_dict['time'] = \
+                csv_process_vectorized(read_raw_columns(f, stats), ts_xs, ts_xf, integrator)
+        else:
+            # The first row is peeked, compressed files can not seek back to read it again
+            rows = read_raw_rows(f, stats)
+            first = next(rows, None)
+            ts_first = None if first is None else read_timestamp(first[0])
+            rows = chain([first], rows) if first is not None else rows
+            if phases:
+                rows = feed_rows(rows, integrator)
+            with stage('parse_integrate'):
+                data, ts_xs, ts_xf, energy_dict['joules'], energy_dict['time'] = \
+                    csv_process(rows, ts_first, ts_xs, ts_xf)
+    log_raw_stats(cwd, file, stats)
+    observe('rows', len(data['mw']) if data is not None else 0)
     if ts_xs and ts_xf:
-        power_plot(file, data['td_dt_00'], data['mw'], data['pos_and_marks'])
-        del data['time'], data['td_dt_00'], data['pos_and_marks']
-        write_csv_dict_with_lists(f'transformed-{file}', data)
+        plot_start = time.perf_counter()
+        with stage('plot'):
+            power_plot(strip_compression(file), *plot_columns(data.ts, data.mw, data.marks, data.ts_first), cwd)
+        observe('plot_seconds', time.perf_counter() - plot_start)
+        with stage('write'):
+            write_csv_dict_with_lists(os.path.join(cwd, f'transformed-{strip_compression(file)}'),
+                                      {key: data[key] for key in TRANSFORMED_COLUMNS})
     else:
         logger.warning(f'[{cwd}][{file}][XS operation not found, skip this file]')
-        # Meta cache system: we use the EXISTENCE of file that starts with 'transformed-' (empty or with data)
-        # to NOT re-analyze older files, for cases where new files are added and we run the script
-        # again it will prevent adding repeated lines in processed_data.csv.
-        open(f'transformed-{file}', 'w').close()
         energy_dict['joules'], energy_dict['time'] = '', ''
+    if phases:
+        energy_dict.update(integrator.columns())
+
+    return energy_dict
+
+
+def data_file_energy(cwd, file, use_index=False, phases=False):
+    """
+    Energy only version of 'data_file_process', the processed data row is computed with a
+    single streaming pass, nothing is plotted and the transformed file is not written.
+    With 'use_index' only the rows between XS and XF are read, see 'index_window', compressed
+    files are always read whole.
+    With 'phases' the columns of every phase in PHASES are added, see 'PhaseIntegrator'.
+    """
+    if is_archive(file):
+        return data_archive_process(cwd, file, plot=False, phases=phases)
+    logger.info(f'[{cwd}][{file}][ENERGY ONLY]')
+    stats = RawCsvStats()
+    path = os.path.join(cwd, file)
+    with open_input(path) as f:
+        window = None
+        if use_index and not compression_suffix(file):
+            with stage('index'):
+                window = index_window(path, [('XS', 'XF'), *PHASES.values()] if phases else [('XS', 'XF')])
+        if window is None:
+            rows = read_raw_rows(f, stats)
+        else:
+            f.seek(window[0])
+            rows = read_raw_rows(f, stats, header=False, end=window[1])
+        with stage('parse_integrate'):
+            integrator = csv_process_stream(rows, PhaseIntegrator() if phases else None)
+    log_raw_stats(cwd, file, stats)
+    return energy_row(cwd, file, integrator)
+
+
+def data_archive_process(cwd, file, plot=True, phases=False):
+    """
+    'data_file_process' for an archive, see trace_archive. Only the blocks between XS and
+    XF are decoded for the energy, the whole trace is decoded for the plot. The transformed
+    file is not written, archives do not keep the time column as text.
+    Power is stored as float32, energy may differ from the csv in the last digits.
+    """
+    logger.info(f'[{cwd}][{file}][ARCHIVE]')
+    energy_dict = csv_name_parsing(file)
+    with TraceArchive(os.path.join(cwd, file)) as archive:
+        log_raw_stats(cwd, file, archive.stats)
+        observe('rows', len(archive))
+        ops = [op for _, op, _ in archive.marks]
+        if 'XS' in ops and 'XF' in ops:
+            energy_dict['joules'], energy_dict['time'] = archive_energy(archive, 'XS', 'XF')
+            if plot:
+                plot_start = time.perf_counter()
+                with stage('plot'):
+                    ts, mw = archive.read()
+                    marks = [(p, op) for p, op, _ in archive.marks]
+                    power_plot(file, *plot_columns(ts, mw, marks, archive.ts_first), cwd)
+                observe('plot_seconds', time.perf_counter() - plot_start)
+        else:
+            logger.warning(f'[{cwd}][{file}][XS operation not found, skip this file]')
+            energy_dict['joules'], energy_dict['time'] = '', ''
+        if phases:
+            energy_dict.update(phase_columns(
+                {
+                    phase: archive_energy(archive, start, finish) for phase, (start, finish) in PHASES.items()
+                    if start in ops and finish in ops
+                },
+                archive_energy(archive, 'XS', 'XF') if 'XS' in ops and 'XF' in ops else None
+            ))
+    return energy_dict
 
+
+def archive_energy(archive, start, finish):
+    """
+    :return: tuple (joules, seconds) between the marks 'start' and 'finish' of 'archive'
+    """
+    with stage('integrate'):
+        energy, time_us = trace_energy(*archive.mark_range(start, finish))
+    return energy / 1000000000, time_us / 1000000
+
+
+def index_window(file, pairs=(('XS', 'XF'),)):
+    """
+    Byte range of the file 'file' (a path) from the first start row to the first finish row (included) of
+    every pair of marks using its sidecar index, the index is built and saved when missing
+    or not valid. Pairs after the first one are optional.
+    :param pairs: list of tuples (start mark, finish mark), the first one is XS and XF
+    :return: tuple (start, end), (0, 0) if a mark of the first pair is missing, None when
+    the whole file must be read: a finish mark before its start mark
+    """
+    index = load_index(file, logger)
+    window = []
+    for i, (start, finish) in enumerate(pairs):
+        first, last = index.first_mark(start), index.first_mark(finish)
+        if first is None or last is None:
+            if i == 0:
+                return 0, 0
+            continue
+        if last[1] < first[1]:
+            return None
+        window.append((first[1], last[2]))
+    return min(s for s, _ in window), max(e for _, e in window)
+
+
+def log_raw_stats(cwd, file, stats):
+    if stats:
+        logger.warning(f'[{cwd}][{file}]{stats}')
+
+
+def energy_row(cwd, file, integrator):
+    """
+    Processed data row of 'file' from an EnergyIntegrator, used by the modes that do
+    not write the transformed file
+    """
+    observe('rows', integrator.samples)
+    energy_dict = csv_name_parsing(file)
+    if integrator.complete():
+        energy_dict['joules'], energy_dict['time'] = integrator.joules(), integrator.seconds()
+    else:
+        logger.warning(f'[{cwd}][{file}][XS operation not found, skip this file]')
+        energy_dict['joules'], energy_dict['time'] = '', ''
+    if isinstance(integrator, PhaseIntegrator):
+        energy_dict.update(integrator.columns())
     return energy_dict
 
 
-def get_files(filter):
+class SplitResult(RangeTasks):
+    """
+    Result of a file split in byte ranges processed by several pool workers, 'get' waits
+    for every range and stitches them in file order, like 'multiprocessing.pool.AsyncResult'
+    """
+
+    def __init__(self, cwd, file, pool, ranges, phases=False):
+        self.cwd = cwd
+        self.file = file
+        self.phases = phases
+        path = os.path.join(cwd, file)
+        super().__init__(pool, path, [(csv_range_process, path, start, end) for start, end in ranges])
+
+    def get(self, timeout=None):
+        integrator = PhaseIntegrator() if self.phases else EnergyIntegrator()
+        stats = RawCsvStats()
+        for partial in self.ranges(timeout):
+            integrator.feed_range(partial)
+            stats.dropped += partial['stats'].dropped
+            stats.repaired += partial['stats'].repaired
+        log_raw_stats(self.cwd, self.file, stats)
+        self.samples = integrator.samples
+        return energy_row(self.cwd, self.file, integrator)
+
+
+def data_file_split(cwd, file, pool, parts, phases=False):
+    """
+    Energy only processing of one file split in 'parts' byte ranges submitted to 'pool'
+    :return: SplitResult
+    """
+    logger.info(f'[{cwd}][{file}][SPLIT][{parts}]')
+    return SplitResult(cwd, file, pool, split_ranges(os.path.join(cwd, file), parts), phases)
+
+
+def get_files(filter, manifest=None, directory=os.curdir):
     """
     Returns a list of files reverse sorted by size.
     Bigger files are first processed to try and maximize the efficiency.
     This does not guaranty that bigger files will always take more time
     to process then smaller files.
-    :return: a list of string representing files in current directory
+    Archives (see trace_archive) are processed instead of the csv they were made from, and
+    csv files instead of their compressed copies (see 'common.unique_inputs'), a csv compressed
+    after it was processed is not processed again.
+    :param manifest: Manifest of processed files, only the 'transformed-' files are checked if None
+    :return: a list of string representing files in 'directory', see 'catalog.list_files'
     """
-    files = os.listdir(os.curdir)
+    files = list_files(directory)
     size_file = []
-    for filename in files:
-        if filename.endswith('.csv') and f'transformed-{filename}' not in files:
+    for filename in unique_inputs(files):
+        stat = files[filename]
+        # Only data files, not the outputs of the scripts, see 'catalog.parse_name'
+        fields = parse_name(filename)
+        if fields is None or fields['suffix'] not in ('csv', ARCHIVE_SUFFIX[1:]):
+            continue
+        if is_archive(filename):
+            # Skip archives of csv files already processed
+            sources = [filename, f'{filename[:-len(ARCHIVE_SUFFIX)]}.csv']
+        elif strip_compression(filename).endswith('.csv') and archive_name(filename) not in files:
+            # Skip csv files compressed after they were processed
+            sources = list(dict.fromkeys([filename, strip_compression(filename)]))
+        else:
+            continue
+        # Files processed before the manifest have a 'transformed-' file (empty or with data)
+        legacy = any(f'transformed-{strip_compression(source)}' in files for source in sources)
+        if manifest is not None:
+            legacy = legacy or any(manifest.known(source) for source in sources[1:])
+        if manifest.pending(filename, legacy) if manifest is not None else not legacy:
             if filter is not None:
                 if filename.startswith(filter):
-                    size = os.path.getsize(filename)
-                    size_file.append((size, filename))
+                    size_file.append((stat.st_size, filename))
             else:
-                size = os.path.getsize(filename)
-                size_file.append((size, filename))
+                size_file.append((stat.st_size, filename))
     size_file.sort(key=lambda s: s[0], reverse=True)
     return [file[1] for file in size_file]
 
 
-def main():
-    options = parse_args(logger)
-    os.chdir(options.directory)
-    logger.addHandler(log_to_file('transform.log'))
+def add_options(parser):
+    add_pool_options(parser)
+    add_plan_options(parser)
+    parser.add_option('-e', '--engine', action='store', type='choice', choices=ENGINES, dest='engine',
+                      default=ENGINE_PYTHON, help=f'engine used to process csv files: {", ".join(ENGINES)}')
+    parser.add_option('--energy-only', action='store_true', dest='energy_only', default=False,
+                      help='only compute energy and time, in constant memory, without plots or transformed files')
+    parser.add_option('--index', action='store_true', dest='index', default=False,
+                      help='energy only mode reads only XS..XF using a sidecar index, built if needed')
+    parser.add_option('--phases', action='store_true', dest='phases', default=False,
+                      help=f'add energy, time and mean power of the phases {", ".join(PHASES)} and the mean power '
+                           f'of XS..XF to each processed data row')
+    parser.add_option('-f', '--follow', action='store_true', dest='follow', default=False,
+                      help='follow files still being written and the new files of the directory, energy only, rows '
+                           'are finalized when XF appears')
+    parser.add_option('--follow-interval', action='store', type='float', dest='follow_interval', default=1.0,
+                      help='seconds between reads of a followed file, default 1')
+    parser.add_option('--follow-timeout', action='store', type='float', dest='follow_timeout', default=60.0,
+                      help='seconds without new rows before a followed file is left unprocessed, and without new '
+                           'files before the directory is left, default 60')
+    parser.add_option('--split-size', action='store', type='int', dest='split_size',
+                      help='files bigger than SPLIT_SIZE MB are split and processed by all cores, energy only')
+
+
+def process_directory(directory, options=None, logger=logger, pool=None):
+    """
+    Processes the data files of 'directory' as the command line does, all the inputs and
+    outputs are in 'directory' and the working directory is not changed, so several
+    directories can be processed at the same time, ie. from threads sharing 'pool'.
+    Profiling (see 'profiling') is enabled for the whole process, cProfile only for the
+    workers of the pool created for the run, so it can not be used with a shared 'pool'.
+    :param options: optparse.Values with the options of the command line but '-d', see
+    'default_options', the defaults if None
+    :param logger: logger of the run, the records of the workers are logged through it too,
+    see 'scheduler.run_scheduled'
+    :param pool: Pool to use, see 'scheduler.limited_pool', one is created with 'options' if None
+    """
+    if options is None:
+        options = default_options(add_options)
+    profiling.enable(options.profile)
+    report = ProfileReport('transform', directory) if options.profile else None
 
-    cwd = os.getcwd()
-    files = get_files(options.starts_with)
-    processed_data = []
+    if options.follow:
+        function, args = data_file_follow, (options.follow_interval, options.follow_timeout, options.phases)
+    elif options.energy_only:
+        function, args = data_file_energy, (options.index, options.phases)
+    else:
+        function, args = data_file_process, (options.engine, options.phases)
+    if options.plan:
+        if options.follow:
+            logger.error('[A run in follow mode can not be planned]')
+            return
+        with Manifest('transform', directory=directory) as manifest:
+            files = get_files(options.starts_with, manifest, directory)
+        plan('transform', [(function, directory, file, *args) for file in files], options.cores, logger,
+             options.max_memory, options.plan_sample, directory)
+        return
+    processed_data = os.path.join(directory, PROCESSED_DATA)
+    if options.cprofile and pool is not None:
+        logger.error('[cProfile needs a pool of its own, the workers of a shared pool are not profiled per run]')
+        return
+    cprofile_directory = profiling.make_cprofile_directory('transform', directory) if options.cprofile else None
+    with Manifest('transform', directory=directory) as manifest, \
+            (limited_pool(options, cprofile_directory) if pool is None else contextlib.nullcontext(pool)) as p:
+        files = get_files(options.starts_with, manifest, directory)
+        sizes = {file: os.path.getsize(os.path.join(directory, file)) for file in files}
+        progress = Progress(logger, len(files), sum(sizes.values()), options.cores, options.progress_interval)
+        split_files = [
+            file for file in files if options.split_size is not None and not is_archive(file) and
+            not compression_suffix(file) and not options.follow and sizes[file] > options.split_size * 1024 * 1024
+        ]
+        splits = [data_file_split(directory, file, p, options.cores, options.phases) for file in split_files]
+        tasks = [(function, directory, file, *args) for file in files if file not in split_files]
+        model = CostModel(manifest.connection, 'transform', task_mode((function, directory, None, *args)), directory)
+        # Files that appear while the directory is followed are processed too
+        more = DirectoryFollower(directory, options.starts_with, manifest, (function, *args), options.follow_timeout,
+                                 files, progress) if options.follow else None
+        # Each row is saved in the manifest as soon as its file is done
+        for file, key, energy_dict in run_scheduled(p, tasks, model, options.cores, logger, manifest, report,
+                                                    progress, options.task_timeout, more):
+            if energy_dict is not None:
+                manifest.record(file, [energy_dict], key)
+                if options.follow:
+                    manifest.export(processed_data, logger)
+        # Split files have a history of their own, their ranges run on all the cores
+        split_model = CostModel(manifest.connection, 'transform', f'data_file_split/{options.cores}/{options.phases}',
+                                directory)
+        failed = []
+        for file, split in zip(split_files, splits):
+            try:
+                manifest.record(file, [split.get(options.task_timeout)], split.key)
+                split_model.record(file, {'size': split.key[0], 'rows': split.samples, 'seconds': split.seconds})
+                if report is not None:
+                    report.add(file, split.seconds, split.profile)
+            except Exception as e:  # MemoryError and multiprocessing.TimeoutError too
+                failed.append((file, f'{type(e).__name__}: {e}'))
+                manifest.quarantine(file, failed[-1][1])
+            progress.done(sizes[file], split.samples)
+        log_quarantined(failed, logger)
+        progress.finish()
+        # Rows not exported by a previous run that crashed are exported too
+        with stage('export'):
+            manifest.export(processed_data, logger)
+    if report is not None:
+        report.write(logger)
+    if cprofile_directory is not None:
+        profiling.merge_cprofiles(cprofile_directory, cprofile_directory, logger)
 
-    # TODO mem profiling not working with mp
-    with Pool(options.cores) as p:
-        results = [p.apply_async(data_file_process, (cwd, file)) for file in files]
-        for result in results:
-            processed_data.append(result.get())
 
-    sort_list_of_dict(processed_data)
-    write_csv_list_of_dict('processed_data.csv', processed_data, logger)
+def main():
+    options = parse_args(logger, add_options)
+    logger.addHandler(log_to_file(os.path.join(options.directory, 'transform.log')))
+    process_directory(os.path.abspath(options.directory), options)
 
 
 if __name__ == "__main__":
-    logger = logging.getLogger('TRANSFORM_CSV')
-    with Manager() as manager:
-        mem = manager.list()
-        profile(mem, 'global', main)
-
-        mem.sort()
-        for item in mem:
-            print(item)
+    main()
@@ -0,0 +1,223 @@
+import csv
+import hashlib
+import json
+import os
+import sqlite3
+from collections import Counter
+
+from common import write_csv_sorted
+
+# Manifest file, saved in the working directory of each pipeline
+MANIFEST_FILE = 'manifest.sqlite'
+
+MANIFEST_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    pipeline TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    hash TEXT NOT NULL,
+    rows TEXT NOT NULL,
+    replaced TEXT,
+    exported INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (pipeline, path)
+);
+CREATE TABLE IF NOT EXISTS quarantine (
+    pipeline TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    reason TEXT NOT NULL,
+    PRIMARY KEY (pipeline, path)
+);
+'''
+
+
+def file_hash(file, block_size=1024 * 1024):
+    """
+    :return: string, sha256 hex digest of the content of 'file'
+    """
+    digest = hashlib.sha256()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def file_key(file, hashed=True):
+    """
+    :param hashed: bool, False to only stat 'file', the hash is computed by 'Manifest.record'
+    :return: tuple (size, mtime_ns, hash) of 'file', hash None if not 'hashed'
+    """
+    stat = os.stat(file)
+    return stat.st_size, stat.st_mtime_ns, file_hash(file) if hashed else None
+
+
+class Manifest:
+    """
+    SQLite record of the files processed by a pipeline ('transform', 'metrics'...) and their
+    result rows. A file is processed again only if its content changes: size and mtime are
+    compared first, the content hash only when they differ (files recorded without a hash,
+    see 'record', are processed again then). Rows are saved as soon as each
+    file is done and exported to the output csv later, so a crash does not lose them.
+    Replaces the sentinel files ('transformed-<file>', 'read-<file>') used before, they are
+    still honored for files not in the manifest.
+    Files that could not be processed are quarantined, they are skipped until they change.
+    """
+
+    def __init__(self, pipeline, path=None, directory=os.curdir):
+        """
+        :param path: string, database file, 'MANIFEST_FILE' in 'directory' if None
+        :param directory: string, directory of the files, their names are relative to it
+        """
+        self.pipeline = pipeline
+        self.directory = directory
+        self.connection = sqlite3.connect(path or os.path.join(directory, MANIFEST_FILE))
+        self.connection.executescript(MANIFEST_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def _select(self, file, columns, table='files'):
+        return self.connection.execute(
+            f'SELECT {columns} FROM {table} WHERE pipeline = ? AND path = ?', (self.pipeline, file)
+        ).fetchone()
+
+    def _path(self, file):
+        return os.path.join(self.directory, file)
+
+    def known(self, file):
+        return self._select(file, 'path') is not None
+
+    def pending(self, file, legacy=False):
+        """
+        :param file: string, file name
+        :param legacy: bool, True if the sentinel file of 'file' exists, only used when
+        'file' is not in the manifest
+        :return: bool, True if 'file' has to be processed
+        """
+        quarantined = self._select(file, 'size, mtime_ns', 'quarantine')
+        if quarantined is not None:
+            stat = os.stat(self._path(file))
+            return (stat.st_size, stat.st_mtime_ns) != quarantined
+        saved = self._select(file, 'size, mtime_ns, hash')
+        if saved is None:
+            return not legacy
+        stat = os.stat(self._path(file))
+        if (stat.st_size, stat.st_mtime_ns) == saved[:2]:
+            return False
+        if stat.st_size != saved[0] or not saved[2] or file_hash(self._path(file)) != saved[2]:
+            return True
+        # Same content, only mtime changed (ie. copied or touched)
+        with self.connection:
+            self.connection.execute(
+                'UPDATE files SET mtime_ns = ? WHERE pipeline = ? AND path = ?',
+                (stat.st_mtime_ns, self.pipeline, file)
+            )
+        return False
+
+    def record(self, file, rows, key=None):
+        """
+        Saves the result rows of 'file', rows exported before for an older version of
+        'file' are removed from the csv on the next 'export'
+        :param file: string, file name
+        :param rows: list of dict, the rows to export
+        :param key: tuple (size, mtime_ns, hash) of 'file', see 'file_key', computed if None. With
+        a hash None the file is not read again to hash it, it is pending when its mtime changes,
+        even if its content does not.
+        """
+        size, mtime_ns, digest = key or file_key(self._path(file))
+        saved = self._select(file, 'rows, replaced, exported')
+        replaced = None
+        if saved is not None:
+            replaced = json.loads(saved[1]) if saved[1] else []
+            if saved[2]:
+                replaced.extend(json.loads(saved[0]))
+            replaced = json.dumps(replaced) if replaced else None
+        with self.connection:
+            self.connection.execute('DELETE FROM quarantine WHERE pipeline = ? AND path = ?', (self.pipeline, file))
+            self.connection.execute(
+                'INSERT OR REPLACE INTO files (pipeline, path, size, mtime_ns, hash, rows, replaced, exported) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, 0)',
+                (self.pipeline, file, size, mtime_ns, digest or '', json.dumps(rows), replaced)
+            )
+
+    def quarantine(self, file, reason):
+        """
+        Records that 'file' could not be processed, it is skipped until it changes
+        :param reason: string, the error
+        """
+        stat = os.stat(self._path(file))
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO quarantine (pipeline, path, size, mtime_ns, reason) VALUES (?, ?, ?, ?, ?)',
+                (self.pipeline, file, stat.st_size, stat.st_mtime_ns, reason)
+            )
+
+    def quarantined(self):
+        """
+        :return: list of tuples (file, reason) of the files in quarantine
+        """
+        return self.connection.execute(
+            'SELECT path, reason FROM quarantine WHERE pipeline = ? ORDER BY path', (self.pipeline,)
+        ).fetchall()
+
+    def _pending_rows(self, column):
+        for saved, in self.connection.execute(
+                f'SELECT {column} FROM files WHERE pipeline = ? AND exported = 0 AND {column} IS NOT NULL',
+                (self.pipeline,)
+        ):
+            yield from json.loads(saved)
+
+    def export(self, filename, logger):
+        """
+        Appends the rows not exported yet to the csv 'filename', sorted, rows of older versions
+        of the files are removed from it first. Rows are streamed from the database and
+        sorted in bounded memory, see 'common.write_csv_sorted'.
+        :return: int, number of rows exported
+        """
+        replaced = list(self._pending_rows('replaced'))
+        if replaced and os.access(filename, os.F_OK):
+            remove_csv_rows(filename, replaced, logger)
+        n = write_csv_sorted(filename, self._pending_rows('rows'), logger)
+        with self.connection:
+            self.connection.execute(
+                'UPDATE files SET exported = 1, replaced = NULL WHERE pipeline = ? AND exported = 0', (self.pipeline,)
+            )
+        return n
+
+
+def row_key(row):
+    """
+    :return: tuple, the items of dict 'row' with a value, as strings, sorted
+    """
+    return tuple(sorted((key, str(value)) for key, value in row.items() if value not in ('', None)))
+
+
+def remove_csv_rows(filename, rows, logger):
+    """
+    Removes the first row of csv 'filename' equal to each row in 'rows', values are compared
+    as strings and empty values as missing ones, the csv may have columns the rows do not have
+    (see 'common.write_csv_sorted'). The csv is copied row by row to a temporary file that replaces it.
+    """
+    remove = Counter(row_key(row) for row in rows)
+    with open(filename, 'r') as f, open(f'{filename}.tmp', 'w') as tmp:
+        reader = csv.DictReader(f)
+        writer = csv.DictWriter(tmp, reader.fieldnames)
+        writer.writeheader()
+        for row in reader:
+            key = row_key(row)
+            if remove[key] > 0:
+                remove[key] -= 1
+            else:
+                writer.writerow(row)
+    os.replace(f'{filename}.tmp', filename)
+    for row, count in remove.items():
+        if count:
+            logger.warning(f'[{filename}][Row to replace not found: {dict(row)}]')
@@ -2,10 +2,14 @@ import csv
 import logging
 import os
 import sys
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from operator import itemgetter
 from optparse import OptionParser
 
-import pandas as pd
+try:
+    import pandas as pd
+except ImportError:  # Optional, only needed by the pandas engine, see 'main'
+    pd = None
 
 from common import write_csv_list_of_dict, sort_list_of_dict, DataFilterItems, IDs, profile
 
@@ -16,6 +20,12 @@ logging.basicConfig(
     datefmt='%Y/%m/%d-%H:%M:%S'
 )
 
+logger = logging.getLogger('MERGE')
+
+ENGINE_PANDAS = 'pandas'
+ENGINE_DICTS = 'dicts'
+ENGINES = (ENGINE_PANDAS, ENGINE_DICTS)
+
 
 def parse_args(logger):
     # Parsear linea de comandos
@@ -23,6 +33,9 @@ def parse_args(logger):
     parser.add_option("--df", "--data-file", action="store", type="string", dest="data_file")
     parser.add_option("--mf", "--metrics-file", action="store", type="string", dest="metrics_file")
     parser.add_option("--sd", "--save-directory", action="store", type="string", dest="save_directory")
+    parser.add_option('-e', '--engine', action='store', type='choice', choices=ENGINES, dest='engine',
+                      default=ENGINE_PANDAS if pd is not None else ENGINE_DICTS,
+                      help=f'engine used to merge: {", ".join(ENGINES)}, {ENGINE_DICTS} does not need pandas')
     (options, args) = parser.parse_args()
     if not options.data_file or \
             not options.metrics_file or \
@@ -51,53 +64,56 @@ def merge_on_intersect_dicts(data: list, metrics: list) -> list:
     """
     Merges two dicts into one using the common elements, returns the new list of OrderedDict
     Rows that are not present in both dicts are not added to the new list.
-    Both dicts are modified, make a copy if you want to do something else with them.
+    Each row of 'metrics', in order, is merged with the first row of 'data' not merged yet with
+    the same values in the common fields, the rows of 'data' are indexed by those values (hash
+    join) so the time is linear in the rows of both.
+    Both dicts are modified, make a copy if you want to do something else with them: the merged
+    rows are removed, the ones left are the rows that do not match, in their order.
     :param data: a list of OrderedDict, data set 1
     :param metrics: a list of OrderedDict, data set 2
     :return: a list of OrderedDict
     """
-    data_keys = data[0].keys()
-    metrics_keys = metrics[0].keys()
-    intersect = list(set(data_keys) & set(metrics_keys))
+    if not data or not metrics:
+        return []
+    intersect = list(data[0].keys() & metrics[0].keys())
+    key = itemgetter(*intersect) if intersect else lambda item: ()
+    index = {}
+    for j, dcp_item in enumerate(data):
+        index.setdefault(key(dcp_item), deque()).append(j)
     merged_data = []
-    i = 0
-    metrics_length = len(metrics)
-    data_length = len(data)
-    while i < metrics_length:
-        mlp_item = metrics[i]
-        j = 0
-        while j < data_length:
-            dcp_item = data[j]
-            # Do fields match?
-            if 0 == [dcp_item[key] == mlp_item[key] for key in intersect].count(False):
-                merged_dict = mlp_item.copy()
-                merged_dict.update(dcp_item)
-                merged_data.append(merged_dict)
-                data.remove(dcp_item)
-                metrics.remove(mlp_item)
-                i -= 1
-                j -= 1
-                metrics_length -= 1
-                data_length -= 1
-            j += 1
-        i += 1
+    data_merged = [False] * len(data)
+    metrics_left = []
+    for mlp_item in metrics:
+        matches = index.get(key(mlp_item))
+        if not matches:
+            metrics_left.append(mlp_item)
+            continue
+        j = matches.popleft()
+        data_merged[j] = True
+        merged_dict = mlp_item.copy()
+        merged_dict.update(data[j])
+        merged_data.append(merged_dict)
+    data[:] = [dcp_item for dcp_item, merged in zip(data, data_merged) if not merged]
+    metrics[:] = metrics_left
     return merged_data
 
 
-def append_data(data: list, diff: list, merged_data: list):
+def append_data(data: list, diff: list, merged_data: list, keys: list = None):
     """
     Appends to 'merged_data' rows from 'data' updated with empty valued fields from 'diff'.
     Follows keys order from 'merged_data'.
     :param data: list of OrderedDicts
     :param diff: list of keys present in 'merged_data' but not in 'data'
     :param merged_data: list of OrderedDicts
+    :param keys: list, keys order, the one of the first row of 'merged_data' if None
     :return:
     """
+    keys = merged_data[0].keys() if keys is None else keys
     for item in data:
         item.update({x: '' for x in diff})
         # Follow keys order of 'merged_data'
         or_dict = OrderedDict()
-        for k in merged_data[0].keys():
+        for k in keys:
             or_dict[k] = item[k]
         merged_data.append(or_dict)
 
@@ -118,21 +134,25 @@ def merge_dicts(data: str, metrics: str):
     metrics_keys, metrics_csv = read_csv_to_dict(metrics)
     merged_data = merge_on_intersect_dicts(metrics=metrics_csv, data=data_csv)
     merged_keys = list(set(data_keys) | set(metrics_keys))
+    # Keys order of the merged rows, also when no row matches
+    keys = list(metrics_keys) + [key for key in data_keys if key not in metrics_keys]
     diff = list(set(merged_keys) - set(metrics_keys))
-    append_data(metrics_csv, diff, merged_data)
+    append_data(metrics_csv, diff, merged_data, keys)
     diff = list(set(merged_keys) - set(data_keys))
-    append_data(data_csv, diff, merged_data)
+    append_data(data_csv, diff, merged_data, keys)
     sort_list_of_dict(merged_data)
     return merged_data
 
 
-def main_dicts_merge(options, log):
+def main_dicts_merge(options, log=logger):
     merged_data = merge_dicts(metrics=options.metrics_file, data=options.data_file)
-    os.chdir(options.save_directory)
-    write_csv_list_of_dict('merge_data.csv', merged_data, log, overwrite=True)
+    write_csv_list_of_dict(os.path.join(options.save_directory, 'merge_data.csv'), merged_data, log, overwrite=True)
 
 
 def merge_pd(data_file: str, metrics_file: str):
+    if pd is None:
+        raise ImportError(f'pandas is needed to merge with the {ENGINE_PANDAS} engine: pip install pandas, '
+                          f'or use the {ENGINE_DICTS} engine')
     data_csv = pd.read_csv(data_file)
     metrics_csv = pd.read_csv(metrics_file)
     merge_on = DataFilterItems.copy()
@@ -158,13 +178,13 @@ def main_merge_pd(options):
 
 def main():
     options = parse_args(logger)
-    # main_dicts_merge(options, logger)  # bad perfomance in general
-    main_merge_pd(options)
+    if options.engine == ENGINE_DICTS:
+        main_dicts_merge(options, logger)
+    else:
+        main_merge_pd(options)
 
 
 if __name__ == "__main__":
-    # global logger
-    logger = logging.getLogger('MERGE')
     mem = []
     profile(mem, 'global', main)
 
@@ -1,8 +1,25 @@
+import contextlib
+import io
+import locale
 import logging
+import mmap
 import os
-from multiprocessing import Manager, Pool
+import re
+from itertools import count
 
-from common import csv_name_parsing, log_to_file, profile, write_csv_list_of_dict, parse_args, sort_list_of_dict
+import profiling
+from catalog import list_files
+from common import csv_name_parsing, log_to_file, parse_args, default_options, open_input, strip_compression, \
+    compression_suffix, unique_inputs
+from manifest import Manifest
+from planner import add_plan_options, plan
+from profiling import stage, ProfileReport
+from progress import Progress
+from scheduler import CostModel, run_scheduled, task_mode, add_pool_options, limited_pool, observe, log_quarantined, \
+    RangeTasks
+
+# Output of the metrics rows, one per run and size of each log
+METRICS_DATA = 'metrics_data.csv'
 
 logging.basicConfig(
     level=logging.INFO,
@@ -11,111 +28,248 @@ logging.basicConfig(
     datefmt='%Y/%m/%d-%H:%M:%S'
 )
 
+logger = logging.getLogger('METRICS')
+
+
+# States of 'parse_npb_log'
+OUTSIDE_RUN = 0  # Before the first 'Run: n' line or after a run that could not be read
+RUN_START = 1  # After 'Run: n' or a closed size block, the next line opens a size block
+IN_SIZE = 2  # In the lines of a size block
+
+# Lines that can change the state of 'parse_npb_log', see 'scan_npb_log'. One regex per
+# keyword, a literal is searched much faster than an alternation
+NPB_KEYWORDS = [re.compile(re.escape(keyword)) for keyword in (b'Run', b'Size:', b'Class', b'Time in ', b'Mops ')]
+# A carriage return not followed by a new line ends a line in text mode, see 'scan_npb_log'
+LONE_CR = re.compile(rb'\r(?!\n)')
+# Start of a run, a log is split at these lines, see 'npb_log_ranges'
+RUN_MARK = re.compile(rb'Run:')
+# Bytes counted at once by 'count_lines'
+COUNT_BLOCK = 16 * 1024 * 1024
+
+
+def parse_npb_log(lines, name_parsed):
+    """
+    Single pass state machine over the lines of a NPB log, a record is yielded as soon as
+    its block is closed, only the record being read is kept in memory.
+    A run starts at a line with 'Run: n', each of the following lines opens a size block
+    ('Size: x') until the next 'Run: n'. A size block is closed by a line with 'Run' or
+    'Size:', or by a line without the expected fields. Its 'Class' line sets the size, the
+    size of the 'Size:' line is used without one; 'Time in seconds' and 'Mops total' set
+    'time_npb' and 'mops', empty if not found. A run is abandoned, until the next 'Run: n',
+    if a size block can not be opened.
+    :param lines: iterable of strings, the lines of the log
+    :param name_parsed: dict with the fields of the name of the log, see 'common.csv_name_parsing'
+    :return: a generator of dict, one per size block of each run
+    """
+    state = OUTSIDE_RUN
+    run = record = None
+    for line in lines:
+        if state == IN_SIZE:
+            if 'Run' in line or 'Size:' in line:
+                yield record
+                state = RUN_START
+            else:
+                try:
+                    if 'Class' in line:
+                        record['size'] = line.split()[3].lower()
+                    if 'Time in ' in line:
+                        record['time_npb'] = float(line.split()[5])
+                    elif 'Mops ' in line:
+                        record['mops'] = float(line.split()[4])
+                except IndexError:
+                    yield record
+                    state = RUN_START
+                continue
+        if 'Run:' in line:
+            run = dict(name_parsed, iteration=f'{int(line.split()[2]):03}')
+            state = RUN_START
+        elif state == RUN_START:
+            fields = line.split()
+            if len(fields) < 3:
+                state = OUTSIDE_RUN
+                continue
+            record = dict(run, time_npb='', mops='')
+            if record['size'] is None:
+                # Replaced by the one of the 'Class' line, if the benchmark did not fail
+                record['size'] = fields[2].lower()
+            state = IN_SIZE
+    if state == IN_SIZE:
+        yield record
 
-def metrics_file_process(cwd: str, file: str) -> [dict]:
+
+def scan_npb_log(buffer, encoding=None, start=0, end=None):
+    """
+    Lines of a NPB log that 'parse_npb_log' needs, without reading the others: the lines
+    with one of NPB_KEYWORDS, each keyword is searched over the whole buffer, and the line
+    after each of them, the one that opens a size block (see RUN_START). Any other line does
+    not change the state of the parser, the records are the same as reading all the lines.
+    Only the lines returned are decoded. The lines must end with a new line, see LONE_CR.
+    :param buffer: bytes-like object with the whole log, ie. a mmap of the file
+    :param encoding: string, encoding of the log, the one of 'open' if None
+    :param start: int, first byte of the lines read, the start of a line
+    :param end: int, the lines read end before this byte, the end of 'buffer' if None
+    :return: a generator of strings
     """
-    Opens 'file', reads all it's lines and collects data with each
-    run of a benchmark in a dict.
-    :param cwd: string, current working directory
+    encoding = encoding or locale.getpreferredencoding(False)
+    end = len(buffer) if end is None else end
+    position = start  # End of the last line returned
+    matches = [keyword.search(buffer, start, end) for keyword in NPB_KEYWORDS]
+    while True:
+        # Next match of each keyword after the last line returned
+        matches = [
+            match if match is None or match.start() >= position else keyword.search(buffer, position, end)
+            for keyword, match in zip(NPB_KEYWORDS, matches)
+        ]
+        positions = [match.start() for match in matches if match is not None]
+        if not positions:
+            break
+        position = max(buffer.rfind(b'\n', position, min(positions)) + 1, position)
+        while position < end:
+            stop = buffer.find(b'\n', position, end) + 1 or end
+            line = buffer[position:stop]
+            yield line.decode(encoding)
+            position = stop
+            if not any(keyword.search(line) for keyword in NPB_KEYWORDS):
+                break
+
+
+def count_lines(buffer, start=0, end=None):
+    """
+    :return: int, lines of 'buffer' between the bytes 'start' and 'end', the last one may not
+    end with a new line
+    """
+    end = len(buffer) if end is None else end
+    lines = sum(buffer[i:min(i + COUNT_BLOCK, end)].count(b'\n') for i in range(start, end, COUNT_BLOCK))
+    return lines + (end > start and buffer[end - 1:end] != b'\n')
+
+
+def metrics_file_process(cwd: str, file: str, scan=True) -> [dict]:
+    """
+    Collects data with each run of a benchmark in a dict, see 'parse_npb_log'. Not
+    compressed logs are mapped in memory and only the lines needed are read, see
+    'scan_npb_log', others are read line by line.
+    :param cwd: string, directory of 'file'
     :param file: string, name of file to process
+    :param scan: bool, False to read every line of the log
     :return: a list of dict
     """
     logger.info(f'[{cwd}][{file}]')
-    data = []
     name_parsed = csv_name_parsing(file)
     name_parsed['size'] = None
-    with open(file, 'r') as f:
-        lines = f.readlines()
-        i = 0
-        while i < len(lines):
-            if 'Run:' in lines[i]:
-                i, metric_dict = block_process_run(i, lines, name_parsed)
-                data.extend(metric_dict)
-            i += 1
-    # mark this file as processed
-    open(f'read-{file}', 'w').close()
+    path = os.path.join(cwd, file)
+    with stage('parse'):
+        if scan and not compression_suffix(file) and os.path.getsize(path):
+            with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                if buffer.find(b'\r') == -1 or LONE_CR.search(buffer) is None:
+                    data = list(parse_npb_log(scan_npb_log(buffer), name_parsed))
+                    observe('rows', count_lines(buffer))
+                    return data
+        with open_input(path, 'r') as f:
+            counter = count()
+            # 'counter' is advanced once per line read
+            data = list(parse_npb_log((line for line, _ in zip(f, counter)), name_parsed))
+            observe('rows', next(counter))
     return data
 
 
-def block_process_run(i: int, lines: list, name_parsed: dict) -> 'int,dict':
-    """
-    Process data between lines with 'Run: n' and 'Run: n+1'.
-    This function has a sketchy implementation and philosophy in general,
-    main candidate to refactor.
-    :param i: int current position in 'lines'
-    :param lines: list of strings with all lines from the file
-    :param name_parsed: a dict with key and value predefined
-    :return: int i: position for previous line before 'Run: n+1', dict
-    """
-    iteration = int(lines[i].split()[2])
-    iter_dict = name_parsed.copy()
-    iter_dict.update({'iteration': f'{iteration:03}'})
-    # Let go to the next line, it should have 'Size: x'
-    i += 1
-    dicts = []
-    # try/except block for when we get to the appearance of last 'Run: x'
-    # since after this block there will be no more of 'Run: x' it will raise
-    # an IndexError. No more available lines to process.
-    try:
-        while 'Run:' not in lines[i]:
-            i, ret_dicts = block_process_size(i, lines, iter_dict)
-            dicts.append(ret_dicts)
-            i += 1
-            # While in 'Run: n' block we must go to the next line
-        # We are at the line with 'Run: n+1', we must set the position to the previous
-        # line so that outer function can read it and launch this function again
-        i -= 1
-    except IndexError:
-        pass
-    return i, dicts
-
-
-def block_process_size(i: int, lines: list, name_parsed: dict) -> 'int,dict':
-    metric_dict = name_parsed.copy()
-    time_npb = ''
-    mops = ''
-    size = lines[i].split()[2].lower()  # In case there is no npb data
-    # Let go to the next line, it should have 'Size: x'
-    i += 1
-    # try/except block for when we get to the appearance of last 'Run: x'
-    # since after this block there will be no more of 'Run: x' it will raise
-    # an IndexError. No more available lines to process.
-    try:
-        while 'Run' not in lines[i] and 'Size:' not in lines[i]:
-            if 'Class' in lines[i]:
-                metric_dict['size'] = lines[i].split()[3].lower()
-            if 'Time in ' in lines[i]:
-                time_npb = float(lines[i].split()[5])
-            elif 'Mops ' in lines[i]:
-                mops = float(lines[i].split()[4])
-            # While in 'Run: n' block we must go to the next line
-            i += 1
-        # We are at the line with 'Run: n+1', we must set the position to the previous
-        # line so that outer function can read it and launch this function again
-        i -= 1
-    except IndexError:
-        pass
-    # Check if there is no npb data
-    if metric_dict['size'] is None:
-        metric_dict['size'] = size
-    metric_dict.update({'time_npb': time_npb, 'mops': mops})
-    return i, metric_dict
-
-
-def get_files(filter):
-    """
-    Filter files from current directory.
-    :return: a list of string, each string is a file name from current directory
-    """
-    files = os.listdir(os.curdir)
+def npb_log_ranges(file, parts):
+    """
+    Splits the log 'file' in 'parts' byte ranges, each one but the first starts at a line
+    with 'Run:'. Such a line closes the size block and the run before it (see
+    'parse_npb_log'), so the ranges can be parsed apart, see 'metrics_range_process'
+    :param file: string, path of the file
+    :param parts: int, number of ranges, less are returned for small files or few runs
+    :return: a list of tuples (start, end)
+    """
+    size = os.path.getsize(file)
+    bounds = [0]
+    if size:
+        with open(file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            for i in range(1, parts):
+                mark = RUN_MARK.search(buffer, max(size * i // parts, bounds[-1]))
+                if mark is None:
+                    break
+                # Start of the line of the mark, a lone carriage return ends a line too
+                start = max(buffer.rfind(b'\n', 0, mark.start()), buffer.rfind(b'\r', 0, mark.start())) + 1
+                if start > bounds[-1]:
+                    bounds.append(start)
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def metrics_range_process(file, start, end, name_parsed):
+    """
+    'metrics_file_process' of the lines of 'file' between the bytes 'start' and 'end', a
+    range of 'npb_log_ranges'
+    :param name_parsed: dict with the fields of the name of the log, see 'parse_npb_log'
+    :return: a dict with 'records' the list of dict of the range, 'rows' the number of lines
+    and 'profile' the stages measured, see 'profiling.collect'
+    """
+    profiling.collect()  # Stages of other work done by this worker, see 'scheduler.run_task'
+    records, rows = [], 0
+    if start < end:
+        with open(file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer, stage('parse'):
+            if buffer.find(b'\r', start, end) == -1 or LONE_CR.search(buffer, start, end) is None:
+                records = list(parse_npb_log(scan_npb_log(buffer, start=start, end=end), name_parsed))
+                rows = count_lines(buffer, start, end)
+            else:
+                # Lines as text mode splits them
+                lines = io.StringIO(buffer[start:end].decode(locale.getpreferredencoding(False)), newline=None)
+                counter = count()
+                records = list(parse_npb_log((line for line, _ in zip(lines, counter)), name_parsed))
+                rows = next(counter)
+    return {'records': records, 'rows': rows, 'profile': profiling.collect()}
+
+
+class MetricsSplitResult(RangeTasks):
+    """
+    Result of a log split in byte ranges processed by several pool workers, 'get' waits for
+    every range and joins their records in file order, like 'multiprocessing.pool.AsyncResult'
+    """
+
+    def get(self, timeout=None):
+        data = []
+        for partial in self.ranges(timeout):
+            data.extend(partial['records'])
+            self.samples += partial['rows']
+        return data
+
+
+def metrics_file_split(cwd, file, pool, parts):
+    """
+    'metrics_file_process' of one log split in 'parts' byte ranges submitted to 'pool', the
+    records are the same
+    :return: MetricsSplitResult
+    """
+    logger.info(f'[{cwd}][{file}][SPLIT][{parts}]')
+    path = os.path.join(cwd, file)
+    name_parsed = csv_name_parsing(file)
+    name_parsed['size'] = None
+    return MetricsSplitResult(pool, path, [
+        (metrics_range_process, path, start, end, name_parsed) for start, end in npb_log_ranges(path, parts)
+    ])
+
+
+def get_files(filter, manifest=None, directory=os.curdir):
+    """
+    Filter files from 'directory'. A log there uncompressed and compressed is one input (see
+    'common.unique_inputs'), a log compressed after it was processed is not processed again.
+    :param manifest: Manifest of processed files, only the 'read-' files are checked if None
+    :return: a list of string, each string is a file name from 'directory'
+    """
+    files = list_files(directory)
     files_ret = []
-    for filename in files:
+    for filename in unique_inputs(files):
         # Basically, dont call your data files metrics.log or start names with 'read-',
-        # is used as a meta cache system.
-        if filename.endswith('.log') and \
-                f'read-{filename}' not in files and \
+        # files processed before the manifest have an empty 'read-' file.
+        legacy = f'read-{filename}' in files or f'read-{strip_compression(filename)}' in files
+        if manifest is not None and filename != strip_compression(filename):
+            # Logs compressed after they were processed
+            legacy = legacy or manifest.known(strip_compression(filename))
+        if strip_compression(filename).endswith('.log') and \
                 filename != 'metrics.log' and \
-                not filename.startswith('read-'):
+                not filename.startswith('read-') and \
+                (manifest.pending(filename, legacy) if manifest is not None else not legacy):
             if filter is not None:
                 if filename.startswith(filter):
                     files_ret.append(filename)
@@ -124,30 +278,82 @@ def get_files(filter):
     return files_ret
 
 
-def main():
-    options = parse_args(logger)
-    os.chdir(options.directory)
-    logger.addHandler(log_to_file('metrics.log'))
+def add_options(parser):
+    add_pool_options(parser)
+    add_plan_options(parser)
+    parser.add_option('--split-size', action='store', type='int', dest='split_size',
+                      help='logs bigger than SPLIT_SIZE MB are split at their runs and processed by all cores')
 
-    cwd = os.getcwd()
-    files = get_files(options.starts_with)
-    processed_data = []
 
-    with Pool(options.cores) as p:
-        results = [p.apply_async(metrics_file_process, (cwd, file)) for file in files]
-        for result in results:
-            processed_data.extend(result.get())
+def process_directory(directory, options=None, logger=logger, pool=None):
+    """
+    Processes the logs of 'directory' as the command line does, all the inputs and outputs
+    are in 'directory' and the working directory is not changed, see
+    'data_csv_process.process_directory'
+    :param options: optparse.Values with the options of the command line but '-d', the
+    defaults if None
+    :param pool: Pool to use, see 'scheduler.limited_pool', one is created with 'options' if None
+    """
+    if options is None:
+        options = default_options(add_options)
+    profiling.enable(options.profile)
+    report = ProfileReport('metrics', directory) if options.profile else None
+    if options.plan:
+        with Manifest('metrics', directory=directory) as manifest:
+            files = get_files(options.starts_with, manifest, directory)
+        plan('metrics', [(metrics_file_process, directory, file) for file in files], options.cores, logger,
+             options.max_memory, options.plan_sample, directory)
+        return
+
+    if options.cprofile and pool is not None:
+        logger.error('[cProfile needs a pool of its own, the workers of a shared pool are not profiled per run]')
+        return
+    cprofile_directory = profiling.make_cprofile_directory('metrics', directory) if options.cprofile else None
+    with Manifest('metrics', directory=directory) as manifest, \
+            (limited_pool(options, cprofile_directory) if pool is None else contextlib.nullcontext(pool)) as p:
+        files = get_files(options.starts_with, manifest, directory)
+        sizes = {file: os.path.getsize(os.path.join(directory, file)) for file in files}
+        progress = Progress(logger, len(files), sum(sizes.values()), options.cores, options.progress_interval)
+        split_files = [
+            file for file in files if options.split_size is not None and not compression_suffix(file) and
+            sizes[file] > options.split_size * 1024 * 1024
+        ]
+        splits = [metrics_file_split(directory, file, p, options.cores) for file in split_files]
+        tasks = [(metrics_file_process, directory, file) for file in files if file not in split_files]
+        model = CostModel(manifest.connection, 'metrics', task_mode(tasks[0]), directory) if tasks else None
+        # The rows of each file are saved in the manifest as soon as it is done
+        for file, key, data in run_scheduled(p, tasks, model, options.cores, logger, manifest, report,
+                                             progress, options.task_timeout):
+            manifest.record(file, data, key)
+        # Split logs have a history of their own, their ranges run on all the cores
+        split_model = CostModel(manifest.connection, 'metrics', f'metrics_file_split/{options.cores}', directory)
+        failed = []
+        for file, split in zip(split_files, splits):
+            try:
+                manifest.record(file, split.get(options.task_timeout), split.key)
+                split_model.record(file, {'size': split.key[0], 'rows': split.samples, 'seconds': split.seconds})
+                if report is not None:
+                    report.add(file, split.seconds, split.profile)
+            except Exception as e:  # MemoryError and multiprocessing.TimeoutError too
+                failed.append((file, f'{type(e).__name__}: {e}'))
+                manifest.quarantine(file, failed[-1][1])
+            progress.done(sizes[file], split.samples)
+        log_quarantined(failed, logger)
+        progress.finish()
+        # Rows not exported by a previous run that crashed are exported too
+        with stage('export'):
+            manifest.export(os.path.join(directory, METRICS_DATA), logger)
+    if report is not None:
+        report.write(logger)
+    if cprofile_directory is not None:
+        profiling.merge_cprofiles(cprofile_directory, cprofile_directory, logger)
 
-    sort_list_of_dict(processed_data)
-    write_csv_list_of_dict('metrics_data.csv', processed_data, logger)
+
+def main():
+    options = parse_args(logger, add_options)
+    logger.addHandler(log_to_file(os.path.join(options.directory, 'metrics.log')))
+    process_directory(os.path.abspath(options.directory), options)
 
 
 if __name__ == "__main__":
-    logger = logging.getLogger('METRICS')
-    with Manager() as manager:
-        mem = manager.list()
-        profile(mem, 'global', main)
-
-        mem.sort()
-        for item in mem:
-            print(item)
+    main()
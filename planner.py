@@ -0,0 +1,195 @@
+import heapq
+import os
+import shutil
+import tempfile
+from multiprocessing.pool import Pool
+
+import psutil
+
+from common import write_csv_list_of_dict, compression_suffix
+from profiling import max_rss_kb
+from scheduler import run_task
+from trace_archive import is_archive, TraceArchive
+
+# Megabytes of the smallest files processed to calibrate the plan, see 'add_plan_options'
+PLAN_SAMPLE = 8
+# Most files processed to calibrate the plan
+PLAN_SAMPLE_FILES = 5
+
+
+def add_plan_options(parser):
+    parser.add_option('--plan', action='store_true', dest='plan', default=False,
+                      help='do not process the files, estimate the time and memory the run would need, '
+                           'saved in plan-<pipeline>.csv')
+    parser.add_option('--plan-sample', action='store', type='float', dest='plan_sample', default=PLAN_SAMPLE,
+                      help=f'MB of the smallest files processed to calibrate the plan, default {PLAN_SAMPLE}')
+
+
+def calibration_files(files, sample_mb=PLAN_SAMPLE, max_files=PLAN_SAMPLE_FILES, directory=os.curdir):
+    """
+    :param files: list of strings, files of the run, relative to 'directory'
+    :return: list of strings, the smallest files of 'files' adding up to 'sample_mb' MB, at
+    least one
+    """
+    sample = []
+    total = 0
+    for size, file in sorted((os.path.getsize(os.path.join(directory, file)), file) for file in files):
+        if sample and (total + size > sample_mb * 1024 * 1024 or len(sample) == max_files):
+            break
+        sample.append(file)
+        total += size
+    return sample
+
+
+def _calibration_task(task):
+    """
+    Runs 'task' with 'run_task' in a temporary directory, so the outputs of the calibration
+    do not mix with the ones of the run
+    :return: tuple (file, observed), observed has 'rss_kb' the memory used by the task
+    """
+    function, cwd, file, *args = task
+    before = max_rss_kb()
+    with tempfile.TemporaryDirectory(prefix='plan-') as directory:
+        shutil.copy2(os.path.join(cwd, file), directory)
+        _, _, _, observed = run_task((function, directory, file, *args))
+    del observed['logs']  # Of the copy in the temporary directory
+    observed['rss_kb'] = max_rss_kb() - before
+    return file, observed
+
+
+def _fit(x, y):
+    """
+    :return: tuple (intercept, slope) of the least squares line of 'y' on 'x', both not
+    negative, through the origin if there are not two different 'x'
+    """
+    n = len(x)
+    if n == 0:
+        return 0.0, 0.0
+    mean_x, mean_y = sum(x) / n, sum(y) / n
+    var_x = sum((xi - mean_x) ** 2 for xi in x)
+    if var_x == 0:
+        return 0.0, max(sum(y) / sum(x), 0.0) if sum(x) else 0.0
+    slope = sum((xi - mean_x) * (yi - mean_y) for xi, yi in zip(x, y)) / var_x
+    if slope < 0:
+        return max(mean_y, 0.0), 0.0
+    intercept = mean_y - slope * mean_x
+    if intercept < 0:
+        return 0.0, sum(y) / sum(x)
+    return intercept, slope
+
+
+class Calibration:
+    """
+    Costs measured processing a sample of files, each in a new worker:
+    seconds = seconds + seconds_per_row * rows and memory = kb + kb_per_row * rows
+    """
+
+    def __init__(self, samples):
+        """
+        :param samples: list of tuples (file, observed), see '_calibration_task', the ones
+        that failed are not used
+        """
+        self.errors = [(file, observed['error']) for file, observed in samples if 'error' in observed]
+        samples = [(file, observed) for file, observed in samples if 'error' not in observed]
+        self.files = [file for file, _ in samples]
+        rows = [observed.get('rows', 0) for _, observed in samples]
+        sizes = [observed['size'] for _, observed in samples]
+        # Bytes per row of the csv files by compression, '' for not compressed ones
+        totals = {}
+        for file, size, row in zip(self.files, sizes, rows):
+            if not is_archive(file):
+                total = totals.setdefault(compression_suffix(file), [0, 0])
+                total[0] += size
+                total[1] += row
+        self.default_bytes_per_row = sum(sizes) / max(sum(rows), 1)
+        self.bytes_per_row = {suffix: size / max(row, 1) for suffix, (size, row) in totals.items()}
+        self.seconds, self.seconds_per_row = _fit(rows, [observed['seconds'] for _, observed in samples])
+        self.kb, self.kb_per_row = _fit(rows, [observed['rss_kb'] for _, observed in samples])
+
+    @classmethod
+    def run(cls, tasks):
+        """
+        Processes 'tasks', one by one, each in a new worker
+        :param tasks: list of tuples (function, cwd, file, *args), see 'scheduler.run_task'
+        """
+        with Pool(1, maxtasksperchild=1) as p:
+            return cls(p.map(_calibration_task, tasks, chunksize=1))
+
+    def rows(self, path):
+        """
+        :return: int, rows of the file 'path', estimated from its size and compression but for
+        archives
+        """
+        if is_archive(path):
+            with TraceArchive(path) as archive:
+                return archive.rows
+        bytes_per_row = self.bytes_per_row.get(compression_suffix(path), self.bytes_per_row.get(''))
+        return int(os.path.getsize(path) / (bytes_per_row or self.default_bytes_per_row))
+
+    def predict(self, path):
+        """
+        :return: tuple (rows, seconds, memory in KB) predicted for the file 'path'
+        """
+        rows = self.rows(path)
+        return rows, self.seconds + self.seconds_per_row * rows, self.kb + self.kb_per_row * rows
+
+
+def lpt_makespan(seconds, cores):
+    """
+    :return: float, makespan of tasks of 'seconds' on 'cores' dispatched longest first, as
+    'scheduler.run_scheduled' does
+    """
+    loads = [0.0] * cores
+    for s in sorted(seconds, reverse=True):
+        heapq.heapreplace(loads, loads[0] + s)
+    return max(loads)
+
+
+def plan(pipeline, tasks, cores, logger, max_memory=None, sample_mb=PLAN_SAMPLE, directory=os.curdir):
+    """
+    Estimates the run of 'tasks' without doing it: rows of each file from its size and the
+    costs per row measured processing the smallest files (see 'Calibration'). Logs the
+    predicted wall time for 'cores' and other core counts, the peak memory per worker and of
+    all of them, and flags the files over the memory budget: 'max_memory' MB if given,
+    the available memory divided by 'cores' if not. Saves 'plan-<pipeline>.csv' in
+    'directory' with the prediction of each file.
+    :param tasks: list of tuples (function, directory, file, *args), see 'scheduler.run_task'
+    :return: list of dict, the rows of the csv
+    """
+    if not tasks:
+        logger.info('[PLAN][No files to process]')
+        return []
+    files = [task[2] for task in tasks]
+    sample = calibration_files(files, sample_mb, directory=directory)
+    calibration = Calibration.run([task for task in tasks if task[2] in sample])
+    for file, error in calibration.errors:
+        logger.warning(f'[PLAN][CALIBRATION][{file}][{error}]')
+    bytes_per_row = ''.join(f'[{ratio:.1f} bytes/row{suffix}]' for suffix, ratio in calibration.bytes_per_row.items())
+    logger.info(f'[PLAN][CALIBRATION][{len(calibration.files)} files]{bytes_per_row}'
+                f'[{calibration.seconds:.3f} s + {calibration.seconds_per_row * 1e6:.3f} s/Mrow]'
+                f'[{calibration.kb / 1024:.1f} MB + {calibration.kb_per_row * 1e6 / 1024:.1f} MB/Mrow]')
+    base_kb = max_rss_kb()  # Workers are forked from this process
+    budget_kb = max_memory * 1024 if max_memory else psutil.virtual_memory().available / 1024 / cores
+    rows = []
+    for file in files:
+        path = os.path.join(directory, file)
+        file_rows, seconds, kb = calibration.predict(path)
+        rows.append({
+            'file': file, 'size': os.path.getsize(path), 'rows': file_rows, 'seconds': round(seconds, 3),
+            'memory_mb': round((base_kb + kb) / 1024, 1), 'over_budget': base_kb + kb > budget_kb
+        })
+    seconds = [row['seconds'] for row in rows]
+    memory = sorted((row['memory_mb'] for row in rows), reverse=True)
+    logger.info(f'[PLAN][{len(rows)} files][{sum(row["size"] for row in rows) / 1e6:.1f} MB]'
+                f'[{sum(row["rows"] for row in rows)} rows][{sum(seconds):.1f} s of work]')
+    for n in sorted({1, 2, 4, 8, 16, 32, 64, cores, os.cpu_count() or 1}):
+        if n <= max(cores, os.cpu_count() or 1):
+            chosen = '[CHOSEN]' if n == cores else ''
+            logger.info(f'[PLAN][CORES {n}]{chosen}[WALL {lpt_makespan(seconds, n):.1f} s]'
+                        f'[PEAK MEMORY {sum(memory[:n]):.0f} MB]')
+    logger.info(f'[PLAN][PEAK MEMORY PER WORKER {memory[0]:.0f} MB][BUDGET {budget_kb / 1024:.0f} MB]')
+    for row in rows:
+        if row['over_budget']:
+            logger.warning(f'[PLAN][OVER BUDGET][{row["file"]}][{row["memory_mb"]:.0f} MB]')
+    write_csv_list_of_dict(os.path.join(directory, f'plan-{pipeline}.csv'), rows, logger, overwrite=True)
+    return rows
@@ -1,3 +1,4 @@
+import os
 from datetime import timedelta
 
 import matplotlib.dates as mdates
@@ -132,12 +133,12 @@ def set_x_as_date(ax, data):
     ax.xaxis.set_major_formatter(x_axis_format)
 
 
-def power_plot(filename, x_axis, y_axis, marks):
+def power_plot(filename, x_axis, y_axis, marks, path='.'):
     config = {
         CfgLabel.ylabel: "Potencia (mW)",
         CfgLabel.aspect_ratio: 2.0,
         CfgLabel.size: 20,
-        CfgLabel.fname: f'power_plot_{filename}',
+        CfgLabel.fname: os.path.join(path, f'power_plot_{filename}'),
         CfgLabel.ftype: 'png',
         CfgLabel.xlabel: "Tiempo"
     }
@@ -153,7 +154,7 @@ def power_plot(filename, x_axis, y_axis, marks):
     ax.set_xlabel(config[CfgLabel.xlabel])
     ax.set_ylim(
         0,
-        get_yaxis_upper_value(max(y_axis))
+        get_yaxis_upper_value(y_axis.max() if hasattr(y_axis, 'max') else max(y_axis))
     )
 
     # Set ticks and strings on Y axes
@@ -200,7 +201,7 @@ def box_plot(path, filename, label, data):
         CfgLabel.dpi: 100,
         CfgLabel.size: 5,
         CfgLabel.ftype: 'png',
-        CfgLabel.fname: f'{path}/boxplot-{label}_{filename}'
+        CfgLabel.fname: os.path.join(path, f'boxplot-{label}_{filename}')
     }
 
     fig, ax = plt.subplots(
@@ -0,0 +1,184 @@
+import datetime
+from collections.abc import Mapping
+from itertools import repeat
+
+import numpy
+
+# Size of the chunks used to convert numpy arrays into python objects
+CHUNK_SIZE = 65536
+
+# Keys of a trace, the columns of a processed power csv, see data_csv_process.data_file_process
+TRACE_KEYS = ['time_str', 'time', 'mw', 'op', 'time_xs', 'time_00', 'us', 'td_dt_00', 'pos_and_marks']
+# Samples of a trace plotted at most, about 10 per pixel of the power plot, see 'plot_columns'
+PLOT_POINTS = 20000
+
+
+def plot_columns(ts, mw, marks, ts_first, max_points=PLOT_POINTS):
+    """
+    Columns of 'plotters.power_plot' for a trace downsampled to about 'max_points' samples, so
+    the plot does not copy every sample. The samples with the min and max power of each bucket
+    are kept, the plot draws the same envelope, and the samples with marks too.
+    :param ts: numpy int64 array, timestamps in microseconds since epoch
+    :param mw: numpy float array, power in milliwatt
+    :param marks: list of tuples (position, operation)
+    :param ts_first: int, first timestamp of the file in microseconds since epoch
+    :param max_points: int, samples kept, plus the first, the last and the marks
+    :return: tuple ('td_dt_00' as a numpy datetime64[us] array, power, marks with their position
+    in the columns returned)
+    """
+    n = len(mw)
+    if n > max_points:
+        size = -(-n // (max_points // 2))
+        whole = n - n % size
+        # Views of the buckets, only the positions of their min and max are allocated
+        buckets = mw[:whole].reshape(-1, size)
+        starts = numpy.arange(0, whole, size)
+        kept = [starts + buckets.argmin(axis=1), starts + buckets.argmax(axis=1), [0, n - 1], [p for p, _ in marks]]
+        if whole < n:
+            kept.append([whole + mw[whole:].argmin(), whole + mw[whole:].argmax()])
+        kept = numpy.unique(numpy.concatenate(kept).astype(numpy.int64))
+        ts, mw = ts[kept], mw[kept]
+        marks = [(int(numpy.searchsorted(kept, p)), op) for p, op in marks]
+    td_dt_00 = numpy.datetime64(datetime.datetime.min, 'us') + (ts - ts_first).astype('timedelta64[us]')
+    return td_dt_00, mw, marks
+
+
+class PowerTrace(Mapping):
+    """
+    Compact in memory representation of a power csv file: timestamps as int64 microseconds
+    since epoch, power as a float array, the raw time strings as fixed width bytes and
+    the marks as a sparse list of (position, operation), the same as 'pos_and_marks'.
+    Works as a read only dict with the keys of TRACE_KEYS, the other columns are derived
+    on demand:
+    - 'time', 'mw' and 'td_dt_00' are numpy arrays (datetime64[us], float, datetime64[us])
+    - 'time_str', 'op', 'time_xs', 'time_00' and 'us' are iterables of python objects,
+      generated by chunks, with the values written in the transformed file
+    - 'pos_and_marks' is a list
+    """
+
+    def __init__(self, time_str, ts, mw, marks, ts_first, ts_xs=None, window=(0, 0)):
+        """
+        :param time_str: numpy array of bytes (dtype 'S'), time column as read from the csv
+        :param ts: numpy int64 array, timestamps in microseconds since epoch
+        :param mw: numpy float array, power in milliwatt
+        :param marks: list of tuples (position, operation)
+        :param ts_first: int, first timestamp of the file in microseconds since epoch
+        :param ts_xs: int, reference for 'time_xs' in microseconds since epoch, None if no XS
+        :param window: tuple (start, stop), rows where energy was computed ('us' is not empty)
+        """
+        self.time_str = time_str
+        self.ts = ts
+        self.mw = mw
+        self.marks = marks
+        self.ts_first = ts_first
+        self.ts_xs = ts_xs
+        self.window = window
+
+    def __len__(self):
+        return len(TRACE_KEYS)
+
+    def __iter__(self):
+        return iter(TRACE_KEYS)
+
+    def __getitem__(self, key):
+        if key == 'time_str':
+            return self._chunks(lambda i, j: self.time_str[i:j].astype(str).tolist())
+        if key == 'time':
+            return self.ts.view('datetime64[us]')
+        if key == 'mw':
+            return self.mw
+        if key == 'op':
+            return self._op()
+        if key == 'time_xs':
+            if self.ts_xs is None:
+                return []
+            return self._chunks(lambda i, j: ((self.ts[i:j] - self.ts_xs) / 1000000).tolist())
+        if key == 'time_00':
+            return self._chunks(lambda i, j: self._time_00(i, j).tolist())
+        if key == 'us':
+            return self._us()
+        if key == 'td_dt_00':
+            return numpy.datetime64(datetime.datetime.min, 'us') + self._time_00(0, len(self.ts))
+        if key == 'pos_and_marks':
+            return self.marks
+        raise KeyError(key)
+
+    @property
+    def nbytes(self):
+        return self.time_str.nbytes + self.ts.nbytes + self.mw.nbytes
+
+    def _time_00(self, i, j):
+        return (self.ts[i:j] - self.ts_first).astype('timedelta64[us]')
+
+    def _chunks(self, convert):
+        for i in range(0, len(self.ts), CHUNK_SIZE):
+            yield from convert(i, i + CHUNK_SIZE)
+
+    def _op(self):
+        position = 0
+        for p, op in self.marks:
+            yield from repeat('', p - position)
+            yield op
+            position = p + 1
+        yield from repeat('', len(self.ts) - position)
+
+    def _us(self):
+        start, stop = self.window
+        yield from repeat('', start)
+        for i in range(start, stop, CHUNK_SIZE):
+            j = min(i + CHUNK_SIZE, stop)
+            yield from (numpy.diff(self.ts[i - 1:j]) % 1000000).tolist()
+        yield from repeat('', len(self.ts) - stop)
+
+
+class PowerTraceBuilder:
+    """
+    Collects the rows of a trace one at a time into the arrays of a PowerTrace, rows are
+    converted every CHUNK_SIZE rows so python objects are only kept for the current chunk
+    """
+
+    def __init__(self):
+        self.rows = 0
+        self.marks = []
+        self._time_str, self._ts, self._mw = [], [], []
+        self._chunk = ([], [], [])
+
+    def append(self, time_str, ts, mw, op):
+        """
+        :param time_str: string, time column as read from the csv
+        :param ts: int, timestamp in microseconds since epoch
+        :param mw: float, power in milliwatt
+        :param op: string, the operation mark of the row, '' if none
+        """
+        chunk_time, chunk_ts, chunk_mw = self._chunk
+        chunk_time.append(time_str)
+        chunk_ts.append(ts)
+        chunk_mw.append(mw)
+        if op != '':
+            self.marks.append((self.rows, op))
+        self.rows += 1
+        if len(chunk_ts) == CHUNK_SIZE:
+            self._flush()
+
+    def _flush(self):
+        chunk_time, chunk_ts, chunk_mw = self._chunk
+        if chunk_ts:
+            self._time_str.append(numpy.array(chunk_time, dtype=bytes))
+            self._ts.append(numpy.array(chunk_ts, dtype=numpy.int64))
+            self._mw.append(numpy.array(chunk_mw, dtype=numpy.float64))
+            self._chunk = ([], [], [])
+
+    def build(self, ts_first, ts_xs=None, window=(0, 0)):
+        """
+        :param ts_first: int, first timestamp of the file in microseconds since epoch
+        :param ts_xs: int, reference for 'time_xs' in microseconds since epoch, None if no XS
+        :param window: tuple (start, stop), rows where energy was computed
+        :return: PowerTrace with the rows appended, None if there are none
+        """
+        self._flush()
+        if not self.rows:
+            return None
+        return PowerTrace(
+            numpy.concatenate(self._time_str), numpy.concatenate(self._ts), numpy.concatenate(self._mw),
+            self.marks, ts_first, ts_xs=ts_xs, window=window
+        )
@@ -0,0 +1,299 @@
+import cProfile
+import contextlib
+import glob
+import json
+import os
+import pstats
+import resource
+import shutil
+import time
+from collections import Counter
+
+from common import write_csv_list_of_dict
+
+# Stages are only measured when enabled, see 'enable'
+_enabled = False
+# Stages measured in this process since the last 'collect', tuples (name, seconds, cpu seconds)
+_records = []
+_NULL_STAGE = contextlib.nullcontext()
+# Directory where each task saves its cProfile stats, None if not enabled, see 'enable_cprofile'
+_cprofile_directory = None
+# Tasks run under cProfile by this process, to name their stats files
+_cprofile_tasks = 0
+# Peak RSS of this process at the last 'collect', KB
+_collected_max_rss_kb = 0
+
+
+def enable(enabled=True):
+    global _enabled
+    _enabled = enabled
+
+
+def enabled():
+    return _enabled
+
+
+def max_rss_kb():
+    """
+    :return: int, peak resident set size of this process in KB since it started
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class _Stage:
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.cpu = time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        _records.append((self.name, time.perf_counter() - self.start, time.process_time() - self.cpu))
+
+
+def stage(name):
+    """
+    Measures wall and cpu time of the code in a 'with stage(name):' block, stages can be nested
+    and repeated. When profiling is not enabled a shared null context is returned.
+    """
+    return _Stage(name) if _enabled else _NULL_STAGE
+
+
+def collect():
+    """
+    :return: dict with the stages measured since the last call, as a list of tuples
+    (name, seconds, cpu seconds), 'max_rss_delta_kb' how much the peak RSS of the process grew
+    since the last call, the memory of the work done since then beyond the peak of the earlier
+    work (0 if below it), and 'worker_max_rss_kb' the peak RSS of the process since it started,
+    maybe of earlier work. None if not enabled.
+    """
+    global _collected_max_rss_kb
+    if not _enabled:
+        return None
+    records = list(_records)
+    _records.clear()
+    peak = max_rss_kb()
+    delta = peak - _collected_max_rss_kb
+    _collected_max_rss_kb = peak
+    return {'stages': records, 'max_rss_delta_kb': delta, 'worker_max_rss_kb': peak}
+
+
+def combine(profile, partial):
+    """
+    Adds to 'profile' the one of a part of a task run by another worker, ie. a byte range of a
+    split file. The parts run at the same time, so their RSS deltas are added.
+    :param profile: dict returned by 'collect', None for the first part
+    :param partial: dict returned by 'collect' in the worker of the part, None if not enabled
+    :return: dict, 'profile' updated
+    """
+    if partial is None:
+        return profile
+    profile = profile or {'stages': [], 'max_rss_delta_kb': 0, 'worker_max_rss_kb': 0}
+    profile['stages'].extend(partial['stages'])
+    profile['max_rss_delta_kb'] += partial['max_rss_delta_kb']
+    profile['worker_max_rss_kb'] = max(profile['worker_max_rss_kb'], partial['worker_max_rss_kb'])
+    return profile
+
+
+class ProfileReport:
+    """
+    Aggregates the stages measured in the workers of a run, file by file, and in the parent
+    """
+
+    def __init__(self, pipeline, directory=os.curdir):
+        """
+        :param directory: string, where the report is written
+        """
+        self.pipeline = pipeline
+        self.directory = directory
+        self.files = []
+        self.start = time.perf_counter()
+
+    def add(self, file, seconds, profile):
+        """
+        :param file: string, processed file
+        :param seconds: float, wall time of the task
+        :param profile: dict returned by 'collect' in the worker
+        """
+        stages = {}
+        for name, wall, cpu in profile['stages']:
+            total = stages.setdefault(name, {'count': 0, 'seconds': 0, 'cpu_seconds': 0})
+            total['count'] += 1
+            total['seconds'] += wall
+            total['cpu_seconds'] += cpu
+        self.files.append({'file': file, 'seconds': seconds, 'max_rss_delta_kb': profile['max_rss_delta_kb'],
+                           'worker_max_rss_kb': profile['worker_max_rss_kb'], 'stages': stages})
+
+    def stages(self):
+        """
+        :return: dict of stage name to count, total, mean and max seconds over all the files
+        """
+        stages = {}
+        for file in self.files:
+            for name, total in file['stages'].items():
+                s = stages.setdefault(name, {'files': 0, 'count': 0, 'seconds': 0, 'cpu_seconds': 0, 'max_seconds': 0})
+                s['files'] += 1
+                s['count'] += total['count']
+                s['seconds'] += total['seconds']
+                s['cpu_seconds'] += total['cpu_seconds']
+                s['max_seconds'] = max(s['max_seconds'], total['seconds'])
+        for s in stages.values():
+            s['mean_seconds'] = s['seconds'] / s['files']
+        return stages
+
+    def write(self, logger):
+        """
+        Writes 'profile-<pipeline>.json' with the whole report and 'profile-<pipeline>.csv' with
+        one row per file and stage
+        """
+        name = os.path.join(self.directory, f'profile-{self.pipeline}')
+        parent = collect() or {'stages': [], 'worker_max_rss_kb': max_rss_kb()}
+        report = {
+            'pipeline': self.pipeline,
+            'seconds': time.perf_counter() - self.start,
+            'parent': parent,
+            'stages': self.stages(),
+            'files': self.files,
+        }
+        with open(f'{name}.json', 'w') as f:
+            json.dump(report, f, indent=2)
+        rows = [
+            {
+                'file': file['file'], 'stage': name, 'count': total['count'], 'seconds': total['seconds'],
+                'cpu_seconds': total['cpu_seconds'], 'file_seconds': file['seconds'],
+                'max_rss_delta_kb': file['max_rss_delta_kb'], 'worker_max_rss_kb': file['worker_max_rss_kb']
+            }
+            for file in self.files for name, total in file['stages'].items()
+        ]
+        write_csv_list_of_dict(f'{name}.csv', rows, logger, overwrite=True)
+        logger.info(f'[PROFILE][{name}.json][{len(self.files)} files]'
+                    f'[PARENT MAX RSS {parent["worker_max_rss_kb"]} KB]')
+
+
+def enable_cprofile(directory):
+    """
+    Runs the tasks of this process under cProfile, see 'cprofiled', also used as pool initializer
+    :param directory: string, absolute path where the stats of each task are saved, None disables it
+    """
+    global _cprofile_directory
+    _cprofile_directory = directory
+
+
+def cprofile_directory():
+    return _cprofile_directory
+
+
+def cprofile_path(pipeline, directory=os.curdir):
+    """
+    :return: string, absolute path of 'cprofile-<pipeline>' in 'directory', where the stats of a
+    run of 'pipeline' are saved
+    """
+    return os.path.abspath(os.path.join(directory, f'cprofile-{pipeline}'))
+
+
+def make_cprofile_directory(pipeline, directory=os.curdir):
+    """
+    :return: string, absolute path of 'cprofile-<pipeline>' in 'directory', created empty
+    """
+    directory = cprofile_path(pipeline, directory)
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+    return directory
+
+
+class _CProfiled:
+
+    def __init__(self, name, directory):
+        self.name = name
+        self.directory = directory
+
+    def __enter__(self):
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+        return self
+
+    def __exit__(self, *exc):
+        global _cprofile_tasks
+        self.profiler.disable()
+        _cprofile_tasks += 1
+        name = os.path.basename(self.name).replace(os.sep, '_')
+        self.profiler.dump_stats(os.path.join(self.directory, f'{os.getpid()}-{_cprofile_tasks}-{name}.pstats'))
+
+
+def cprofiled(name, directory=None):
+    """
+    Runs the code in a 'with cprofiled(name):' block under cProfile and saves its stats in
+    'directory', the one of 'enable_cprofile' if None, one file per block. When cProfile is not
+    enabled a shared null context is returned.
+    """
+    directory = directory or _cprofile_directory
+    return _CProfiled(name, directory) if directory is not None else _NULL_STAGE
+
+
+def call(function, *args):
+    """
+    Pool task that runs 'function(*args)' under cProfile when enabled, see 'cprofiled'
+    """
+    with cprofiled(function.__name__):
+        return function(*args)
+
+
+def _label(func):
+    filename, line, name = func
+    return name if filename == '~' else f'{name} ({os.path.basename(filename)}:{line})'
+
+
+def collapsed_stacks(stats, min_us=1):
+    """
+    cProfile only records caller to callee edges, the stacks are rebuilt walking the call graph
+    from the functions without callers, the time of each function is split among its stacks
+    proportionally to the time of each edge. Recursive calls are folded into the first call.
+    :param stats: pstats.Stats
+    :param min_us: stacks with less microseconds are not walked
+    :return: Counter of stacks 'caller;...;callee' to microseconds spent in the callee itself
+    """
+    callees = {}
+    for func, (_, _, _, _, callers) in stats.stats.items():
+        for caller, (_, _, _, ct) in callers.items():
+            callees.setdefault(caller, []).append((func, ct))
+    stacks = Counter()
+
+    def walk(func, stack, seconds):
+        _, _, tt, ct, _ = stats.stats[func]
+        share = seconds / ct if ct else 0
+        stack = stack + (func,)
+        stacks[';'.join(map(_label, stack))] += tt * share * 1e6
+        for callee, edge in callees.get(func, []):
+            if callee not in stack and edge * share * 1e6 >= min_us:
+                walk(callee, stack, edge * share)
+
+    for func, (_, _, _, ct, callers) in stats.stats.items():
+        if not callers:
+            walk(func, (), ct)
+    return stacks
+
+
+def merge_cprofiles(directory, output, logger, top=10):
+    """
+    Merges the stats of all the tasks saved in 'directory' into '<output>.pstats', readable
+    with pstats or snakeviz, and '<output>.collapsed', one line 'stack microseconds' per stack
+    for flamegraph.pl or speedscope. The functions with most own time are logged.
+    """
+    files = sorted(glob.glob(os.path.join(directory, '*.pstats')))
+    if not files:
+        logger.warning(f'[CPROFILE][{directory}][No stats]')
+        return None
+    stats = pstats.Stats(*files)
+    stats.dump_stats(f'{output}.pstats')
+    with open(f'{output}.collapsed', 'w') as f:
+        for stack, us in sorted(collapsed_stacks(stats).items()):
+            if us >= 1:
+                f.write(f'{stack} {int(us)}\n')
+    logger.info(f'[CPROFILE][{output}.pstats][{output}.collapsed][{len(files)} tasks]')
+    hot = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)[:top]
+    for func, (cc, nc, tt, ct, _) in hot:
+        logger.info(f'[CPROFILE][{_label(func)}][CALLS {nc}][OWN {tt:.3f} s][CUMULATIVE {ct:.3f} s]')
+    return stats
@@ -0,0 +1,117 @@
+import sys
+import time
+
+# Seconds between progress samples written to the run log, see 'add_progress_options'
+PROGRESS_INTERVAL = 10.0
+
+
+def add_progress_options(parser):
+    parser.add_option('--progress-interval', action='store', type='float', dest='progress_interval',
+                      default=PROGRESS_INTERVAL,
+                      help=f'seconds between progress samples in the log, 0 logs only the last one, '
+                           f'default {PROGRESS_INTERVAL}')
+
+
+class Progress:
+    """
+    Progress of a batch run, kept in the parent process: files done out of the total, MB/s,
+    rows/s, utilization of each worker and ETA. The status line is refreshed on 'stream' when
+    it is a terminal and a sample is logged every 'interval' seconds, so the throughput of
+    runs can be compared across hosts and code versions.
+    """
+
+    def __init__(self, logger, files, size=0, cores=1, interval=PROGRESS_INTERVAL, name='', stream=sys.stderr):
+        """
+        :param files: int, number of files (or tasks) of the run
+        :param size: int, bytes of all the files, 0 if unknown, the ETA is computed from files then
+        :param cores: int, number of workers
+        :param interval: float, seconds between samples logged, 0 or None to log only at 'finish'
+        :param name: string, added to the log lines, ie. the stage of the run
+        """
+        self.logger = logger
+        self.files = files
+        self.size = size
+        self.cores = cores
+        self.interval = interval
+        self.name = name
+        self.stream = stream if stream is not None and stream.isatty() else None
+        self.start = time.perf_counter()
+        self.last_log = self.start
+        self.done_files = 0
+        self.done_size = 0
+        self.rows = 0
+        self.busy = {}  # Seconds of work of each worker
+
+    def done(self, size=0, rows=0, seconds=0.0, worker=None):
+        """
+        Adds a completed file
+        :param size: int, bytes of the file
+        :param rows: int, rows read from the file
+        :param seconds: float, time the worker spent with the file
+        :param worker: worker id (pid), None if unknown
+        """
+        self.done_files += 1
+        self.done_size += size
+        self.rows += rows
+        if worker is not None:
+            self.busy[worker] = self.busy.get(worker, 0) + seconds
+        self.tick()
+
+    def sample(self):
+        """
+        :return: dict with 'elapsed' seconds, 'files' done, 'total' files, 'mb' done, 'mb_s',
+        'rows_s', 'utilization' of each worker (fraction of the elapsed time it was busy),
+        'busy' the utilization of all the cores and 'eta' in seconds, None until a file is done
+        """
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+        if self.size and self.done_size:
+            eta = (self.size - self.done_size) * elapsed / self.done_size
+        elif self.done_files:
+            eta = (self.files - self.done_files) * elapsed / self.done_files
+        else:
+            eta = None
+        return {
+            'elapsed': elapsed,
+            'files': self.done_files,
+            'total': self.files,
+            'mb': self.done_size / 1e6,
+            'mb_s': self.done_size / 1e6 / elapsed,
+            'rows_s': self.rows / elapsed,
+            'utilization': {worker: busy / elapsed for worker, busy in sorted(self.busy.items())},
+            'busy': sum(self.busy.values()) / (elapsed * self.cores),
+            'eta': eta,
+        }
+
+    def status(self, sample=None):
+        s = sample or self.sample()
+        eta = f'{s["eta"]:.0f} s' if s['eta'] is not None else '?'
+        busy = f'[BUSY {s["busy"]:.0%}]' if s['utilization'] else ''
+        return (f'[{s["files"]}/{s["total"]} files][{s["mb"]:.1f} MB][{s["mb_s"]:.2f} MB/s]'
+                f'[{s["rows_s"]:.0f} rows/s]{busy}[ETA {eta}]')
+
+    def _log(self, sample):
+        name = f'[{self.name}]' if self.name else ''
+        workers = ' '.join(f'{worker}:{u:.0%}' for worker, u in sample['utilization'].items())
+        self.logger.info(f'[PROGRESS]{name}{self.status(sample)}' + (f'[WORKERS {workers}]' if workers else ''))
+
+    def tick(self):
+        """
+        Refreshes the status line and logs a sample if 'interval' seconds passed since the last one
+        """
+        now = time.perf_counter()
+        sample = None
+        if self.stream is not None:
+            sample = self.sample()
+            self.stream.write('\r' + f'{self.name} {self.status(sample)}'.lstrip() + '\033[K')
+            self.stream.flush()
+        if self.interval and now - self.last_log >= self.interval:
+            self.last_log = now
+            self._log(sample or self.sample())
+
+    def finish(self):
+        """
+        Logs the last sample, the throughput of the whole run
+        """
+        if self.stream is not None:
+            self.stream.write('\n')
+        self._log(self.sample())
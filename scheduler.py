@@ -0,0 +1,487 @@
+import contextlib
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import resource
+import signal
+import statistics
+import time
+from multiprocessing.pool import Pool
+
+import profiling
+from custom_exceptions import TaskTimeout
+from manifest import file_key
+from progress import add_progress_options
+
+HISTORY_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS history (
+    pipeline TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    rows INTEGER NOT NULL,
+    seconds REAL NOT NULL,
+    plot_seconds REAL NOT NULL,
+    PRIMARY KEY (pipeline, mode, path)
+)
+'''
+
+# Measures of the running task, see 'observe'
+_observed = {}
+# Wall clock seconds allowed to each task of this worker, see 'init_worker'
+_timeout = None
+# Seconds past the timeout of a task before the parent kills its worker, the alarm of the worker
+# fails the task first unless it can not run, ie. the task is blocked in C code, see 'run_scheduled'
+KILL_GRACE = 2
+
+
+def add_pool_options(parser):
+    parser.add_option('--max-memory', action='store', type='int', dest='max_memory',
+                      help='virtual address space limit of each worker in MB (not resident memory, mapped files '
+                           'and reserved memory count too), files that exceed it are quarantined')
+    parser.add_option('--task-timeout', action='store', type='float', dest='task_timeout',
+                      help='seconds allowed to process each file, files that exceed it are quarantined')
+    parser.add_option('--max-tasks-per-child', action='store', type='int', dest='max_tasks_per_child',
+                      help='files processed by a worker before it is replaced by a new one')
+    parser.add_option('--profile', action='store_true', dest='profile', default=False,
+                      help='time the stages of each file and save a report as profile-<pipeline>.json/csv')
+    parser.add_option('--cprofile', action='store_true', dest='cprofile', default=False,
+                      help='run each file under cProfile, the stats are saved in cprofile-<pipeline>/ and merged '
+                           'into cprofile-<pipeline>.pstats/.collapsed')
+    add_progress_options(parser)
+
+
+def init_worker(max_memory=None, timeout=None, profile=False, cprofile_directory=None):
+    """
+    Pool initializer, sets the limits of the worker
+    :param max_memory: int, virtual address space limit in bytes (RLIMIT_AS), allocations beyond it
+    raise MemoryError. It is not a resident memory (RSS) limit: memory reserved or mapped but not
+    used counts too, so it has to be set above the RSS expected of a task (see 'planner.plan')
+    :param timeout: float, seconds allowed to each task, see 'run_task'
+    :param profile: bool, measure the stages of each task, see 'profiling'
+    :param cprofile_directory: string, where the cProfile stats of each task are saved, see
+    'profiling.enable_cprofile'
+    """
+    global _timeout
+    if max_memory is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (max_memory, resource.getrlimit(resource.RLIMIT_AS)[1]))
+    _timeout = timeout
+    profiling.enable(profile)
+    profiling.enable_cprofile(cprofile_directory)
+
+
+def limited_pool(options, cprofile_directory=None):
+    """
+    :param options: optparse.Values with 'cores' and the options of 'add_pool_options'
+    :param cprofile_directory: string, the workers run their tasks under cProfile and save the
+    stats in it, see 'profiling.enable_cprofile', None to disable it
+    :return: a Pool with the limits, profiling and worker recycling of 'options'
+    """
+    max_memory = options.max_memory * 1024 * 1024 if options.max_memory else None
+    initargs = (max_memory, options.task_timeout, options.profile, cprofile_directory)
+    return Pool(options.cores, initializer=init_worker, initargs=initargs, maxtasksperchild=options.max_tasks_per_child)
+
+
+def _alarm(signum, frame):
+    raise TaskTimeout(f'Task timeout: {_timeout} s')
+
+
+class _Records(logging.Handler):
+    """
+    Keeps the log records of a task, see 'captured_logs'
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        # Sent to the parent process, the arguments may not be picklable
+        record.msg, record.args = record.getMessage(), None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        self.records.append(record)
+
+
+@contextlib.contextmanager
+def captured_logs():
+    """
+    Keeps the log records of the code in a 'with captured_logs() as records:' block instead of
+    handling them, so the parent process can log them through the logger of the run, see
+    'run_scheduled'. The handlers of the loggers of this process, inherited when the worker was
+    forked, are restored at the end.
+    """
+    root = logging.getLogger()
+    loggers = [root] + [
+        log for log in logging.Logger.manager.loggerDict.values() if isinstance(log, logging.Logger) and log.handlers
+    ]
+    handlers = [(log, log.handlers) for log in loggers]
+    capture = _Records()
+    for log in loggers:
+        log.handlers = [capture] if log is root or not log.propagate else []
+    try:
+        yield capture.records
+    finally:
+        for log, saved in handlers:
+            log.handlers = saved
+
+
+def observe(name, value):
+    """
+    Adds 'value' to the measure 'name' of the task running in this process, ie. rows
+    read or seconds spent plotting, they are returned by 'run_task'
+    """
+    _observed[name] = _observed.get(name, 0) + value
+
+
+def observe_key(key):
+    """
+    Replaces the key returned by 'run_task' for the task running in this process, for tasks that
+    read a file still being written, ie. following it, as the key taken before is of a part of it
+    :param key: tuple (size, mtime_ns, hash), see 'manifest.file_key'
+    """
+    _observed['key'] = key
+
+
+def run_task(task, index=None, started=None):
+    """
+    Runs 'function(cwd, file, *args)' in a pool worker and measures it
+    :param task: tuple (function, cwd, file, *args), 'file' is relative to the directory 'cwd'
+    :param index: task number, the pid of this worker and the time the task starts (see 'time.time')
+    are saved in 'started[index]' before it runs, so a task lost with its worker or running past its
+    timeout can be found, see 'run_scheduled'
+    :param started: dict shared with the parent process, optional
+    :return: tuple (file, key, result, observed), key as 'manifest.file_key' taken before the task
+    (or the one given to 'observe_key'), without the hash, and observed a dict with 'size',
+    'seconds', 'worker' (pid), 'changed' (True if the file changed while the task ran), 'logs'
+    (the log records of the task, see 'captured_logs') and the measures added with 'observe'.
+    When the task fails, runs out of memory or time (see 'init_worker') result is None and
+    observed has 'error'. With profiling enabled observed has 'profile', see 'profiling.collect', with
+    cProfile enabled the stats of the task are saved, see 'profiling.cprofiled'.
+    """
+    function, cwd, file, *args = task
+    if started is not None:
+        started[index] = (os.getpid(), time.time())
+    _observed.clear()
+    profiling.collect()  # Stages of other work done by this worker, ie. split file ranges
+    path = os.path.join(cwd, file)
+    # Key of the content read, taken before so a file changed meanwhile is processed again later. The
+    # file is not hashed, the task may read only part of it (ie. with an index), see 'Manifest.record'
+    key = file_key(path, hashed=False)
+    start = time.perf_counter()
+    with captured_logs() as records:
+        try:
+            try:
+                # Armed and disarmed inside the outer 'try', an alarm at any point is a timeout of the task
+                if _timeout:
+                    signal.signal(signal.SIGALRM, _alarm)
+                    signal.setitimer(signal.ITIMER_REAL, _timeout)
+                with profiling.cprofiled(file):
+                    result = function(cwd, file, *args)
+            finally:
+                if _timeout:
+                    signal.setitimer(signal.ITIMER_REAL, 0)
+        except Exception as e:  # MemoryError and TaskTimeout too
+            result = None
+            _observed['error'] = f'{type(e).__name__}: {e}'
+    key = _observed.pop('key', key)
+    observed = dict(_observed, seconds=time.perf_counter() - start, worker=os.getpid(), size=key[0], logs=records)
+    try:
+        stat = os.stat(path)
+        observed['changed'] = (stat.st_size, stat.st_mtime_ns) != key[:2]
+    except OSError:
+        observed['changed'] = True
+    observed['profile'] = profiling.collect()
+    return file, key, result, observed
+
+
+def task_mode(task):
+    """
+    :return: string, what is done with each file: function and arguments but the file
+    """
+    function, cwd, file, *args = task
+    return '/'.join([function.__name__, *map(str, args)])
+
+
+class CostModel:
+    """
+    Predicts the seconds needed to process a file from the history of previous runs in the
+    same mode (see 'task_mode'), saved in the manifest database:
+    - files already seen: their last time scaled by size
+    - new files: size / bytes per second, plus the plot time per row by the estimated rows
+    Medians of all the files in the history are used for new files, the prediction is the
+    size of the file when there is no history.
+    """
+
+    def __init__(self, connection, pipeline, mode, directory=os.curdir):
+        """
+        :param directory: string, directory of the files, their names are relative to it
+        """
+        self.connection = connection
+        self.pipeline = pipeline
+        self.mode = mode
+        self.directory = directory
+        self.connection.execute(HISTORY_SCHEMA)
+        self.connection.commit()
+        history = self.connection.execute(
+            'SELECT path, size, rows, seconds, plot_seconds FROM history WHERE pipeline = ? AND mode = ?',
+            (pipeline, mode)
+        ).fetchall()
+        self.history = {
+            path: (size, rows, seconds, plot_seconds) for path, size, rows, seconds, plot_seconds in history
+        }
+        sized = [h for h in self.history.values() if h[0] > 0]
+        self.bytes_per_second = self._median([size / max(seconds - plot, 1e-6) for size, _, seconds, plot in sized])
+        self.rows_per_byte = self._median([rows / size for size, rows, _, _ in sized])
+        self.plot_per_row = self._median([plot / rows for _, rows, _, plot in sized if rows > 0])
+
+    @staticmethod
+    def _median(values):
+        return statistics.median(values) if values else None
+
+    def predict(self, file):
+        """
+        :return: float, predicted seconds to process 'file', its size when there is no history
+        """
+        size = os.path.getsize(os.path.join(self.directory, file))
+        if file in self.history:
+            size_then, _, seconds, _ = self.history[file]
+            return seconds * size / size_then if size_then else seconds
+        if self.bytes_per_second is None:
+            return size
+        plot = size * self.rows_per_byte * self.plot_per_row if self.plot_per_row is not None else 0
+        return size / self.bytes_per_second + plot
+
+    def record(self, file, observed):
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO history (pipeline, mode, path, size, rows, seconds, plot_seconds) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (self.pipeline, self.mode, file, observed['size'], observed.get('rows', 0),
+                 observed['seconds'], observed.get('plot_seconds', 0))
+            )
+
+
+class RangeTasks:
+    """
+    Byte ranges of one file processed by several pool workers. The key of the file is taken
+    before the ranges are submitted, so a file appended to during the run is processed again,
+    and 'seconds' runs from the submission to the end of the last range, not to the 'get'.
+    """
+
+    def __init__(self, pool, path, tasks):
+        """
+        :param pool: multiprocessing.Pool
+        :param path: string, path of the file
+        :param tasks: list of tuple (function, *args), one per range
+        """
+        self.key = file_key(path, hashed=False)
+        self.profile = None  # Stages of all the ranges, see 'profiling.collect'
+        self.samples = 0  # Rows of all the ranges
+        self._pending = len(tasks)
+        self._finished = None
+        self._submitted = time.perf_counter()
+        self.results = [pool.apply_async(profiling.call, task, callback=self._done) for task in tasks]
+
+    def _done(self, _):
+        # Callbacks run in the single result handler thread of the pool, before 'get' returns
+        self._pending -= 1
+        if not self._pending:
+            self._finished = time.perf_counter()
+
+    @property
+    def seconds(self):
+        """
+        :return: float, wall time of the ranges, until now while they run
+        """
+        return (self._finished or time.perf_counter()) - self._submitted
+
+    def ranges(self, timeout=None):
+        """
+        Waits for each range in file order, their profiles are combined in 'profile'
+        :return: generator of the dict returned by each range
+        """
+        for result in self.results:
+            partial = result.get(timeout)
+            self.profile = profiling.combine(self.profile, partial['profile'])
+            yield partial
+
+
+def run_scheduled(pool, tasks, model, cores, logger, manifest=None, report=None, progress=None, timeout=None,
+                  more=None):
+    """
+    Dispatches 'tasks' to 'pool' longest predicted first and yields the results as they
+    complete, the history of 'model' is updated with each one. Failed tasks are not yielded,
+    their files are quarantined in 'manifest' and listed at the end. The makespan is logged
+    at the end against its lower bound: max(longest task, sum of task times / cores).
+    A task whose worker dies (ie. killed by the OOM killer or a segfault) fails too, the pool
+    replaces the worker but would never return the task. The log records of each task are
+    logged through 'logger' when it completes, so each run keeps its own log with a shared pool.
+    :param tasks: list of tuples (function, cwd, file, *args)
+    :param model: CostModel
+    :param cores: int, number of workers of 'pool'
+    :param manifest: Manifest where failed files are quarantined, optional
+    :param report: profiling.ProfileReport where the stages of each task are added, optional
+    :param progress: progress.Progress updated with each task and refreshed every second while
+    waiting, optional
+    :param timeout: float, seconds allowed to each task, the worker of a task still running
+    KILL_GRACE seconds later is killed and the task fails, None to wait forever. The workers
+    time out their tasks themselves too, see 'init_worker'.
+    :param more: callable, called every second with the number of pending tasks, returns a list of
+    new tasks to dispatch, or None once no more will come, ie. files that appear in a followed
+    directory. Optional, the run ends when 'tasks' are done if None.
+    :return: a generator of tuples (file, key, result), see 'run_task'
+    """
+    tasks = sorted(tasks, key=lambda task: model.predict(task[2]), reverse=True)
+    start = time.perf_counter()
+    seconds = []
+    failed = []
+    outcomes = queue.SimpleQueue()
+    with multiprocessing.Manager() as manager:
+        started = manager.dict()  # Task index to pid of the worker running it and start time
+        pending = {}  # Task index to file
+        indexes = itertools.count()
+
+        def dispatch(task):
+            i = next(indexes)
+            pending[i] = task[2]
+            pool.apply_async(run_task, (task, i, started), callback=lambda outcome: outcomes.put((i, outcome)),
+                             error_callback=lambda e: outcomes.put((i, e)))
+
+        for task in tasks:
+            dispatch(task)
+        workers = {}
+        orphaned = set()
+        check = time.monotonic() + 1
+        while pending or more is not None:
+            try:
+                i, outcome = outcomes.get(timeout=1)
+            except queue.Empty:
+                i, outcome = None, None
+            # Every second, also while other tasks complete
+            if time.monotonic() >= check:
+                check = time.monotonic() + 1
+                if progress is not None:
+                    progress.tick()
+                running = started.copy()
+                lost, orphaned = _lost_tasks(workers, running, pending, orphaned)
+                for lost_i, reason in lost + _overdue_tasks(running, pending, timeout, orphaned):
+                    file = pending.pop(lost_i)
+                    failed.append((file, reason))
+                    if manifest is not None:
+                        manifest.quarantine(file, reason)
+                    if progress is not None:
+                        progress.done()
+                if more is not None:
+                    new = more(len(pending))
+                    if new is None:
+                        more = None
+                    for task in new or []:
+                        dispatch(task)
+            if i is None or pending.pop(i, None) is None:
+                continue  # Nothing completed or given up as lost
+            if isinstance(outcome, BaseException):
+                raise outcome
+            yield from _completed(outcome, model, logger, manifest, report, progress, seconds, failed)
+    log_quarantined(failed, logger)
+    if seconds:
+        makespan = time.perf_counter() - start
+        lower_bound = max(max(seconds), sum(seconds) / cores)
+        logger.info(f'[MAKESPAN][{len(seconds)} tasks][{makespan:.3f} s][LOWER BOUND {lower_bound:.3f} s]'
+                    f'[EFFICIENCY {lower_bound / makespan:.1%}]')
+
+
+def _lost_tasks(workers, started, pending, orphaned):
+    """
+    Tasks of 'pending' whose worker is not alive. A worker that exits normally (see
+    'maxtasksperchild') returns its last task first, so a task is only lost if it is still
+    orphaned in the next call, once its result had time to arrive.
+    :param workers: dict, pid to Process of the child processes seen alive, updated
+    :param started: dict, task index to tuple (pid of the worker that took it, start time), see 'run_task'
+    :param pending: dict, task index to file of the tasks not completed
+    :param orphaned: set, task indexes orphaned in the previous call
+    :return: tuple (list of tuples (task index, reason) of the lost tasks, set of the orphaned ones)
+    """
+    # The workers are children of this process, the exit code of the ones that exited stays in
+    # their Process for the pool
+    children = multiprocessing.active_children()
+    workers.update((process.pid, process) for process in children)
+    alive = {process.pid for process in children}
+    now = {i for i in pending if i in started and started[i][0] not in alive}
+    lost = []
+    for i in sorted(now & orphaned):
+        pid = started[i][0]
+        # Unknown if the pool replaced the worker before it was seen
+        exitcode = workers[pid].exitcode if pid in workers else None
+        if exitcode is None:
+            reason = f'Worker {pid} died'
+        elif exitcode < 0:
+            reason = f'Worker {pid} died, killed by {signal.Signals(-exitcode).name}'
+        else:
+            reason = f'Worker {pid} died, exit code {exitcode}'
+        lost.append((i, reason))
+    return lost, now
+
+
+def _overdue_tasks(started, pending, timeout, orphaned):
+    """
+    Kills the workers of the tasks of 'pending' running for longer than 'timeout' plus KILL_GRACE
+    seconds, the pool replaces them
+    :param started: dict, task index to tuple (pid of the worker that took it, start time), see 'run_task'
+    :param pending: dict, task index to file of the tasks not completed
+    :param timeout: float, seconds allowed to each task, None for no limit
+    :param orphaned: set, task indexes whose worker is not alive, see '_lost_tasks'
+    :return: list of tuples (task index, reason) of the tasks of the killed workers
+    """
+    if timeout is None:
+        return []
+    overdue = []
+    now = time.time()
+    for i in sorted(set(pending) - orphaned):
+        if i in started and now - started[i][1] > timeout + KILL_GRACE:
+            pid = started[i][0]
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass  # Exited meanwhile, its result may never arrive either
+            overdue.append((i, f'TaskTimeout: Task timeout: {timeout} s, worker {pid} killed'))
+    return overdue
+
+
+def _completed(outcome, model, logger, manifest, report, progress, seconds, failed):
+    """
+    Handles the 'outcome' of a task in 'run_scheduled', see 'run_task'
+    :return: list with the tuple (file, key, result) if the task did not fail
+    """
+    file, key, result, observed = outcome
+    for record in observed['logs']:
+        logger.handle(record)
+    seconds.append(observed['seconds'])
+    if progress is not None:
+        progress.done(observed['size'], observed.get('rows', 0), observed['seconds'], observed['worker'])
+    if report is not None and observed['profile'] is not None:
+        report.add(file, observed['seconds'], observed['profile'])
+    if 'error' in observed:
+        failed.append((file, observed['error']))
+        if manifest is not None:
+            manifest.quarantine(file, observed['error'])
+        return []
+    if observed['changed']:
+        # Recorded with the key from before the task, the file is pending in the next run
+        logger.warning(f'[{file}][Changed while processed, it is processed again in the next run]')
+    model.record(file, observed)
+    return [(file, key, result)]
+
+
+def log_quarantined(failed, logger):
+    """
+    Run summary of the files that could not be processed
+    :param failed: list of tuples (file, reason)
+    """
+    if failed:
+        logger.warning(f'[QUARANTINED][{len(failed)} files]')
+        for file, reason in failed:
+            logger.warning(f'[QUARANTINED][{file}][{reason}]')
@@ -9,8 +9,12 @@ import numpy
 import pandas as pd
 import seaborn as sns
 
+import profiling
 from common import log_to_file, IDs, profile, DataFilterItems, ResultItems, write_csv_list_of_dict, CORES
 from plotters import box_plot
+from progress import Progress, add_progress_options
+
+logger = logging.getLogger('STATS_CSV')
 
 
 def parse_args(logger):
@@ -20,6 +24,10 @@ def parse_args(logger):
     parser.add_option("--sd", "--save-directory", action="store", type="string", dest="save_directory")
     parser.add_option("--skip-warm-up", action="store", type="int", dest="skip_warm_up", default=0)
     parser.add_option("--only-stats", action="store_true", dest="only_stats")
+    parser.add_option("--cprofile", action="store_true", dest="cprofile",
+                      help="run each plotting task under cProfile, the stats are saved in cprofile-stats/ and "
+                           "merged into cprofile-stats.pstats/.collapsed")
+    add_progress_options(parser)
     (options, args) = parser.parse_args()
     if not options.data_file or \
             not options.save_directory:
@@ -59,40 +67,58 @@ def set_data_labels(cp):
             cp.ax.text(x=text_x, y=text_y, s=f'{bar_height:.2f}', ha='center', fontsize=9)
 
 
-def cat_plotting(cwd, df, options, x_axis_groupby, type):
+def stats_pool(cwd, options):
+    """
+    :return: a Pool whose workers run their tasks under cProfile with '--cprofile', the stats are
+    saved in the cProfile directory of the run in 'cwd', tasks have to be submitted with 'profiling.call'
+    """
+    directory = profiling.cprofile_path('stats', cwd) if options.cprofile else None
+    return Pool(CORES, initializer=profiling.enable_cprofile, initargs=(directory,))
+
+
+def wait_results(results, options, name, logger=logger):
+    """
+    Waits for the pool 'results' of a plotting stage, its progress is reported as 'name'
+    """
+    progress = Progress(logger, len(results), cores=CORES, interval=options.progress_interval, name=name)
+    for result in results:
+        result.get()
+        progress.done()
+    progress.finish()
+
+
+def cat_plotting(cwd, df, options, x_axis_groupby, type, logger=logger):
     df_groups = df.groupby(list(set(DataFilterItems) - set([x_axis_groupby])))
     values = ['mean', 'q2_median']
-    with Pool(CORES) as p:
+    with stats_pool(cwd, options) as p:
         results = [p.apply_async(
-            catplot_for_parallel, (df_groups, options, type, value, x_axis_groupby)
+            profiling.call, (catplot_for_parallel, cwd, df_groups, options, type, value, x_axis_groupby, logger)
         ) for value in values]
-        for result in results:
-            result.get()
+        wait_results(results, options, f'CATPLOT {type} {x_axis_groupby}', logger)
 
 
-def catplot_for_parallel(df_groups, options, type, value, x_axis_groupby):
+def catplot_for_parallel(cwd, df_groups, options, type, value, x_axis_groupby, logger=logger):
     for group in df_groups:
         name = f'catplot_{value}_{type}_{x_axis_groupby}_{"_".join(str(x) for x in group[0])}'
         cp = sns.catplot(x=IDs.THREADS, y=value, data=group[1], height=6, kind="bar", palette="muted")
         set_data_labels(cp)
-        cp.savefig(name)
+        cp.savefig(os.path.join(cwd, name))
         cp.fig.clf()
         plt.close()
         logger.info(f'[{options.data_file}][CATPLOT][{name}]')
 
 
-def cat_plotting_group(cwd, df, options, x_axis_groupby, type):
+def cat_plotting_group(cwd, df, options, x_axis_groupby, type, logger=logger):
     df_groups = df.groupby(list(set(DataFilterItems) - set(x_axis_groupby)))
     values = ['mean', 'q2_median']
-    with Pool(CORES) as p:
+    with stats_pool(cwd, options) as p:
         results = [p.apply_async(
-            catplot_group_for_parallel, (df_groups, options, type, value, x_axis_groupby)
+            profiling.call, (catplot_group_for_parallel, cwd, df_groups, options, type, value, x_axis_groupby, logger)
         ) for value in values]
-        for result in results:
-            result.get()
+        wait_results(results, options, f'CATPLOT {type} {"_".join(x_axis_groupby)}', logger)
 
 
-def catplot_group_for_parallel(df_groups, options, type, value, x_axis_groupby):
+def catplot_group_for_parallel(cwd, df_groups, options, type, value, x_axis_groupby, logger=logger):
     for group in df_groups:
         name = f'catplot_{value}_{type}_{"_".join(x_axis_groupby)}_{"_".join(str(x) for x in group[0])}'
         title = f'{type}_{"_".join(group[0])}'
@@ -100,13 +126,13 @@ def catplot_group_for_parallel(df_groups, options, type, value, x_axis_groupby):
                          palette="muted")
         set_data_labels(cp)
         cp.ax.set_title(title)
-        cp.savefig(name)
+        cp.savefig(os.path.join(cwd, name))
         cp.fig.clf()
         plt.close()
         logger.info(f'[{options.data_file}][CATPLOT][HUE][{name}]')
 
 
-def box_plotting(cwd, df, options, x_axis_groupby):
+def box_plotting(cwd, df, options, x_axis_groupby, logger=logger):
     """
     Creates boxplots with data from :df and saves them in :cwd.
     :df has type,device,os,benchmark and threads, using :x_axis_groupby
@@ -116,16 +142,19 @@ def box_plotting(cwd, df, options, x_axis_groupby):
     :param df: pandas DataFrame, data read from a csv file (usually and in my case)
     :param options: optparse.Values object, parsed arguments, used for logging
     :param x_axis_groupby: string, the x axis of the boxplot
+    :param logger: logger of the run, also used by the workers
     :return:
     """
     df_groups = df.groupby(list(set(DataFilterItems) - set([x_axis_groupby])))
-    with Pool(CORES) as p:
-        results = [p.apply_async(boxplot_for_parallel, (cwd, group, options, x_axis_groupby)) for group in df_groups]
-        for result in results:
-            result.get()
+    with stats_pool(cwd, options) as p:
+        results = [
+            p.apply_async(profiling.call, (boxplot_for_parallel, cwd, group, options, x_axis_groupby, logger))
+            for group in df_groups
+        ]
+        wait_results(results, options, f'BOXPLOT {x_axis_groupby}', logger)
 
 
-def boxplot_for_parallel(cwd, group, options, x_axis_groupby):
+def boxplot_for_parallel(cwd, group, options, x_axis_groupby, logger=logger):
     unique = group[1][x_axis_groupby].drop_duplicates()
     dicts = {}
     for i in ResultItems:
@@ -139,36 +168,38 @@ def boxplot_for_parallel(cwd, group, options, x_axis_groupby):
         plt.close()
 
 
-def groups_plotting(name, data, options, x_group, x_axis):
+def groups_plotting(cwd, name, data, options, x_group, x_axis, logger=logger):
     name_time = f'{name}_{IDs.TIME}_{x_axis}_{x_group}.png'
     logger.info(f'[{options.data_file}][BOXPLOT][{name_time}]')
     bp = sns.boxplot(x=x_axis, y=IDs.TIME, hue=x_group, data=data)
-    bp.get_figure().savefig(name_time)
+    bp.get_figure().savefig(os.path.join(cwd, name_time))
     bp.get_figure().clf()
     name_energy = f'{name}_{IDs.ENERGY}_{x_axis}_{x_group}.png'
     logger.info(f'[{options.data_file}][BOXPLOT][{name_energy}]')
     bp = sns.boxplot(x=x_axis, y=IDs.ENERGY, hue=x_group, data=data)
-    bp.get_figure().savefig(name_energy)
+    bp.get_figure().savefig(os.path.join(cwd, name_energy))
     bp.get_figure().clf()
     name_mops = f'{name}_{IDs.MOPS}_{x_axis}_{x_group}.png'
     logger.info(f'[{options.data_file}][BOXPLOT][{name_mops}]')
     bp = sns.boxplot(x=x_axis, y=IDs.MOPS, hue=x_group, data=data)
-    bp.get_figure().savefig(name_mops)
+    bp.get_figure().savefig(os.path.join(cwd, name_mops))
     bp.get_figure().clf()
 
 
-def box_plotting_groups(cwd, df, options, x_axis_groupby):
+def box_plotting_groups(cwd, df, options, x_axis_groupby, logger=logger):
     df_groups = df.groupby(list(set(DataFilterItems) - set(x_axis_groupby)))
-    with Pool(CORES) as p:
-        results = [p.apply_async(boxplot_group_for_parallel, (group, options, x_axis_groupby)) for group in df_groups]
-        for result in results:
-            result.get()
+    with stats_pool(cwd, options) as p:
+        results = [
+            p.apply_async(profiling.call, (boxplot_group_for_parallel, cwd, group, options, x_axis_groupby, logger))
+            for group in df_groups
+        ]
+        wait_results(results, options, f'BOXPLOT {"_".join(x_axis_groupby)}', logger)
 
 
-def boxplot_group_for_parallel(group, options, x_axis_groupby):
+def boxplot_group_for_parallel(cwd, group, options, x_axis_groupby, logger=logger):
     name = f'{"_".join(str(x) for x in group[0])}'
-    groups_plotting(name, group[1], options, x_axis_groupby[0], x_axis_groupby[1])
-    groups_plotting(name, group[1], options, x_axis_groupby[1], x_axis_groupby[0])
+    groups_plotting(cwd, name, group[1], options, x_axis_groupby[0], x_axis_groupby[1], logger)
+    groups_plotting(cwd, name, group[1], options, x_axis_groupby[1], x_axis_groupby[0], logger)
 
 
 def update_dict(stats, data_dict, type_of_data):
@@ -180,7 +211,7 @@ def update_dict(stats, data_dict, type_of_data):
     return new_dict
 
 
-def create_and_write_stats(df):
+def create_and_write_stats(df, cwd=os.curdir, logger=logger):
     df_groups = df.groupby(DataFilterItems)
     stats_results = {IDs.TIME: [], IDs.TIME_NPB: [], IDs.ENERGY: [], IDs.MOPS: []}
     for group in df_groups:
@@ -203,54 +234,68 @@ def create_and_write_stats(df):
             stats_dict['count'] = numpy.int(stats_dict['count'])
             stats_results[result].append(stats_dict)
     for result in ResultItems:
-        write_csv_list_of_dict(f'stats_{result}.csv', stats_results[result], logger, overwrite=True)
+        write_csv_list_of_dict(os.path.join(cwd, f'stats_{result}.csv'), stats_results[result], logger, overwrite=True)
 
     return stats_results
 
 
-def main():
-    options = parse_args(logger)
-    os.chdir(options.save_directory)
-    logger.addHandler(log_to_file('stats.log'))
-    cwd = os.getcwd()
+def make_stats(options, logger=logger):
+    """
+    Writes the stats and plots of 'options.data_file' in 'options.save_directory', the
+    working directory of the process is not changed
+    :param options: optparse.Values object, see 'parse_args'
+    :param logger: logger of the run, the plotting workers use it too
+    :return: dict of result to list of dict, the stats written
+    """
+    cwd = os.path.abspath(options.save_directory)
+    cprofile_directory = profiling.make_cprofile_directory('stats', cwd) if options.cprofile else None
 
     df = pd.read_csv(options.data_file)
     df = clean_data(df, options.skip_warm_up)
-    stats = create_and_write_stats(df)
+    with profiling.cprofiled('create_and_write_stats', cprofile_directory):
+        stats = create_and_write_stats(df, cwd, logger)
 
     if not options.only_stats:
-        box_plotting(cwd, df, options, x_axis_groupby=IDs.THREADS)
-        box_plotting(cwd, df, options, x_axis_groupby=IDs.OS)
-        box_plotting(cwd, df, options, x_axis_groupby=IDs.DEVICE)
-        box_plotting(cwd, df, options, x_axis_groupby=IDs.TYPE)
+        box_plotting(cwd, df, options, x_axis_groupby=IDs.THREADS, logger=logger)
+        box_plotting(cwd, df, options, x_axis_groupby=IDs.OS, logger=logger)
+        box_plotting(cwd, df, options, x_axis_groupby=IDs.DEVICE, logger=logger)
+        box_plotting(cwd, df, options, x_axis_groupby=IDs.TYPE, logger=logger)
         logger.info(f'[{options.data_file}]')
 
-        box_plotting_groups(cwd, df, options, [IDs.DEVICE, IDs.THREADS])
-        box_plotting_groups(cwd, df, options, [IDs.DEVICE, IDs.BENCH])
-        box_plotting_groups(cwd, df, options, [IDs.DEVICE, IDs.TYPE])
-        box_plotting_groups(cwd, df, options, [IDs.DEVICE, IDs.OS])
+        box_plotting_groups(cwd, df, options, [IDs.DEVICE, IDs.THREADS], logger)
+        box_plotting_groups(cwd, df, options, [IDs.DEVICE, IDs.BENCH], logger)
+        box_plotting_groups(cwd, df, options, [IDs.DEVICE, IDs.TYPE], logger)
+        box_plotting_groups(cwd, df, options, [IDs.DEVICE, IDs.OS], logger)
 
-        box_plotting_groups(cwd, df, options, [IDs.THREADS, IDs.BENCH])
-        box_plotting_groups(cwd, df, options, [IDs.THREADS, IDs.TYPE])
-        box_plotting_groups(cwd, df, options, [IDs.THREADS, IDs.OS])
+        box_plotting_groups(cwd, df, options, [IDs.THREADS, IDs.BENCH], logger)
+        box_plotting_groups(cwd, df, options, [IDs.THREADS, IDs.TYPE], logger)
+        box_plotting_groups(cwd, df, options, [IDs.THREADS, IDs.OS], logger)
 
-        box_plotting_groups(cwd, df, options, [IDs.BENCH, IDs.TYPE])
-        box_plotting_groups(cwd, df, options, [IDs.BENCH, IDs.OS])
+        box_plotting_groups(cwd, df, options, [IDs.BENCH, IDs.TYPE], logger)
+        box_plotting_groups(cwd, df, options, [IDs.BENCH, IDs.OS], logger)
 
-        box_plotting_groups(cwd, df, options, [IDs.TYPE, IDs.OS])
+        box_plotting_groups(cwd, df, options, [IDs.TYPE, IDs.OS], logger)
 
         for resultItem in ResultItems:
             pd_stats = pd.DataFrame(stats[resultItem])
-            cat_plotting(cwd, pd_stats, options, IDs.THREADS, resultItem)
-            cat_plotting_group(cwd, pd_stats, options, [IDs.THREADS, IDs.OS], resultItem)
-            cat_plotting_group(cwd, pd_stats, options, [IDs.THREADS, IDs.TYPE], resultItem)
+            cat_plotting(cwd, pd_stats, options, IDs.THREADS, resultItem, logger)
+            cat_plotting_group(cwd, pd_stats, options, [IDs.THREADS, IDs.OS], resultItem, logger)
+            cat_plotting_group(cwd, pd_stats, options, [IDs.THREADS, IDs.TYPE], resultItem, logger)
+    if cprofile_directory is not None:
+        profiling.merge_cprofiles(cprofile_directory, cprofile_directory, logger)
+    return stats
 
     # df = sns.load_dataset('tips')
     # sns.boxplot(x = "day", y = "total_bill", hue = "smoker", data = df, palette = "Set1")
 
 
+def main():
+    options = parse_args(logger)
+    logger.addHandler(log_to_file(os.path.join(options.save_directory, 'stats.log')))
+    make_stats(options)
+
+
 if __name__ == "__main__":
-    logger = logging.getLogger('STATS_CSV')
     pd.options.display.width = 0
     mem = []
     profile(mem, 'test', main,)
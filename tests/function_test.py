@@ -1,13 +1,47 @@
+import bz2
 import datetime
+import gzip
+import io
+import json
+import logging
+import logging.handlers
+import lzma
 import os
+import pstats
+import shutil
+import signal
+import threading
+import time
+from multiprocessing.pool import Pool
 from collections import OrderedDict
 from optparse import Values
 
+import numpy
 import pandas as pd
+import psutil
 import pytest
 
-from common import read_timestamp, csv_name_parsing, set_cores, IDs, DataFilterItems, sort_list_of_dict
+from catalog import Catalog, list_files, parse_name, is_power_csv
+from common import read_timestamp, csv_name_parsing, set_cores, IDs, DataFilterItems, sort_list_of_dict, \
+    TimestampParser, epoch_us_to_datetime, read_raw_rows, read_raw_columns, RawCsvStats, write_csv_sorted, \
+    write_csv_list_of_dict, default_options, open_input, strip_compression, write_csv_dict_with_lists, unique_inputs
 from custom_exceptions import UnsupportedNumberOfCores
+import data_csv_process
+from data_csv_process import data_file_process, ENGINE_PYTHON, ENGINE_NUMPY, data_file_energy, split_ranges, \
+    csv_range_process, csv_process_stream, EnergyIntegrator, get_files, CsvFollower, data_file_follow, \
+    data_file_split, PHASES, process_directory, PhaseIntegrator
+from trace_index import load_index, read_index, index_path
+from power_trace import plot_columns
+from manifest import Manifest, file_key
+import profiling
+from planner import plan, calibration_files, lpt_makespan
+from profiling import ProfileReport, stage
+from progress import Progress
+from scheduler import CostModel, run_scheduled, task_mode, limited_pool
+import trace_archive
+from trace_archive import csv_to_archive, archive_name, write_archive, TraceArchive, archive_file_process
+import metrics_log_process
+from metrics_log_process import parse_npb_log, scan_npb_log, count_lines, npb_log_ranges, metrics_file_split
 from merge import merge_pd, read_csv_to_dict, merge_on_intersect_dicts, merge_dicts, main_dicts_merge, main_merge_pd
 
 TEST_RESOURCES = 'tests/resources'
@@ -21,6 +55,10 @@ MT_METRICS_DATA_3 = 'mt_metrics_data_3.csv'
 MT_PROCESSED_DATA_3 = 'mt_processed_data_3.csv'
 CM_ON_INTERSECT_MERGE = 'cm_on_intersect_merge_data.csv'  # CM stands for Custom Merge
 CSV_TO_DICT = 'cm_read_csv_to_dict.csv'
+SMALL_FILE = '01_small_file.csv'
+DT_FILE = 'data_hikey970_linux_mg_b_4_001.csv'  # DT stands for 'data transform'
+ML_FILE = 'npb_hikey970_linux_mg_b_4.log'  # ML stands for 'metrics log'
+ML_METRICS_DATA = 'ml_metrics_data.csv'  # metrics_data.csv of ML_FILE
 
 
 # TODO use fixture to load and share test data [1]([)https://docs.pytest.org/en/latest/fixture.html#sharing-test-data)
@@ -31,6 +69,18 @@ def cleanup(request):
     os.remove(f'{request.config.rootdir}/{TEST_RESOURCES}/{MT_RESULT_CSV_FILE}')
 
 
+@pytest.fixture
+def dt_directory(request, tmp_path, monkeypatch):
+    """
+    Temporary working directory with a copy of the small power file named as
+    data_csv_process expects.
+    """
+    shutil.copy(f'{request.config.rootdir}/{TEST_RESOURCES}/{SMALL_FILE}', tmp_path / DT_FILE)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(data_csv_process, 'logger', logging.getLogger('TEST'), raising=False)
+    return tmp_path
+
+
 @pytest.mark.parametrize(
     "timestamp, ex_timestamp",
     [
@@ -56,6 +106,21 @@ def test_read_timestamp(timestamp, ex_timestamp):
     assert read_timestamp(timestamp) == ex_timestamp
 
 
+def test_timestamp_parser():
+    # Layouts are mixed on purpose, the parser must detect them again
+    timestamps = [
+        '2019/06/29-16:31:46.3383', '2019/06/29-16:31:46.3396', '2019/06/29-16:31:47.1', '2019/6/29-16:31:47.1',
+        '2019/06/29-16:31:60.0', '0:00:00.001600', '0:00:00', '12:5:7', '25:00:00', 'not a timestamp', ''
+    ]
+    parser = TimestampParser()
+    for timestamp in timestamps:
+        assert read_timestamp(timestamp) == parser.parse(timestamp)
+    epoch_us = TimestampParser().epoch_us_column(timestamps)
+    assert [read_timestamp(ts) for ts in timestamps] == [
+        None if us is None else epoch_us_to_datetime(us) for us in epoch_us
+    ]
+
+
 @pytest.mark.parametrize(
     "name, expected",
     [
@@ -165,6 +230,36 @@ def test_merge_dicts(request):
     assert expected == result
 
 
+def test_merge_on_intersect_dicts_first_match():
+    data = [
+        {'benchmark': 'mg', 'iteration': '1', 'energy': '10'},
+        {'benchmark': 'mg', 'iteration': '1', 'energy': '11'},
+        {'benchmark': 'ep', 'iteration': '1', 'energy': '12'},
+    ]
+    metrics = [
+        {'iteration': '1', 'benchmark': 'mg', 'mops': '1'},
+        {'iteration': '1', 'benchmark': 'is', 'mops': '2'},
+        {'iteration': '1', 'benchmark': 'mg', 'mops': '3'},
+        {'iteration': '1', 'benchmark': 'mg', 'mops': '4'},
+    ]
+    result = merge_on_intersect_dicts(data=data, metrics=metrics)
+    assert [(row['mops'], row['energy']) for row in result] == [('1', '10'), ('3', '11')]
+    assert list(result[0]) == ['iteration', 'benchmark', 'mops', 'energy']
+    # The merged rows are removed, the rows that do not match are left in order
+    assert [row['energy'] for row in data] == ['12']
+    assert [row['mops'] for row in metrics] == ['2', '4']
+
+
+def test_merge_dicts_no_match(tmp_path):
+    data, metrics = tmp_path / 'data.csv', tmp_path / 'metrics.csv'
+    data.write_text('type,device,os,benchmark,size,threads,iteration,joules\n,hikey970,linux,mg,b,4,001,10\n')
+    metrics.write_text('type,device,os,benchmark,size,threads,iteration,mops\n,hikey970,linux,ep,b,4,001,3\n')
+    result = merge_dicts(data=str(data), metrics=str(metrics))
+    keys = DataFilterItems + [IDs.ITERATION, 'mops', 'joules']
+    assert [list(row) for row in result] == [keys] * 2
+    assert [(row[IDs.BENCH], row['mops'], row['joules']) for row in result] == [('ep', '3', ''), ('mg', '', '10')]
+
+
 def test_main_dicts_merge(request):
     null, expected = read_csv_to_dict(f'{request.config.rootdir}/{TEST_RESOURCES}/{MT_MERGE}')
     sort_list_of_dict(expected)
@@ -213,3 +308,933 @@ def test_main_merge_pd_ws_type(request, cleanup):
     result.reset_index(drop=True, inplace=True)
     result = result.round(decimals=3)
     assert expected.equals(result)
+
+
+@pytest.mark.parametrize("engine", [ENGINE_PYTHON, ENGINE_NUMPY])
+def test_data_file_process(dt_directory, engine):
+    expected = {
+        IDs.TYPE: 'default', IDs.DEVICE: 'hikey970', IDs.OS: 'linux', IDs.BENCH: 'mg', IDs.SIZE: 'b',
+        IDs.THREADS: '4', IDs.ITERATION: '001', IDs.ENERGY: 0.052979596, IDs.TIME: 0.0091
+    }
+    assert expected == data_file_process(str(dt_directory), DT_FILE, engine)
+    assert os.access(f'power_plot_{DT_FILE}.png', os.F_OK)
+
+
+def test_data_file_process_engines_transformed(dt_directory):
+    data_file_process(str(dt_directory), DT_FILE, ENGINE_PYTHON)
+    with open(f'transformed-{DT_FILE}') as f:
+        expected = f.read()
+    os.remove(f'transformed-{DT_FILE}')
+    data_file_process(str(dt_directory), DT_FILE, ENGINE_NUMPY)
+    with open(f'transformed-{DT_FILE}') as f:
+        assert expected == f.read()
+
+
+def test_plot_columns():
+    n = 100003
+    ts = numpy.arange(n, dtype=numpy.int64) * 1300 + 1562147255000000
+    mw = numpy.random.default_rng(0).uniform(2000, 4000, n)
+    mw[77777] = 9000
+    marks = [(10, 'XS'), (50001, 'XF')]
+    td_dt_00, plot_mw, plot_marks = plot_columns(ts, mw, marks, ts[0], max_points=1000)
+    assert len(td_dt_00) == len(plot_mw) <= 1000 + 2 + 2 + len(marks)
+    # The same envelope, ends and mark times as with all the samples
+    expected_td, _, _ = plot_columns(ts, mw, marks, ts[0], max_points=n)
+    assert (plot_mw.min(), plot_mw.max()) == (mw.min(), 9000)
+    assert (expected_td[0], expected_td[-1]) == (td_dt_00[0], td_dt_00[-1])
+    assert [(expected_td[p], op) for p, op in marks] == [(td_dt_00[p], op) for p, op in plot_marks]
+    assert numpy.all(numpy.diff(td_dt_00) > numpy.timedelta64(0))
+
+
+def test_write_csv_dict_with_lists(tmp_path):
+    write_csv_dict_with_lists(tmp_path / 'columns.csv', {'a': [1, 2], 'b': iter([3.5, 4.5]), 'time_xs': []})
+    assert ['a,b,time_xs', '1,3.5,', '2,4.5,'] == (tmp_path / 'columns.csv').read_text().splitlines()
+
+
+def test_data_file_energy(dt_directory):
+    expected = data_file_process(str(dt_directory), DT_FILE)
+    os.remove(f'power_plot_{DT_FILE}.png')
+    os.remove(f'transformed-{DT_FILE}')
+    assert expected == data_file_energy(str(dt_directory), DT_FILE)
+    assert not os.access(f'power_plot_{DT_FILE}.png', os.F_OK)
+    assert not os.access(f'transformed-{DT_FILE}', os.F_OK)
+
+
+@pytest.mark.parametrize("parts", [1, 2, 3, 5, 40])
+def test_csv_range_process(dt_directory, parts):
+    with open(DT_FILE, 'rb') as f:
+        expected = csv_process_stream(read_raw_rows(f))
+    ranges = split_ranges(DT_FILE, parts)
+    assert len(ranges) <= parts
+    result = EnergyIntegrator()
+    for start, end in ranges:
+        result.feed_range(csv_range_process(DT_FILE, start, end))
+    assert (expected.samples, expected.ts_start, expected.ts_finish, expected.seconds()) == \
+           (result.samples, result.ts_start, result.ts_finish, result.seconds())
+    # Ranges are summed apart, floating point rounding may differ from the sequential sum
+    assert expected.joules() == pytest.approx(result.joules(), rel=1e-12)
+
+
+def test_data_file_split_manifest(dt_directory):
+    with Pool(2) as p:
+        split = data_file_split(str(dt_directory), DT_FILE, p, 3)
+        # Appended once the ranges are submitted, the rows of the file miss this part
+        with open(DT_FILE, 'ab') as f:
+            f.write(b'2019/07/03-09:47:35.9999,2377.21,\n')
+        row = split.get()
+        assert 0 < split.seconds
+        with Manifest('transform') as manifest:
+            manifest.record(DT_FILE, [row], split.key)
+            assert [DT_FILE] == get_files(None, manifest)
+        options = default_options(data_csv_process.add_options, cores=1, split_size=0)
+        data_csv_process.process_directory(str(dt_directory), options, pool=p)
+    with Manifest('transform') as manifest:
+        assert [] == get_files(None, manifest)
+        history = CostModel(manifest.connection, 'transform', 'data_file_split/1/False').history
+    assert [DT_FILE] == list(history)
+    size, rows, seconds, _ = history[DT_FILE]
+    assert (os.path.getsize(DT_FILE), split.samples + 1) == (size, rows) and 0 < seconds
+
+
+def test_read_raw_rows():
+    raw = b'Time,Power(mWatt),Operation\n' \
+          b'2019/07/03-09:47:35.9210,2371.61,\n' \
+          b'2019/07/03-09:47:35.92\x00\x00\x002019/07/03-09:47:35.9233,2371.61,XS\n' \
+          b'\x00\x00\x00\n' \
+          b'2019/07/03-09:47:35.9\x00\x00\x0023,2371.61,XS\n' \
+          b'\x00\x009:47:35.9240,2371.61,\n' \
+          b'\x002019/13/03-09:47:35.9245,2371.61,\n' \
+          b'2019/07/03-09:47:35.9247,2377.21,\r\n' \
+          b'2019/07/03-09:47:35.9250,23'
+    expected = [
+        ('2019/07/03-09:47:35.9210', '2371.61', ''),
+        ('2019/07/03-09:47:35.9233', '2371.61', 'XS'),
+        ('2019/07/03-09:47:35.9247', '2377.21', '')
+    ]
+    # Small blocks to split rows between reads
+    for block_size in [5, 1024]:
+        stats = RawCsvStats()
+        assert expected == list(read_raw_rows(io.BytesIO(raw), stats, block_size=block_size))
+        # Torn rows that look like rows: the end of a timestamp, a timestamp without its date
+        # and a timestamp that is not valid
+        assert (6, 1) == (stats.dropped, stats.repaired)
+
+
+def test_read_raw_columns(dt_phases):
+    with open(DT_FILE, 'rb') as f:
+        lines = f.readlines()
+    # Damaged lines among the clean ones, a CRLF row and a torn last row
+    lines.insert(5, b'2019/07/03-09:47:35.9\x00\x00\x0023,1234,\n')
+    lines.insert(9, b'2019/07/03-09:47:35.9245,2371.61;\n')
+    lines[12] = lines[12].replace(b'\n', b'\r\n')
+    raw = b''.join(lines) + b'2019/07/03-09:47:35.9250,23'
+    stats = RawCsvStats()
+    rows = list(read_raw_rows(io.BytesIO(raw), stats))
+    parser = TimestampParser()
+    expected = (
+        [row[0].encode() for row in rows], parser.epoch_us_column([row[0] for row in rows]),
+        [float(row[1]) for row in rows], [(i, row[2]) for i, row in enumerate(rows) if row[2] != '']
+    )
+    integrator = PhaseIntegrator()
+    for row in rows:
+        integrator.feed(parser.epoch_us(row[0]), float(row[1]), row[2])
+    # Blocks of one line, of clean lines only and of all the file
+    for block_size in [1, 64, 300, 1024 * 1024]:
+        blocks_stats = RawCsvStats()
+        blocks = list(read_raw_columns(io.BytesIO(raw), blocks_stats, block_size=block_size))
+        offsets = numpy.cumsum([0] + [len(block[1]) for block in blocks])
+        assert expected == (
+            numpy.concatenate([block[0] for block in blocks]).tolist(),
+            numpy.concatenate([block[1] for block in blocks]).tolist(),
+            numpy.concatenate([block[2] for block in blocks]).tolist(),
+            [(offset + i, op) for offset, block in zip(offsets, blocks) for i, op in block[3]]
+        )
+        assert (stats.dropped, stats.repaired) == (blocks_stats.dropped, blocks_stats.repaired)
+        columns = PhaseIntegrator()
+        for _, ts, mw, marks in blocks:
+            columns.feed_columns(ts, mw, marks)
+        assert integrator.columns() == columns.columns()
+        assert (integrator.energy, integrator.time_us, integrator.samples) == \
+               (columns.energy, columns.time_us, columns.samples)
+    with pytest.raises(ValueError):
+        list(read_raw_rows(io.BytesIO(b'Power(mWatt),Time,Operation\n2371.61,2019/07/03-09:47:35.9210,\n')))
+
+
+def test_data_file_process_damaged(dt_directory):
+    with open(DT_FILE, 'rb') as f:
+        lines = f.readlines()
+    lines.insert(5, b'2019/07/03-09:47:35.9\x00\x00\x0023,1234,\n')
+    with open(DT_FILE, 'wb') as f:
+        f.writelines(lines)
+    expected = data_file_energy(str(dt_directory), DT_FILE)
+    assert expected[IDs.ENERGY] != ''
+    for engine in [ENGINE_PYTHON, ENGINE_NUMPY]:
+        assert expected == data_file_process(str(dt_directory), DT_FILE, engine)
+
+
+def test_data_file_energy_index_damaged(dt_directory):
+    with open(DT_FILE, 'rb') as f:
+        lines = f.readlines()
+    # The XS row is recovered from a damaged line
+    lines[7] = b'2019/07/03-09:47:35.92\x00\x00\x00' + lines[7]
+    with open(DT_FILE, 'wb') as f:
+        f.writelines(lines)
+    expected = data_file_energy(str(dt_directory), DT_FILE)
+    assert expected[IDs.ENERGY] != ''
+    assert expected == data_file_energy(str(dt_directory), DT_FILE, use_index=True)
+    assert ['XS', 'XF'] == [mark[0] for mark in read_index(DT_FILE).marks]
+
+
+def test_is_power_csv():
+    files = [DT_FILE, f'{DT_FILE}.gz', f'transformed-{DT_FILE}', archive_name(DT_FILE), 'processed_data.csv',
+             'metrics_data.csv', 'merge_data.csv', 'plan-transform.csv', 'profile-transform.csv']
+    assert [DT_FILE, f'{DT_FILE}.gz'] == [file for file in files if is_power_csv(file)]
+
+
+def test_data_file_process_read_only(dt_directory):
+    with open(DT_FILE, 'rb') as f:
+        expected = f.read()
+    data_file_process(str(dt_directory), DT_FILE)
+    with open(DT_FILE, 'rb') as f:
+        assert expected == f.read()
+
+
+def test_data_file_energy_index(dt_directory):
+    expected = data_file_energy(str(dt_directory), DT_FILE)
+    assert expected == data_file_energy(str(dt_directory), DT_FILE, use_index=True)
+    index = read_index(DT_FILE)
+    assert ['XS', 'XF'] == [mark[0] for mark in index.marks]
+    assert index.offset_at(index.seconds[0][0]) == index.seconds[0][1]
+    # Any change in the file invalidates the index
+    with open(DT_FILE, 'ab') as f:
+        f.write(b'5,2377.21,\n')
+    assert read_index(DT_FILE) is None
+    assert index.to_dict() != load_index(DT_FILE).to_dict()
+    assert os.access(index_path(DT_FILE), os.F_OK)
+
+
+def test_trace_archive(dt_directory):
+    with open(DT_FILE, 'rb') as f:
+        rows = list(read_raw_rows(f))
+    parser = TimestampParser()
+    ts = [parser.epoch_us(row[0]) for row in rows]
+    csv_to_archive(DT_FILE)
+    with TraceArchive(archive_name(DT_FILE)) as archive:
+        assert len(rows) == len(archive)
+        assert ts == archive.read()[0].tolist()
+        assert [float(row[1]) for row in rows] == pytest.approx(archive.read()[1].tolist())
+        assert [(p, row[2]) for p, row in enumerate(rows) if row[2]] == [m[:2] for m in archive.marks]
+        assert ts[6:16] == archive.mark_range('XS', 'XF')[0].tolist()
+        assert ts[3:9] == archive.time_range(ts[3], ts[9])[0].tolist()
+        assert ts[2:5] == archive.read(2, 5)[0].tolist()
+
+
+def test_trace_archive_blocks(dt_directory):
+    with open(DT_FILE, 'rb') as f:
+        write_archive('blocks.pta', read_raw_rows(f), block_rows=4)
+    csv_to_archive(DT_FILE)
+    with TraceArchive('blocks.pta') as archive, TraceArchive(archive_name(DT_FILE)) as expected:
+        assert 8 == len(archive.blocks)
+        for start, stop in [(0, None), (3, 13), (4, 8), (7, 7), (29, 40)]:
+            assert expected.read(start, stop)[0].tolist() == archive.read(start, stop)[0].tolist()
+        ts = expected.read()[0]
+        assert ts[5:23].tolist() == archive.time_range(ts[5], ts[23])[0].tolist()
+
+
+def test_archive_file_process(dt_directory):
+    empty, other = DT_FILE.replace('001', '002'), DT_FILE.replace('001', '003')
+    with open(empty, 'w') as f:
+        f.write('Time,Power(mWatt),Operation\n')
+    with open(other, 'w') as f:
+        f.write('a,b\n1,2\n')
+    for output in ['processed_data.csv', 'merge_data.csv', f'transformed-{DT_FILE}']:
+        with open(output, 'w') as f:
+            f.write('a,b\n1,2\n')
+    assert sorted([DT_FILE, empty, other]) == sorted(trace_archive.get_files(None, str(dt_directory)))
+    assert 29 == archive_file_process(str(dt_directory), DT_FILE, False)
+    assert not os.access(DT_FILE, os.F_OK) and os.access(archive_name(DT_FILE), os.F_OK)
+    # Not archived, the csv is kept
+    assert 0 == archive_file_process(str(dt_directory), empty, False)
+    with pytest.raises(ValueError):
+        archive_file_process(str(dt_directory), other, False)
+    for file in [empty, other]:
+        assert os.access(file, os.F_OK) and not os.access(archive_name(file), os.F_OK)
+    # The outputs are not inputs of data_csv_process either, the archive is skipped because
+    # the transformed file marks its csv as processed
+    assert sorted([empty, other]) == sorted(get_files(None))
+
+
+def test_data_file_process_archive(dt_directory):
+    expected = data_file_process(str(dt_directory), DT_FILE)
+    csv_to_archive(DT_FILE)
+    os.remove(f'transformed-{DT_FILE}')
+    assert [archive_name(DT_FILE)] == get_files(None)
+    result = data_file_process(str(dt_directory), archive_name(DT_FILE))
+    assert expected[IDs.TIME] == result[IDs.TIME]
+    # Power is archived as float32
+    assert expected[IDs.ENERGY] == pytest.approx(result[IDs.ENERGY], rel=1e-6)
+    assert os.access(f'power_plot_{archive_name(DT_FILE)}.png', os.F_OK)
+    with Manifest('transform') as manifest:
+        manifest.record(archive_name(DT_FILE), [result])
+        assert [] == get_files(None, manifest)
+
+
+def test_data_file_follow(dt_directory):
+    expected = data_file_energy(str(dt_directory), DT_FILE)
+    with open(DT_FILE, 'rb') as f:
+        raw = f.read()
+    # Write the file in pieces that split the header and rows, as the acquisition may leave it
+    follower = CsvFollower(DT_FILE, block_size=16)
+    written = 0
+    with open(DT_FILE, 'wb') as f:
+        for cut in [10, 50, 120, 370, 371, len(raw) - 20, len(raw)]:
+            f.write(raw[written:cut])
+            f.flush()
+            written = cut
+            follower.poll()
+            assert follower.offset == raw.rfind(b'\n', 0, cut) + 1
+    assert follower.integrator.complete()
+    assert expected[IDs.ENERGY] == follower.integrator.joules()
+    assert expected[IDs.TIME] == follower.integrator.seconds()
+    assert 1 == follower.stats.dropped
+    assert expected == data_file_follow(str(dt_directory), DT_FILE, interval=0, timeout=0)
+
+
+def test_data_file_follow_timeout(dt_directory):
+    with open(DT_FILE, 'rb') as f:
+        raw = f.read()
+    with open(DT_FILE, 'wb') as f:
+        f.write(raw[:raw.index(b'XF')])
+    assert data_file_follow(str(dt_directory), DT_FILE, interval=0, timeout=0) is None
+    assert not os.access(f'transformed-{DT_FILE}', os.F_OK)
+
+
+def test_process_directory_follow(dt_directory):
+    with open(DT_FILE, 'rb') as f:
+        raw = f.read()
+    with open(DT_FILE, 'wb') as f:
+        f.write(raw[:raw.index(b'XF')])
+    new_file = DT_FILE.replace('_001.csv', '_002.csv')
+    options = default_options(data_csv_process.add_options, cores=1, follow=True, follow_interval=0.1,
+                              follow_timeout=3)
+    run = threading.Thread(target=process_directory, args=(str(dt_directory), options))
+    run.start()
+    # A file that appears while the other one is followed, then the followed one is completed
+    time.sleep(1)
+    with open(new_file, 'wb') as f:
+        f.write(raw)
+    time.sleep(1)
+    with open(DT_FILE, 'wb') as f:
+        f.write(raw)
+    run.join()
+    _, rows = read_csv_to_dict('processed_data.csv')
+    assert ['001', '002'] == sorted(row[IDs.ITERATION] for row in rows)
+    # Recorded as it was when its following ended, not when it started
+    with Manifest('transform') as manifest:
+        assert [] == get_files(None, manifest)
+
+
+@pytest.fixture
+def dt_phases(dt_directory):
+    """
+    The small power file with AS/AF and BS/BF marks before XS
+    """
+    with open(DT_FILE, 'rb') as f:
+        lines = f.read().split(b'\n')
+    for line, op in [(1, b'AS'), (3, b'AF'), (4, b'BS'), (6, b'BF')]:
+        lines[line] += op
+    with open(DT_FILE, 'wb') as f:
+        f.write(b'\n'.join(lines))
+    return dt_directory
+
+
+def test_data_file_phases(dt_phases):
+    expected = {}
+    for phase, (start, finish) in PHASES.items():
+        with open(DT_FILE, 'rb') as f:
+            integrator = csv_process_stream(read_raw_rows(f), EnergyIntegrator(start, finish))
+        expected[f'{phase}_joules'], expected[f'{phase}_time'] = integrator.joules(), integrator.seconds()
+        expected[f'{phase}_watts'] = integrator.joules() / integrator.seconds()
+    assert 0 < expected['a_joules'] and 0 < expected['b_joules']
+    expected.update(data_file_process(str(dt_phases), DT_FILE))
+    expected['watts'] = expected[IDs.ENERGY] / expected[IDs.TIME]
+
+    def process(function, *args):
+        return function(str(dt_phases), DT_FILE, *args)
+
+    assert expected == process(data_file_process, ENGINE_PYTHON, True)
+    assert expected == process(data_file_process, ENGINE_NUMPY, True)
+    assert expected == process(data_file_energy, False, True)
+    assert expected == process(data_file_energy, True, True)
+    assert expected == process(data_file_follow, 0, 0, True)
+    with Pool(2) as p:
+        result = process(data_file_split, p, 3, True).get()
+    assert expected == pytest.approx(result, rel=1e-12)
+    csv_to_archive(DT_FILE)
+    result = data_file_process(str(dt_phases), archive_name(DT_FILE), ENGINE_PYTHON, True)
+    assert expected == pytest.approx(result, rel=1e-6)
+
+
+def test_data_file_phases_not_found(dt_directory):
+    result = data_file_energy(str(dt_directory), DT_FILE, False, True)
+    for phase in PHASES:
+        assert ('', '', '') == (result[f'{phase}_joules'], result[f'{phase}_time'], result[f'{phase}_watts'])
+    assert result[IDs.ENERGY] / result[IDs.TIME] == result['watts']
+
+
+def test_manifest(dt_directory):
+    logger = logging.getLogger('TEST')
+    row = data_file_energy(str(dt_directory), DT_FILE)
+    with Manifest('transform') as manifest:
+        assert [DT_FILE] == get_files(None, manifest)
+        manifest.record(DT_FILE, [row])
+        assert [] == get_files(None, manifest)
+        assert 1 == manifest.export('processed_data.csv', logger)
+        assert 0 == manifest.export('processed_data.csv', logger)
+    # Same content, only mtime changed
+    os.utime(DT_FILE, ns=(0, 0))
+    with Manifest('transform') as manifest:
+        assert [] == get_files(None, manifest)
+        # Changed content, the exported row is replaced
+        with open(DT_FILE, 'ab') as f:
+            f.write(b'2019/07/03-09:47:35.9999,2377.21,\n')
+        assert [DT_FILE] == get_files(None, manifest)
+        manifest.record(DT_FILE, [dict(row, joules=1.0)])
+        assert 1 == manifest.export('processed_data.csv', logger)
+    _, data = read_csv_to_dict('processed_data.csv')
+    assert ['1.0'] == [d[IDs.ENERGY] for d in data]
+    # Files processed before the manifest are skipped, other pipelines are apart
+    open(f'transformed-{DT_FILE}', 'w').close()
+    with Manifest('other') as manifest:
+        assert [] == get_files(None, manifest)
+        assert not manifest.known(DT_FILE)
+
+
+def appending_task(cwd, file):
+    result = data_file_energy(cwd, file)
+    with open(os.path.join(cwd, file), 'ab') as f:
+        f.write(b'2019/07/03-09:47:35.9999,2377.21,\n')
+    return result
+
+
+def test_run_scheduled_changed(dt_directory, caplog):
+    logger = logging.getLogger('TEST')
+    small = DT_FILE.replace('001', '002')
+    shutil.copy(DT_FILE, small)
+    key = file_key(DT_FILE)
+    tasks = [(appending_task, str(dt_directory), DT_FILE), (data_file_energy, str(dt_directory), small)]
+    with Manifest('transform') as manifest, Pool(1) as p:
+        model = CostModel(manifest.connection, 'transform', task_mode(tasks[0]))
+        with caplog.at_level(logging.WARNING):
+            keys = {}
+            for file, keys[file], result in run_scheduled(p, tasks, model, 1, logger, manifest):
+                manifest.record(file, [result], keys[file])
+        # The key of the content read is recorded, the rows appended meanwhile are processed later
+        assert (*key[:2], None) == keys[DT_FILE]
+        assert f'[{DT_FILE}][Changed while processed' in caplog.text
+        assert [DT_FILE] == get_files(None, manifest)
+        # The files are not hashed, only a change of size or mtime is seen
+        assert (*file_key(small)[:2], None) == keys[small]
+        assert not manifest.pending(small)
+        os.utime(small, ns=(0, 0))
+        assert manifest.pending(small)
+
+
+def test_manifest_phases(dt_directory):
+    logger = logging.getLogger('TEST')
+    small = DT_FILE.replace('001', '002')
+    shutil.copy(DT_FILE, small)
+    with Manifest('transform') as manifest:
+        for file in (DT_FILE, small):
+            manifest.record(file, [data_file_energy(str(dt_directory), file)])
+        assert 2 == manifest.export('processed_data.csv', logger)
+    # Later run with '--phases' of a changed file, its row has more columns
+    with open(small, 'ab') as f:
+        f.write(b'2019/07/03-09:47:35.9999,2377.21,\n')
+    row = data_file_energy(str(dt_directory), small, False, True)
+    with Manifest('transform') as manifest:
+        assert [small] == get_files(None, manifest)
+        manifest.record(small, [row])
+        assert 1 == manifest.export('processed_data.csv', logger)
+    header, data = read_csv_to_dict('processed_data.csv')
+    assert list(row.keys()) == header
+    assert 2 == len(data)
+    assert [str(row['watts'])] == [d['watts'] for d in data if d['watts']]
+
+
+def test_run_scheduled(dt_directory, caplog):
+    small = DT_FILE.replace('001', '002')
+    with open(DT_FILE, 'rb') as f:
+        lines = f.readlines()
+    with open(small, 'wb') as f:
+        f.writelines(lines[:20])
+    logger = logging.getLogger('TEST')
+    tasks = [(data_file_energy, str(dt_directory), file) for file in [small, DT_FILE]]
+    with Manifest('transform') as manifest, Pool(2) as p:
+        model = CostModel(manifest.connection, 'transform', task_mode(tasks[0]))
+        # No history, files are sorted by size
+        assert os.path.getsize(DT_FILE) == model.predict(DT_FILE)
+        progress = Progress(logger, 2, os.path.getsize(small) + os.path.getsize(DT_FILE), 2, interval=0)
+        with caplog.at_level(logging.INFO):
+            results = {file: result for file, _, result in run_scheduled(p, tasks, model, 2, logger,
+                                                                         progress=progress)}
+            progress.finish()
+        assert data_file_energy(str(dt_directory), DT_FILE) == results[DT_FILE]
+        assert '[MAKESPAN][2 tasks]' in caplog.text
+        assert '[PROGRESS][2/2 files]' in caplog.text
+        assert 0 == progress.sample()['eta']
+        assert 1 <= len(progress.busy) <= 2
+        model = CostModel(manifest.connection, 'transform', task_mode(tasks[0]))
+        assert {small, DT_FILE} == set(model.history)
+        assert 29 == model.history[DT_FILE][1]
+        # Another mode has its own history
+        assert {} == CostModel(manifest.connection, 'transform', 'other').history
+        # Predictions from a fixed history: 1000 bytes per second, 0.1 rows per byte and the
+        # median of 0.01 and 0.02 plot seconds per row
+        model = CostModel(manifest.connection, 'transform', 'seeded')
+        for name, size, rows, seconds, plot_seconds in [('a', 1000, 100, 2.0, 1.0), ('b', 3000, 300, 9.0, 6.0)]:
+            with open(name, 'wb') as f:
+                f.write(b'x' * size)
+            model.record(name, {'size': size, 'rows': rows, 'seconds': seconds, 'plot_seconds': plot_seconds})
+        with open('a', 'ab') as f:
+            f.write(b'x' * 1000)
+        with open('c', 'wb') as f:
+            f.write(b'x' * 2000)
+        model = CostModel(manifest.connection, 'transform', 'seeded')
+        # Known files scale their last time by size, new ones use the medians
+        assert 4.0 == pytest.approx(model.predict('a'))
+        assert 9.0 == pytest.approx(model.predict('b'))
+        assert 2.0 + 2000 * 0.1 * 0.015 == pytest.approx(model.predict('c'))
+
+
+def test_plan(dt_directory, caplog):
+    small = DT_FILE.replace('001', '002')
+    with open(DT_FILE, 'rb') as f:
+        lines = f.readlines()
+    with open(small, 'wb') as f:
+        f.writelines(lines[:20])
+    logger = logging.getLogger('TEST')
+    tasks = [(data_file_process, str(dt_directory), file, ENGINE_PYTHON) for file in [DT_FILE, small]]
+    assert [small] == calibration_files([DT_FILE, small], sample_mb=0)
+    files = set(os.listdir(dt_directory))
+    with caplog.at_level(logging.INFO):
+        rows = plan('test', tasks, 2, logger, max_memory=1)
+    # The calibration does not leave outputs of the files
+    assert files | {'plan-test.csv'} == set(os.listdir(dt_directory))
+    assert [DT_FILE, small] == [row['file'] for row in rows]
+    assert 29 == pytest.approx(rows[0]['rows'], abs=3)
+    assert all(row['seconds'] > 0 and row['over_budget'] for row in rows)
+    assert '[PLAN][CORES 2][CHOSEN]' in caplog.text
+    assert f'[PLAN][OVER BUDGET][{DT_FILE}]' in caplog.text
+    _, saved = read_csv_to_dict('plan-test.csv')
+    assert 2 == len(saved)
+    assert 7 == lpt_makespan([2, 3, 2, 3, 2], 2)
+    assert 3 == lpt_makespan([2, 3, 2, 3, 2], 8)
+
+
+def test_compressed_input(dt_directory):
+    with open(DT_FILE, 'rb') as f:
+        content = f.read()
+    expected = data_file_process(str(dt_directory), DT_FILE, ENGINE_PYTHON)
+    with open(f'transformed-{DT_FILE}') as f:
+        transformed = f.read()
+    os.remove(DT_FILE)
+    for module, suffix in [(gzip, '.gz'), (lzma, '.xz'), (bz2, '.bz2')]:
+        name = DT_FILE + suffix
+        with module.open(name, 'wb') as f:
+            f.write(content)
+        assert csv_name_parsing(DT_FILE) == csv_name_parsing(name)
+        assert DT_FILE == strip_compression(name)
+        assert 'csv' == parse_name(name)['suffix']
+        with open_input(name) as f:
+            assert content == f.read()
+        # The transformed file of the csv marks its compressed copy as processed
+        assert [] == get_files(None)
+        os.remove(f'transformed-{DT_FILE}')
+        assert [name] == get_files(None)
+        for engine in [ENGINE_PYTHON, ENGINE_NUMPY]:
+            assert expected == data_file_process(str(dt_directory), name, engine)
+        with open(f'transformed-{DT_FILE}') as f:
+            assert transformed == f.read()
+        # The index is not used with compressed files, they are read whole
+        energy = data_file_energy(str(dt_directory), name, use_index=True)[IDs.ENERGY]
+        assert expected[IDs.ENERGY] == pytest.approx(energy)
+        os.remove(name)
+    # The plain csv is processed instead of its compressed copy
+    with open(DT_FILE, 'wb') as f:
+        f.write(content)
+    with gzip.open(DT_FILE + '.gz', 'wb') as f:
+        f.write(content)
+    os.remove(f'transformed-{DT_FILE}')
+    assert [DT_FILE] == get_files(None)
+    # An archive made from a compressed csv is named after the csv
+    assert archive_name(DT_FILE) == archive_name(DT_FILE + '.gz')
+    csv_to_archive(DT_FILE + '.gz')
+    with TraceArchive(archive_name(DT_FILE)) as archive:
+        assert 29 == archive.rows
+
+
+def gzip_in_place(path):
+    with open(path, 'rb') as f, gzip.open(f'{path}.gz', 'wb') as compressed:
+        shutil.copyfileobj(f, compressed)
+    os.remove(path)
+
+
+def test_compressed_after_processing(request, tmp_path):
+    shutil.copy(f'{request.config.rootdir}/{TEST_RESOURCES}/{SMALL_FILE}', tmp_path / DT_FILE)
+    shutil.copy(f'{request.config.rootdir}/{TEST_RESOURCES}/{ML_FILE}', tmp_path)
+    # A csv processed energy only has no 'transformed-' file, only the manifest knows it
+    options = default_options(data_csv_process.add_options, cores=1, energy_only=True)
+    process_directory(str(tmp_path), options)
+    gzip_in_place(tmp_path / DT_FILE)
+    with Manifest('transform', directory=str(tmp_path)) as manifest:
+        assert [] == get_files(None, manifest, str(tmp_path))
+    process_directory(str(tmp_path), options)
+    _, data = read_csv_to_dict(str(tmp_path / 'processed_data.csv'))
+    assert 1 == len(data)
+    options = default_options(metrics_log_process.add_options, cores=1)
+    metrics_log_process.process_directory(str(tmp_path), options)
+    expected = (tmp_path / 'metrics_data.csv').read_text()
+    gzip_in_place(tmp_path / ML_FILE)
+    metrics_log_process.process_directory(str(tmp_path), options)
+    assert expected == (tmp_path / 'metrics_data.csv').read_text()
+    # Compressed copies of an input are one input, the plain file if it is there
+    shutil.copy(tmp_path / f'{ML_FILE}.gz', tmp_path / f'{ML_FILE[:-4]}_2.log.gz')
+    with lzma.open(tmp_path / f'{ML_FILE[:-4]}_2.log.xz', 'wb') as f:
+        f.write(b'')
+    name = f'{ML_FILE[:-4]}_2'
+    assert [f'{name}.log.gz'] == metrics_log_process.get_files(name, directory=str(tmp_path))
+    (tmp_path / f'{name}.log').write_text('')
+    assert [f'{name}.log'] == metrics_log_process.get_files(name, directory=str(tmp_path))
+    assert ['a.csv', 'b.csv.bz2', 'c.log'] == unique_inputs(['c.log.gz', 'b.csv.gz', 'c.log', 'b.csv.bz2', 'a.csv'])
+
+
+def test_metrics_file_process(request, tmp_path):
+    shutil.copy(f'{request.config.rootdir}/{TEST_RESOURCES}/{ML_FILE}', tmp_path)
+    metrics_log_process.process_directory(str(tmp_path), default_options(metrics_log_process.add_options, cores=1))
+    with open(tmp_path / 'metrics_data.csv') as f:
+        data = f.read()
+    with open(f'{request.config.rootdir}/{TEST_RESOURCES}/{ML_METRICS_DATA}') as f:
+        assert f.read() == data
+    # Records are yielded as soon as their block is closed
+    read = []
+
+    def lines():
+        with open(tmp_path / ML_FILE) as f:
+            for line in f:
+                read.append(line)
+                yield line
+
+    # The scan of the lines needed finds the same records, with new lines of any kind
+    expected = metrics_log_process.metrics_file_process(str(tmp_path), ML_FILE, scan=False)
+    assert expected == metrics_log_process.metrics_file_process(str(tmp_path), ML_FILE)
+    name_parsed = dict(csv_name_parsing(ML_FILE), size=None)
+    with open(tmp_path / ML_FILE, 'rb') as f:
+        content = f.read()
+    assert expected == list(parse_npb_log(scan_npb_log(content.replace(b'\n', b'\r\n')), name_parsed))
+    assert content.count(b'\n') == count_lines(content) == count_lines(content + b'Run: 5') - 1
+    with open(tmp_path / ML_FILE, 'wb') as f:
+        f.write(content.replace(b'\n', b'\r'))
+    assert expected == metrics_log_process.metrics_file_process(str(tmp_path), ML_FILE)
+    with open(tmp_path / ML_FILE, 'wb') as f:
+        f.write(content)
+    records = parse_npb_log(lines(), name_parsed)
+    first = next(records)
+    assert 'Size: B' in read[-1]
+    assert {'iteration': '001', 'size': 'a', 'time_npb': 1.53, 'mops': 653.59}.items() <= first.items()
+    assert 6 == len(list(records))
+
+
+def test_metrics_file_split(request, tmp_path):
+    with open(f'{request.config.rootdir}/{TEST_RESOURCES}/{ML_FILE}', 'rb') as f:
+        content = f.read()
+    directories = [tmp_path / 'sequential', tmp_path / 'split']
+    for directory in directories:
+        directory.mkdir()
+        with open(directory / ML_FILE, 'wb') as f:
+            f.write(content * 5)
+    path = str(directories[1] / ML_FILE)
+    ranges = npb_log_ranges(path, 4)
+    assert 4 == len(ranges) and 0 == ranges[0][0] and len(content) * 5 == ranges[-1][1]
+    assert all(b'Run:' in (content * 5)[start:].split(b'\n', 1)[0] for start, _ in ranges[1:])
+    # A file without runs is not split
+    assert 1 == len(npb_log_ranges(f'{request.config.rootdir}/{TEST_RESOURCES}/{SMALL_FILE}', 4))
+    expected = metrics_log_process.metrics_file_process(str(directories[0]), ML_FILE)
+    with Pool(2) as p:
+        split = metrics_file_split(str(directories[1]), ML_FILE, p, 4)
+        assert expected == split.get()
+        assert count_lines(content * 5) == split.samples and 0 < split.seconds
+        # Taken before the ranges are submitted, a log appended to later is not the one processed
+        assert file_key(path, hashed=False) == split.key
+        with open(path, 'ab') as f:
+            f.write(content)
+        with Manifest('metrics', directory=str(directories[1])) as manifest:
+            manifest.record(ML_FILE, expected, split.key)
+            assert manifest.pending(ML_FILE)
+        with open(path, 'wb') as f:
+            f.write(content * 5)
+        # The same output of the whole pipeline
+        for directory, split_size in zip(directories, [None, 0]):
+            options = default_options(metrics_log_process.add_options, cores=1, split_size=split_size)
+            metrics_log_process.process_directory(str(directory), options, pool=p)
+    data = []
+    for directory in directories:
+        with open(directory / 'metrics_data.csv') as f:
+            data.append(f.read())
+    assert data[0] == data[1]
+    assert 1 + 7 * 5 == len(data[1].splitlines())
+    with Manifest('metrics', directory=str(directories[1])) as manifest:
+        history = CostModel(manifest.connection, 'metrics', 'metrics_file_split/1', str(directories[1])).history
+    assert (len(content) * 5, count_lines(content * 5)) == history[ML_FILE][:2]
+
+
+def test_process_directory(request, tmp_path, monkeypatch):
+    directories = [tmp_path / 'a', tmp_path / 'b']
+    for directory in directories:
+        directory.mkdir()
+        shutil.copy(f'{request.config.rootdir}/{TEST_RESOURCES}/{SMALL_FILE}', directory / DT_FILE)
+    with open(directories[1] / DT_FILE, 'rb') as f:
+        lines = f.readlines()
+    with open(directories[1] / DT_FILE.replace('001', '002'), 'wb') as f:
+        f.writelines(lines[:20])
+    monkeypatch.chdir(tmp_path)
+    loggers = [logging.getLogger(f'TEST.{directory.name}') for directory in directories]
+    handlers = [logging.handlers.BufferingHandler(1000) for _ in loggers]
+    for logger, handler in zip(loggers, handlers):
+        logger.addHandler(handler)
+    options = default_options(data_csv_process.add_options, cores=1, progress_interval=0)
+    with pytest.raises(AttributeError):
+        default_options(data_csv_process.add_options, no_such_option=1)
+    # Both directories at the same time, from threads sharing the pool
+    with Pool(2) as p:
+        threads = [threading.Thread(target=process_directory, args=(str(directory), options, logger, p))
+                   for directory, logger in zip(directories, loggers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # The workers of a shared pool are not profiled per run
+        process_directory(str(directories[0]), default_options(data_csv_process.add_options, cprofile=True),
+                          loggers[0], p)
+    for logger, handler in zip(loggers, handlers):
+        logger.removeHandler(handler)
+    assert os.getcwd() == str(tmp_path)
+    assert {'a', 'b'} == set(os.listdir(tmp_path))
+    # The records of the workers are logged by the logger of their run
+    for directory, handler in zip(directories, handlers):
+        messages = [record.getMessage() for record in handler.buffer]
+        assert f'[{directory}][{DT_FILE}][DROPPED ROWS: 1][REPAIRED ROWS: 0]' in messages
+        assert all(str(directory) in message for message in messages if str(tmp_path) in message)
+    assert '[cProfile needs a pool of its own' in handlers[0].buffer[-1].getMessage()
+    assert not os.path.exists(directories[0] / 'cprofile-transform')
+    expected = data_file_process(str(directories[0]), DT_FILE, ENGINE_PYTHON)
+    for directory, files in zip(directories, [1, 2]):
+        _, data = read_csv_to_dict(str(directory / 'processed_data.csv'))
+        assert files == len(data)
+        row = next(d for d in data if d[IDs.ITERATION] == '001')
+        assert float(row[IDs.ENERGY]) == pytest.approx(expected[IDs.ENERGY])
+        assert os.path.exists(directory / f'transformed-{DT_FILE}')
+        assert os.path.exists(directory / 'manifest.sqlite')
+
+
+def test_catalog(tmp_path):
+    names = {
+        'hikey970/linux/data_hikey970_linux_mg_b_4_001.csv': 'hikey970',
+        'hikey970/linux/data_hikey970_linux_mg_b_4_002.pta': 'hikey970',
+        'hikey970/linux/npb_hikey970_linux_mg_b_4.log': 'hikey970',
+        'hikey970/android/data_hikey970_android_mg_b_4_001.csv': 'hikey970',
+        'odroid/data_odroidxu4_linux_ep_a_2_001.csv': 'odroidxu4',
+    }
+    ignored = ['hikey970/linux/transformed-data_hikey970_linux_mg_b_4_001.csv', 'hikey970/linux/metrics.log',
+               'hikey970/linux/processed_data.csv', '.hidden/data_hikey970_linux_mg_b_4_003.csv', 'notes.txt']
+    for name in list(names) + ignored:
+        (tmp_path / name).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / name).write_text('x')
+    with Catalog(str(tmp_path)) as catalog:
+        assert (5, 0) == catalog.update()
+        assert (0, 0) == catalog.update()
+        assert sorted(names) == [file['path'] for file in catalog.select()]
+        selected = catalog.select(device='hikey970', os='linux', benchmark='mg')
+        assert [name for name in names if '/linux/' in name] == [file['path'] for file in selected]
+        assert ['001', '002', None] == [file['iteration'] for file in selected]
+        assert ['csv', 'pta', 'log'] == [file['suffix'] for file in selected]
+        assert 3 == len(catalog.select(suffix='csv'))
+        assert 3 == len(catalog.select(os=['android', 'linux'], benchmark=['mg', 'ep'], suffix='csv'))
+        with pytest.raises(ValueError):
+            catalog.select(joules='1')
+        (tmp_path / 'odroid/data_odroidxu4_linux_ep_a_2_001.csv').write_text('xx')
+        os.remove(tmp_path / 'hikey970/android/data_hikey970_android_mg_b_4_001.csv')
+        assert (1, 1) == catalog.update()
+        assert 2 == catalog.select(directory='odroid')[0]['bytes']
+    # Directories are not listed
+    assert {'catalog.sqlite', 'notes.txt'} == set(list_files(tmp_path))
+
+
+class FakeTerminal(io.StringIO):
+
+    def isatty(self):
+        return True
+
+
+def test_progress(caplog):
+    logger = logging.getLogger('TEST')
+    terminal = FakeTerminal()
+    progress = Progress(logger, 4, 4000000, cores=2, interval=None, name='TEST', stream=terminal)
+    assert progress.sample()['eta'] is None
+    progress.done(1000000, 500, 0.5, worker=1)
+    progress.done(2000000, 1000, 1.0, worker=2)
+    sample = progress.sample()
+    assert (2, 4, 3.0) == (sample['files'], sample['total'], sample['mb'])
+    assert [1, 2] == list(sample['utilization'])
+    assert sample['eta'] == pytest.approx(sample['elapsed'] / 3, rel=0.01)
+    assert sample['rows_s'] == pytest.approx(1500 / sample['elapsed'], rel=0.01)
+    assert terminal.getvalue().startswith('\rTEST [1/4 files][1.0 MB]')
+    with caplog.at_level(logging.INFO):
+        progress.done(1000000, 0, 0.1, worker=1)
+        assert '[PROGRESS]' not in caplog.text
+        progress.finish()
+    assert '[PROGRESS][TEST][3/4 files][4.0 MB]' in caplog.text
+    assert '[WORKERS 1:' in caplog.text
+    # Unknown sizes, the ETA comes from the files done
+    progress = Progress(logger, 3, stream=None)
+    progress.done()
+    sample = progress.sample()
+    assert sample['eta'] == pytest.approx(2 * sample['elapsed'])
+
+
+def test_write_csv_sorted(request, tmp_path):
+    _, data = read_csv_to_dict(f'{request.config.rootdir}/{TEST_RESOURCES}/{MT_METRICS_DATA}')
+    data = data[::-1] + data[:7]
+    logger = logging.getLogger('TEST')
+    expected = sorted(data, key=lambda d: (d[IDs.TYPE], d[IDs.DEVICE], d[IDs.OS], d[IDs.BENCH], d[IDs.SIZE],
+                                           d[IDs.THREADS], d[IDs.ITERATION]))
+    write_csv_list_of_dict(tmp_path / 'expected.csv', expected[:5], logger)
+    write_csv_list_of_dict(tmp_path / 'expected.csv', expected[5:], logger)
+    # Runs of 3 rows, the first write creates the file and the next one appends
+    assert 5 == write_csv_sorted(tmp_path / 'result.csv', expected[:5][::-1], logger, run_size=3)
+    assert len(data) - 5 == write_csv_sorted(tmp_path / 'result.csv', iter(expected[5:][::-1]), logger, run_size=3)
+    assert (tmp_path / 'expected.csv').read_text() == (tmp_path / 'result.csv').read_text()
+    assert 0 == write_csv_sorted(tmp_path / 'empty.csv', [], logger)
+    # Rows with other columns, the header is the union and the csv is rewritten with it
+    extra = [dict(d, watts='1.5') for d in expected[:2]]
+    assert 2 == write_csv_sorted(tmp_path / 'result.csv', extra[::-1], logger)
+    header, result = read_csv_to_dict(tmp_path / 'result.csv')
+    assert list(expected[0].keys()) + ['watts'] == header
+    assert sorted(sorted(d.items()) for d in expected + extra) == \
+        sorted(sorted((k, v) for k, v in d.items() if v or k != 'watts') for d in result)
+
+
+def failing_task(cwd, file, failure):
+    if failure == 'memory':
+        return bytearray(8 * 1024 * 1024 * 1024)
+    if failure == 'timeout':
+        time.sleep(10)
+    if failure == 'error':
+        raise ValueError('malformed')
+    if failure == 'killed':
+        os.kill(os.getpid(), signal.SIGKILL)
+    if failure == 'blocked':
+        # The alarm of the worker can not stop it, as a task blocked in C code
+        signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGALRM])
+        time.sleep(30)
+    return {'file': file}
+
+
+def test_run_scheduled_limits(dt_directory, caplog):
+    logger = logging.getLogger('TEST')
+    failures = ['memory', 'timeout', 'error', 'killed', 'blocked', None]
+    for i in range(len(failures)):
+        shutil.copy(DT_FILE, f'{i}.csv')
+    tasks = [(failing_task, str(dt_directory), f'{i}.csv', failure) for i, failure in enumerate(failures)]
+    options = Values({'cores': 2, 'max_memory': 4096, 'task_timeout': 0.5, 'max_tasks_per_child': 1, 'profile': False})
+    with Manifest('test') as manifest, limited_pool(options) as p:
+        model = CostModel(manifest.connection, 'test', task_mode(tasks[0]))
+        with caplog.at_level(logging.WARNING):
+            results = list(run_scheduled(p, tasks, model, 2, logger, manifest, timeout=options.task_timeout))
+        assert [('5.csv', {'file': '5.csv'})] == [(file, result) for file, _, result in results]
+        quarantined = dict(manifest.quarantined())
+        assert ['0.csv', '1.csv', '2.csv', '3.csv', '4.csv'] == sorted(quarantined)
+        assert quarantined['0.csv'].startswith('MemoryError')
+        assert quarantined['1.csv'].startswith('TaskTimeout')
+        assert 'ValueError: malformed' == quarantined['2.csv']
+        # The pool replaces a killed worker but never returns its task
+        assert quarantined['3.csv'].startswith('Worker ') and ' died' in quarantined['3.csv']
+        # Killed by the parent once past the timeout
+        assert quarantined['4.csv'].startswith('TaskTimeout') and quarantined['4.csv'].endswith(' killed')
+        assert '[QUARANTINED][5 files]' in caplog.text
+        # Quarantined files are skipped until they change
+        assert not manifest.pending('2.csv')
+        with open('2.csv', 'ab') as f:
+            f.write(b'\n')
+        assert manifest.pending('2.csv')
+        manifest.record('2.csv', [])
+        assert ['0.csv', '1.csv', '3.csv', '4.csv'] == [file for file, _ in manifest.quarantined()]
+
+
+def test_collect_rss():
+    profiling.enable()
+    try:
+        profiling.collect()
+        # Over the peak of the earlier tests
+        headroom = profiling.max_rss_kb() * 1024 - psutil.Process().memory_info().rss
+        memory = bytearray(max(headroom, 0) + 64 * 1024 * 1024)
+        memory[::4096] = b'x' * len(memory[::4096])
+        first = profiling.collect()
+        del memory
+        # A peak of earlier work is not reported again by the next one
+        second = profiling.collect()
+    finally:
+        profiling.enable(False)
+    assert 60 * 1024 < first['max_rss_delta_kb']
+    assert 0 == second['max_rss_delta_kb']
+    assert first['worker_max_rss_kb'] == second['worker_max_rss_kb']
+    combined = profiling.combine(profiling.combine(None, first), second)
+    assert (first['max_rss_delta_kb'], first['worker_max_rss_kb']) == \
+        (combined['max_rss_delta_kb'], combined['worker_max_rss_kb'])
+    assert combined is profiling.combine(combined, None)
+
+
+def test_profile_report(dt_directory):
+    logger = logging.getLogger('TEST')
+    assert stage('parse') is stage('plot')
+    tasks = [(data_file_process, str(dt_directory), DT_FILE, engine) for engine in [ENGINE_PYTHON, ENGINE_NUMPY]]
+    options = Values({'cores': 2, 'max_memory': None, 'task_timeout': None, 'max_tasks_per_child': None,
+                      'profile': True})
+    report = ProfileReport('test')
+    with Manifest('test') as manifest, limited_pool(options) as p:
+        model = CostModel(manifest.connection, 'test', 'test')
+        assert 2 == len(list(run_scheduled(p, tasks, model, 2, logger, manifest, report)))
+    assert not profiling.enabled()
+    report.write(logger)
+    with open('profile-test.json') as f:
+        saved = json.load(f)
+    assert {'parse_integrate', 'parse', 'integrate', 'plot', 'write'} == set(saved['stages'])
+    assert 2 == saved['stages']['plot']['files']
+    assert all(0 < file['worker_max_rss_kb'] and 0 <= file['max_rss_delta_kb'] for file in saved['files'])
+    _, rows = read_csv_to_dict('profile-test.csv')
+    assert 7 == len(rows)
+
+
+def test_cprofile(dt_directory):
+    logger = logging.getLogger('TEST')
+    tasks = [(data_file_process, str(dt_directory), DT_FILE, engine) for engine in [ENGINE_PYTHON, ENGINE_NUMPY]]
+    options = Values({'cores': 2, 'max_memory': None, 'task_timeout': None, 'max_tasks_per_child': None,
+                      'profile': False})
+    directory = profiling.make_cprofile_directory('test')
+    with Manifest('test') as manifest, limited_pool(options, directory) as p:
+        model = CostModel(manifest.connection, 'test', 'test')
+        assert 2 == len(list(run_scheduled(p, tasks, model, 2, logger, manifest)))
+    # Only the workers of the pool profile
+    assert profiling.cprofiled('x') is stage('x')
+    assert 2 == len(os.listdir(directory))
+    stats = profiling.merge_cprofiles(directory, 'cprofile-test', logger)
+    assert 'calculate_energy' in {name for _, _, name in stats.stats}
+    assert 'data_file_process' in {name for _, _, name in pstats.Stats('cprofile-test.pstats').stats}
+    with open('cprofile-test.collapsed') as f:
+        lines = f.read().splitlines()
+    stacks = dict(line.rsplit(' ', 1) for line in lines)
+    assert all(int(us) > 0 for us in stacks.values())
+    assert any(stack.startswith('data_file_process (data_csv_process.py:') and 'calculate_energy' in stack
+               for stack in stacks)
+    # The own time of all the stacks is the total time of the profile
+    assert sum(map(int, stacks.values())) / 1e6 == pytest.approx(stats.total_tt, rel=0.05)
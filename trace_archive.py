@@ -0,0 +1,266 @@
+import json
+import logging
+import os
+import struct
+from itertools import islice
+from multiprocessing.pool import Pool
+
+import numpy
+
+from catalog import is_power_csv
+from common import TimestampParser, RawCsvStats, read_raw_rows, log_to_file, parse_args, open_input, \
+    strip_compression
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='[%(process)d][%(asctime)s.%(msecs)03d][%(name)s][%(levelname)s]%(message)s',
+    datefmt='%Y/%m/%d-%H:%M:%S'
+)
+
+logger = logging.getLogger('ARCHIVE')
+
+ARCHIVE_VERSION = 1
+ARCHIVE_SUFFIX = '.pta'
+ARCHIVE_MAGIC = b'PTRACE\x00\x01'
+# Rows per block, a range query decodes only the blocks it touches
+ARCHIVE_BLOCK_ROWS = 65536
+# Blocks start at offsets multiple of ALIGNMENT so they can be viewed as numpy arrays
+ALIGNMENT = 8
+FOOTER_OFFSET = struct.Struct('<Q')
+TS_DTYPE = numpy.dtype('<i8')
+DELTA_DTYPES = [numpy.dtype('<i4'), TS_DTYPE]
+POWER_DTYPE = numpy.dtype('<f4')
+
+
+# Archive layout, little endian:
+# - ARCHIVE_MAGIC
+# - blocks of at most ARCHIVE_BLOCK_ROWS rows: timestamp deltas in microseconds (int32, int64 when
+#   a delta does not fit) followed by power in milliwatt (float32), each array aligned to ALIGNMENT
+# - footer, json: version, rows, first timestamp, blocks as (offset, rows, delta dtype, first
+#   timestamp, min timestamp, max timestamp), marks as (position, operation, timestamp) and the
+#   not valid rows found in the source csv
+# - offset of the footer, uint64
+# The first delta of a block is 0, timestamps of a block are 'first timestamp' + cumsum(deltas)
+
+
+def archive_name(file):
+    """
+    :return: string, name of the archive of the csv 'file', 'x.csv' and 'x.csv.gz' become 'x.pta'
+    """
+    return f'{os.path.splitext(strip_compression(file))[0]}{ARCHIVE_SUFFIX}'
+
+
+def is_archive(file):
+    return file.endswith(ARCHIVE_SUFFIX)
+
+
+def _pad(f):
+    f.write(b'\x00' * (-f.tell() % ALIGNMENT))
+
+
+def write_archive(path, rows, stats=None, block_rows=ARCHIVE_BLOCK_ROWS):
+    """
+    Writes the rows of a raw power csv as an archive, rows are read by blocks
+    so memory usage does not depend on the length of the csv
+    :param path: string, archive file name
+    :param rows: iterable of tuples (time, power, operation), see 'common.read_raw_rows'
+    :param stats: RawCsvStats of 'rows', saved in the footer
+    :param block_rows: int, rows per block
+    :return: int, number of rows
+    """
+    parser = TimestampParser()
+    blocks, marks = [], []
+    n = 0
+    rows = iter(rows)
+    with open(path, 'wb') as f:
+        f.write(ARCHIVE_MAGIC)
+        for chunk in iter(lambda: list(islice(rows, block_rows)), []):
+            chunk_time, chunk_power, chunk_op = zip(*chunk)
+            ts = numpy.array(parser.epoch_us_column(chunk_time), dtype=TS_DTYPE)
+            deltas = numpy.diff(ts, prepend=ts[0])
+            dtype = DELTA_DTYPES[0]
+            if len(deltas) and (deltas.min() < numpy.iinfo(dtype).min or deltas.max() > numpy.iinfo(dtype).max):
+                dtype = DELTA_DTYPES[1]
+            for p, op in enumerate(chunk_op):
+                if op != '':
+                    marks.append((n + p, op, int(ts[p])))
+            _pad(f)
+            blocks.append((f.tell(), len(chunk), dtype.str, int(ts[0]), int(ts.min()), int(ts.max())))
+            f.write(deltas.astype(dtype).tobytes())
+            _pad(f)
+            f.write(numpy.fromiter(map(float, chunk_power), dtype=POWER_DTYPE, count=len(chunk)).tobytes())
+            n += len(chunk)
+        footer = {
+            'version': ARCHIVE_VERSION, 'rows': n, 'ts_first': blocks[0][3] if blocks else None,
+            'blocks': blocks, 'marks': marks,
+            'stats': {'dropped': stats.dropped, 'repaired': stats.repaired} if stats else None
+        }
+        offset = f.tell()
+        f.write(json.dumps(footer).encode())
+        f.write(FOOTER_OFFSET.pack(offset))
+    return n
+
+
+def csv_to_archive(file, path=None):
+    """
+    Converts the raw power csv 'file' to an archive, not valid rows are skipped
+    :param file: string, csv file name, it can be compressed, see 'common.open_input'
+    :param path: string, archive file name, see 'archive_name' if None
+    :return: tuple (rows, RawCsvStats of the csv), rows is the number of rows archived
+    """
+    stats = RawCsvStats()
+    with open_input(file) as f:
+        rows = write_archive(path or archive_name(file), read_raw_rows(f, stats), stats)
+    return rows, stats
+
+
+class TraceArchive:
+    """
+    Read only access to an archive, the file is memory mapped and blocks are decoded
+    only when a query needs them. Timestamps are returned as numpy int64 arrays of
+    microseconds since epoch and power as numpy float32 arrays of milliwatt.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._map = numpy.memmap(path, dtype=numpy.uint8, mode='r')
+        if bytes(self._map[:len(ARCHIVE_MAGIC)]) != ARCHIVE_MAGIC:
+            raise ValueError(f'{path} is not a power trace archive')
+        offset, = FOOTER_OFFSET.unpack(bytes(self._map[-FOOTER_OFFSET.size:]))
+        footer = json.loads(bytes(self._map[offset:-FOOTER_OFFSET.size]))
+        if footer['version'] != ARCHIVE_VERSION:
+            raise ValueError(f'{path} has archive version {footer["version"]}, expected {ARCHIVE_VERSION}')
+        self.rows = footer['rows']
+        self.ts_first = footer['ts_first']
+        self.blocks = [tuple(b) for b in footer['blocks']]
+        self.marks = [tuple(m) for m in footer['marks']]
+        self.stats = RawCsvStats()
+        if footer['stats']:
+            self.stats.dropped, self.stats.repaired = footer['stats']['dropped'], footer['stats']['repaired']
+        self._starts = numpy.cumsum([0] + [b[1] for b in self.blocks])
+
+    def __len__(self):
+        return self.rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._map = None
+
+    def _block(self, i):
+        offset, rows, dtype, ts_base, _, _ = self.blocks[i]
+        dtype = numpy.dtype(dtype)
+        deltas = self._map[offset:offset + rows * dtype.itemsize].view(dtype)
+        offset += rows * dtype.itemsize
+        offset += -offset % ALIGNMENT
+        mw = self._map[offset:offset + rows * POWER_DTYPE.itemsize].view(POWER_DTYPE)
+        return ts_base + numpy.cumsum(deltas, dtype=TS_DTYPE), mw
+
+    def _concatenate(self, parts):
+        if not parts:
+            return numpy.empty(0, dtype=TS_DTYPE), numpy.empty(0, dtype=POWER_DTYPE)
+        return numpy.concatenate([p[0] for p in parts]), numpy.concatenate([p[1] for p in parts])
+
+    def read(self, start=0, stop=None):
+        """
+        Rows from position 'start' to 'stop' (not included), as 'list[start:stop]'
+        :return: tuple of numpy arrays (timestamps, power)
+        """
+        start, stop, _ = slice(start, stop).indices(self.rows)
+        parts = []
+        for i in range(len(self.blocks)):
+            first, last = self._starts[i], self._starts[i + 1]
+            if first < stop and start < last:
+                ts, mw = self._block(i)
+                parts.append((ts[max(start - first, 0):stop - first], mw[max(start - first, 0):stop - first]))
+        return self._concatenate(parts)
+
+    def time_range(self, ts_start, ts_stop):
+        """
+        Rows with a timestamp from 'ts_start' to 'ts_stop' (not included), in file order
+        :param ts_start: int, microseconds since epoch
+        :param ts_stop: int, microseconds since epoch
+        :return: tuple of numpy arrays (timestamps, power)
+        """
+        parts = []
+        for i, (_, _, _, _, ts_min, ts_max) in enumerate(self.blocks):
+            if ts_min < ts_stop and ts_start <= ts_max:
+                ts, mw = self._block(i)
+                inside = (ts >= ts_start) & (ts < ts_stop)
+                parts.append((ts[inside], mw[inside]))
+        return self._concatenate(parts)
+
+    def position(self, op):
+        """
+        :return: int, position of the first row with the mark 'op', None if not found
+        """
+        return next((p for p, o, _ in self.marks if o == op), None)
+
+    def mark_range(self, start='XS', finish='XF'):
+        """
+        Rows from the first 'start' mark to the first 'finish' mark, both included,
+        empty when a mark is not found or 'finish' is before 'start'
+        :return: tuple of numpy arrays (timestamps, power)
+        """
+        first, last = self.position(start), self.position(finish)
+        if first is None or last is None or last < first:
+            return self._concatenate([])
+        return self.read(first, last + 1)
+
+
+def archive_file_process(cwd, file, keep):
+    """
+    Archives the csv 'file' of the directory 'cwd', the csv is removed if not 'keep' and
+    its rows were archived. Archives without rows or not complete are removed, they would
+    be processed instead of the csv, see 'data_csv_process.get_files'.
+    :return: int, number of rows archived
+    """
+    logger.info(f'[{cwd}][{file}]')
+    path = os.path.join(cwd, archive_name(file))
+    try:
+        rows, stats = csv_to_archive(os.path.join(cwd, file), path)
+    except Exception:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+    if stats:
+        logger.warning(f'[{cwd}][{file}]{stats}')
+    if not rows:
+        os.remove(path)
+        logger.warning(f'[{cwd}][{file}][No rows, the csv is not archived]')
+    elif not keep:
+        os.remove(os.path.join(cwd, file))
+    return rows
+
+
+def get_files(filter, directory=os.curdir):
+    """
+    :return: a list of string, the raw power csv files of 'directory', compressed or not,
+    the outputs of the scripts are not included, see 'catalog.is_power_csv'
+    """
+    return [f for f in os.listdir(directory) if is_power_csv(f) and (filter is None or f.startswith(filter))]
+
+
+def add_options(parser):
+    parser.add_option('--remove-csv', action='store_false', dest='keep', default=True,
+                      help='remove each csv file once its archive is written')
+
+
+def main():
+    options = parse_args(logger, add_options)
+    logger.addHandler(log_to_file(os.path.join(options.directory, 'archive.log')))
+
+    cwd = os.path.abspath(options.directory)
+    files = get_files(options.starts_with, cwd)
+    with Pool(options.cores) as p:
+        results = [p.apply_async(archive_file_process, (cwd, file, options.keep)) for file in files]
+        for result in results:
+            result.get()
+
+
+if __name__ == '__main__':
+    main()
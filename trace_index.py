@@ -0,0 +1,162 @@
+import json
+import logging
+import os
+from bisect import bisect_right
+from multiprocessing.pool import Pool
+
+from catalog import is_power_csv
+from common import TimestampParser, RawCsvStats, raw_line_rows, log_to_file, parse_args, compression_suffix
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='[%(process)d][%(asctime)s.%(msecs)03d][%(name)s][%(levelname)s]%(message)s',
+    datefmt='%Y/%m/%d-%H:%M:%S'
+)
+
+logger = logging.getLogger('INDEX')
+
+INDEX_VERSION = 1
+INDEX_SUFFIX = '.idx'
+
+
+class TraceIndex:
+    """
+    Sidecar index of a raw power csv, saved as '<file>.idx' (json):
+    - size and mtime_ns of the csv when the index was built, the index is not valid
+      if any of them changes
+    - seconds: a list of (epoch seconds, offset), offset of the first row of each second
+    - marks: a list of (operation, offset, end, epoch microseconds), 'offset' is where the
+      row with the mark starts and 'end' where the next row starts
+    """
+
+    def __init__(self, size, mtime_ns, seconds, marks):
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.seconds = seconds
+        self.marks = marks
+
+    def is_valid(self, file):
+        stat = os.stat(file)
+        return self.size == stat.st_size and self.mtime_ns == stat.st_mtime_ns
+
+    def offset_at(self, epoch_seconds):
+        """
+        :return: int, offset of the first row of the last indexed second not after 'epoch_seconds'
+        """
+        i = bisect_right([s for s, _ in self.seconds], epoch_seconds)
+        return self.seconds[max(i - 1, 0)][1] if self.seconds else 0
+
+    def first_mark(self, op):
+        """
+        :return: the first mark with operation 'op' as (operation, offset, end, epoch microseconds) or None
+        """
+        return next((mark for mark in self.marks if mark[0] == op), None)
+
+    def to_dict(self):
+        return {
+            'version': INDEX_VERSION, 'size': self.size, 'mtime_ns': self.mtime_ns,
+            'seconds': self.seconds, 'marks': self.marks
+        }
+
+
+def index_path(file):
+    return f'{file}{INDEX_SUFFIX}'
+
+
+def build_index(file):
+    """
+    Scans 'file' once and returns its TraceIndex, only timestamps that start a new second
+    and rows with marks are parsed. Rows are read as 'common.read_raw_rows' does, not valid
+    rows are ignored and the rows recovered from damaged lines are indexed at their line.
+    :param file: string, path of a raw power csv
+    :return: TraceIndex
+    """
+    stat = os.stat(file)
+    parser = TimestampParser()
+    stats = RawCsvStats()
+    seconds, marks = [], []
+    last_second = None
+    row = None  # Last valid row
+    with open(file, 'rb') as f:
+        offset = len(f.readline())
+        for line in f:
+            end = offset + len(line)
+            # A last line without new line is torn, see 'common.read_raw_rows'
+            if line.endswith(b'\n'):
+                for row in raw_line_rows(line[:-1].decode('latin-1'), stats, parser, row):
+                    time_str, _, op = row
+                    second = time_str.partition('.')[0]
+                    if second != last_second or op:
+                        ts = parser.epoch_us(time_str)
+                        if ts is not None:
+                            if second != last_second:
+                                seconds.append((ts // 1000000, offset))
+                                last_second = second
+                            if op:
+                                marks.append((op, offset, end, ts))
+            offset = end
+    return TraceIndex(stat.st_size, stat.st_mtime_ns, seconds, marks)
+
+
+def save_index(file, index):
+    with open(index_path(file), 'w') as f:
+        json.dump(index.to_dict(), f)
+
+
+def read_index(file):
+    """
+    :return: the TraceIndex saved for 'file', None if there is no index, it has another
+    version or it is not valid anymore (file changed)
+    """
+    try:
+        with open(index_path(file), 'r') as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if saved.get('version') != INDEX_VERSION:
+        return None
+    index = TraceIndex(
+        saved['size'], saved['mtime_ns'],
+        [tuple(s) for s in saved['seconds']], [tuple(m) for m in saved['marks']]
+    )
+    return index if index.is_valid(file) else None
+
+
+def load_index(file, logger=None):
+    """
+    Returns the index of 'file', it is built and saved if there is no valid index.
+    When the index can not be saved (ie. read only storage) it is used anyway.
+    :return: TraceIndex
+    """
+    index = read_index(file)
+    if index is None:
+        index = build_index(file)
+        try:
+            save_index(file, index)
+        except OSError as e:
+            if logger is not None:
+                logger.warning(f'[{file}][Index not saved: {e}]')
+    return index
+
+
+def index_file_process(cwd, file):
+    logger.info(f'[{cwd}][{file}]')
+    load_index(os.path.join(cwd, file), logger)
+
+
+def main():
+    options = parse_args(logger)
+    logger.addHandler(log_to_file(os.path.join(options.directory, 'index.log')))
+
+    cwd = os.path.abspath(options.directory)
+    # Compressed files can not be read from an offset, they are always read whole
+    files = [f for f in os.listdir(cwd) if is_power_csv(f) and not compression_suffix(f) and
+             (options.starts_with is None or f.startswith(options.starts_with))]
+    with Pool(options.cores) as p:
+        results = [p.apply_async(index_file_process, (cwd, file)) for file in files]
+        for result in results:
+            result.get()
+
+
+if __name__ == '__main__':
+    main()